@@ -106,6 +106,18 @@ class ConfigParser(object):
             cpoint_dict = {}
         self.checkpointing = CheckpointCfg(**cpoint_dict)
 
+        # Multistage checkpointing requires the fixed number of timesteps
+        assert not (self.checkpointing.method == "multistage"
+                    and self.time.adaptive), \
+            "Adaptive timestepping requires non-multistage checkpointing"
+
+        # Optional prior operator solver section
+        try:
+            prior_dict = self.config_dict['prior']
+        except KeyError:
+            prior_dict = {}
+        self.prior = PriorCfg(**prior_dict)
+
         # Optional section for sampling prior and posterior
         try:
             sample_dict = self.config_dict['sample']
@@ -152,14 +164,16 @@ class ConfigParser(object):
                     self.eigendec.phase_name,
                     self.error_prop.phase_name,
                     self.inv_sigma.phase_name,
-                    self.obs_sens.phase_name]
+                    self.obs_sens.phase_name,
+                    self.sample.phase_name]
 
         ph_suffix = [self.inversion.phase_suffix,
                     self.time.phase_suffix,
                     self.eigendec.phase_suffix,
                     self.error_prop.phase_suffix,
                     self.inv_sigma.phase_suffix,
-                    self.obs_sens.phase_suffix]
+                    self.obs_sens.phase_suffix,
+                    self.sample.phase_suffix]
 
         for ph, suff in zip(ph_names, ph_suffix):
             out_dir = (outdir / ph / suff)
@@ -230,6 +244,11 @@ class InversionCfg(ConfigPrinter):
     use_cloud_point_velocities: bool = False
 
     mass_precon: bool = True
+
+    # Number of converged velocities kept to seed forward solves (0 disables)
+    velocity_cache_size: int = 0
+    velocity_cache_method: str = "nearest"  # or "extrapolate"
+
     phase_name: str = 'inversion'
     phase_suffix: str = ''
 
@@ -239,6 +258,10 @@ class InversionCfg(ConfigPrinter):
         """
         assert (self.alpha_active or self.beta_active)
 
+        assert self.velocity_cache_size >= 0
+        assert self.velocity_cache_method in ["nearest", "extrapolate"], \
+            "Valid selections for 'velocity_cache_method' are 'nearest' or 'extrapolate'"
+
         assert self.initial_guess_alpha_method.lower() in ["sia", "wearing", "constant"]
 
         assert (self.initial_guess_alpha_method == "constant") == \
@@ -258,6 +281,8 @@ class ObsCfg(ConfigPrinter):
     """
     vel_file: str = None
     pts_len: float = None
+    # Keep observation operators on disk for reuse by later runs & phases
+    cache_operators: bool = False
 
 @dataclass(frozen=True)
 class ErrorPropCfg(ConfigPrinter):
@@ -268,6 +293,7 @@ class ErrorPropCfg(ConfigPrinter):
     qoi_apply_vaf_mask: bool = False
     qoi_vaf_mask_usecode: bool = False
     qoi_vaf_mask_code: int = 1
+    batched: bool = False  # all dQ/dm snapshots as one block
     phase_name: str = 'error_prop'
     phase_suffix: str = ''
 
@@ -294,9 +320,18 @@ class SampleCfg(ConfigPrinter):
     # this is to do nothing right now -- but it might be more efficient to create interactive plots
     # interactive_plot: bool = False
     num_eigenvals: int = 0
+    block_size: int = 16  # samples drawn (& projected) at once
+    write_samples: bool = False  # stream every sample to HDF5
+    n_groups: int = 1  # process groups sampling independently
     phase_name: str = 'sample'
     phase_suffix: str = ''
 
+    def __post_init__(self):
+        """Check sampling parameters"""
+        assert self.sample_size >= 1
+        assert self.block_size >= 1
+        assert self.n_groups >= 1
+
 @dataclass(frozen=True)
 class MeltParamCfg(ConfigPrinter):
     """
@@ -313,6 +348,10 @@ class InvSigmaCfg(ConfigPrinter):
     """
     patch_downscale: float = None
     npatches: int = None
+    batched: bool = False  # all patches at once
+    prior_variance: str = "exact"  # or "sampled" (batched only)
+    prior_variance_samples: int = 1000
+    block_size: int = 64  # columns per multi-RHS block
     phase_name: str = 'inv_sigma'
     phase_suffix: str = ''
 
@@ -322,6 +361,30 @@ class InvSigmaCfg(ConfigPrinter):
             "Provide only one of npatches, patwnscale in [invsigma]"
         if self.npatches is None and self.patch_downscale is None:
             object.__setattr__(self, 'patch_downscale', 0.1)
+        assert self.prior_variance in ["exact", "sampled"], \
+            "Valid selections for 'prior_variance' are 'exact' or 'sampled'"
+        assert self.block_size >= 1
+
+@dataclass(frozen=True)
+class PriorCfg(ConfigPrinter):
+    """
+    Configuration of the linear solvers for the prior (A) & mass (M) operators
+    """
+    A_solver: str = "cg"  # or "lu", "cholesky", "amg"
+    M_solver: str = "cg"  # or "lu", "cholesky"
+    factor_package: str = None  # PETSc default (mumps for "cholesky"), or e.g. "mumps"
+    rtol: float = 1.0e-14
+    atol: float = 1.0e-32
+    sqrt_method: str = "binomial"  # or "chebyshev", for the mass matrix root
+
+    def __post_init__(self):
+        """Check solver choices"""
+        assert self.A_solver in ["cg", "lu", "cholesky", "amg"], \
+            "Valid selections for 'A_solver' are 'cg', 'lu', 'cholesky' or 'amg'"
+        assert self.M_solver in ["cg", "lu", "cholesky"], \
+            "Valid selections for 'M_solver' are 'cg', 'lu' or 'cholesky'"
+        assert self.sqrt_method in ["binomial", "chebyshev"], \
+            "Valid selections for 'sqrt_method' are 'binomial' or 'chebyshev'"
 
 @dataclass(frozen=True)
 class EigenDecCfg(ConfigPrinter):
@@ -331,11 +394,24 @@ class EigenDecCfg(ConfigPrinter):
     num_eig: int = None
     eig_algo: str = "slepc"
     power_iter: int = 1   #Number of power iterations for random algorithm
+    oversampling: int = 10  #Additional random vectors for random algorithm
+    single_pass: bool = False  #Single sweep of Hessian actions (random)
+    n_replicas: int = 1  #Model replicas computing Hessian actions (random)
+    resume: bool = False  #Continue from previously written eigenpairs
+    profile: bool = False  #Write per-call timings to the diagnostics dir
+    # Relax the Krylov tolerance of the TLM/adjoint solves in Hessian
+    # actions as the eigensolver converges, up to hessian_rtol_max
+    inexact_hessian: bool = False
+    hessian_rtol_max: float = 1.0e-4
     misfit_only: bool = False
     precondition_by: str = "prior"
     test_ed: bool = False
     tol: float = 1.0e-10
     max_iter: int = 1e6
+    # Check eigenvectors have unit prior norm when loaded by later phases
+    check_norms: bool = True
+    # Only eigenvalues above this are used by run_sample
+    eigenvalue_thresh: float = None
     phase_name: str = 'eigendec'
     phase_suffix: str = ''
 
@@ -346,6 +422,17 @@ class EigenDecCfg(ConfigPrinter):
         assert self.eig_algo in ["slepc", "random"], \
             "Valid selections for 'eig_algo' are 'slepc' or 'random'"
 
+        if self.eig_algo == "random":
+            assert self.num_eig is not None, \
+                "'num_eig' is required for eig_algo 'random'"
+            assert self.power_iter >= 1
+            assert self.oversampling >= 0
+
+        assert 0.0 < self.hessian_rtol_max < 1.0
+        assert self.n_replicas >= 1
+        assert self.n_replicas == 1 or self.eig_algo == "random", \
+            "Hessian replicas ('n_replicas' > 1) require eig_algo 'random'"
+
 @dataclass(frozen=True)
 class ConstantsCfg(ConfigPrinter):
     """
@@ -362,6 +449,8 @@ class ConstantsCfg(ConfigPrinter):
     vel_rp: float = 1e-2         #Regularisation for velocity
     float_eps: float = 1e-6      #Floats closer than float_eps are considered equal
 
+    # The one seed for all random draws: the sample, invsigma & eigendec
+    # phases seed their streams (sample_rng) from it
     random_seed: int = None      #Optionally seeds random generator
 
     def __post_init__(self):
@@ -431,8 +520,32 @@ class MassSolveCfg(ConfigPrinter):
 
     use_cg_thickness: bool = False
 
+    # Keep the thickness matrix & linear solver (& so the sparsity pattern &
+    # symbolic factorization) between timesteps
+    reuse_solver: bool = False
+    # 'lu', or 'gmres' with 'preconditioner' ('default' is PETSc's ILU, or
+    # block Jacobi/ILU in parallel)
+    linear_solver: str = "lu"
+    preconditioner: str = "default"
+    rtol: float = 1.0e-12
+    atol: float = 1.0e-30
+
+    # 'implicit' (backward Euler) or 'explicit' (forward Euler upwind DG0,
+    # sub-stepped to satisfy cfl, with no global solve)
+    scheme: str = "implicit"
+    cfl: float = 0.5
+    max_substeps: int = 1000
+
     def __post_init__(self):
-     """  """
+        """Check options valid"""
+        assert self.linear_solver in ["lu", "gmres"], \
+            "Valid selections for 'linear_solver' are 'lu' or 'gmres'"
+        assert self.scheme in ["implicit", "explicit"], \
+            "Valid selections for 'scheme' are 'implicit' or 'explicit'"
+        assert not (self.scheme == "explicit" and self.use_cg_thickness), \
+            "The explicit thickness scheme requires DG0 thickness"
+        assert 0.0 < self.cfl <= 1.0
+        assert self.max_substeps >= 1
 
 
 @dataclass(frozen=True)
@@ -466,6 +579,20 @@ class MomsolveCfg(ConfigPrinter):
                           'krylov_solver': {'absolute_tolerance': 1.0e-50,
                                             'relative_tolerance': 1.0e-8}}})
 
+    # Keep forms, assembled tensors, linear solvers & BCs between solves
+    reuse_solver: bool = False
+
+    # Switch from picard to newton once the residual has dropped by this factor
+    picard_switch_rtol: float = None
+    # Skip picard when starting from a previously converged velocity
+    newton_warm_start: bool = False
+
+    def __post_init__(self):
+        """Check options valid"""
+        if self.picard_switch_rtol is not None:
+            assert 0.0 < self.picard_switch_rtol < 1.0, \
+                "picard_switch_rtol must be in (0, 1)"
+
 
 @dataclass(frozen=True)
 class IOCfg(ConfigPrinter):
@@ -514,6 +641,9 @@ class IOCfg(ConfigPrinter):
 
     log_level: str = "info"
     output_var_format: str = "all"
+    # Write timestep output to one time-series XDMF file, rather than files
+    # per variable & step
+    timeseries_output: bool = False
 
     def set_default_filename(self, attr_name, suffix):
         """Sets a default filename (prefixed with run_name) & check suffix"""
@@ -568,6 +698,14 @@ class TimeCfg(ConfigPrinter):
     dt: float = None
     num_sens: int = 1
     save_frequency: float = 0
+    # Adaptive timestepping: dt from a CFL estimate (& optionally a target
+    # max thickness change per step), landing exactly on the num_sens times
+    adaptive: bool = False
+    cfl: float = 1.0
+    dt_min: float = None
+    dt_max: float = None  # default: dt
+    dH_tol: float = None
+    dt_growth: float = 2.0
 
     phase_name: str = 'forward'
     phase_suffix: str = ''
@@ -579,6 +717,12 @@ class TimeCfg(ConfigPrinter):
           Must provide run_length (total len)
           Must provide exactly one of: total_steps, dt, steps_per_year
         """
+        assert self.cfl > 0.0
+        assert self.dt_growth >= 1.0
+        assert self.dH_tol is None or self.dH_tol > 0.0
+        if self.dt_min is not None and self.dt_max is not None:
+            assert 0.0 < self.dt_min <= self.dt_max
+
         #Check user provided exactly one way to specify dt:
         assert sum([x is not None for x in [self.total_steps,
                                         self.dt,
@@ -56,8 +56,11 @@
 from .backend import HDF5File, XDMFFile, function_get_values, \
     function_global_size, function_local_size, function_set_values, \
     is_function, norm, project, space_comm, space_new
+from . import inout
 
 import functools
+import hashlib
+import mpi4py.MPI as MPI  # noqa: N817
 import logging
 import numpy as np
 from pathlib import Path
@@ -69,7 +72,11 @@ log = logging.getLogger("fenics_ice")
 
 __all__ = \
     [
-        "eigendecompose"
+        "EigenBasis",
+        "eigendecompose",
+        "load_eigenbasis",
+        "randomized_eigendecompose",
+        "write_eigenpairs"
     ]
 
 
@@ -109,7 +116,8 @@ class PythonMatrix:
 
 def eigendecompose(space, A_action, B_matrix=None, N_eigenvalues=None,
                    solver_type=None, problem_type=None, which=None,
-                   tolerance=1.0e-12, max_it=1000000, configure=None, monitor=None):
+                   tolerance=1.0e-12, max_it=1000000, configure=None, monitor=None,
+                   deflation_space=None):
     # First written 2018-03-01
     """
     Matrix-free interface with SLEPc via slepc4py, loosely following
@@ -138,6 +146,9 @@ def eigendecompose(space, A_action, B_matrix=None, N_eigenvalues=None,
                    for manual configuration.
     monitor        (Optional) Function handle accepting the EPS. Can be used
                    for monitoring/outputting intermediate EVs.
+    deflation_space (Optional) List of functions spanning a known invariant
+                   subspace (e.g. previously converged eigenvectors), which
+                   is deflated. N_eigenvalues further eigenpairs are sought.
 
     Returns:
 
@@ -181,6 +192,8 @@ def eigendecompose(space, A_action, B_matrix=None, N_eigenvalues=None,
     esolver.setTolerances(tol=tolerance, max_it=max_it)
     if configure is not None:
         configure(esolver)
+    if deflation_space is not None and len(deflation_space) > 0:
+        esolver.setDeflationSpace([d.vector().vec() for d in deflation_space])
     esolver.setUp()
 
     assert not _flagged_error[0]
@@ -199,6 +212,188 @@ def eigendecompose(space, A_action, B_matrix=None, N_eigenvalues=None,
     return esolver
 
 
+def _b_orthonormalize(Y, B_block, comm, rtol=1.0e-12, W=None, BW=None):
+    """
+    B-orthonormalize the columns of Y (local values), by SVQB (Stathopoulos &
+    Wu 2002) applied twice, dropping directions which are numerically
+    linearly dependent. If W (B-orthonormal) & BW are supplied, Y is first
+    B-orthogonalized against W in each pass. Returns Q, B Q.
+    """
+    for i in range(2):
+        if W is not None:
+            C = np.ascontiguousarray(BW.T @ Y)
+            comm.Allreduce(MPI.IN_PLACE, C, op=MPI.SUM)
+            Y = Y - W @ C
+        BY = B_block(Y)
+        G = np.ascontiguousarray(Y.T @ BY)
+        comm.Allreduce(MPI.IN_PLACE, G, op=MPI.SUM)
+        G = 0.5 * (G + G.T)
+
+        s, U = np.linalg.eigh(G)
+        keep = s > rtol * s.max()
+        S = U[:, keep] / np.sqrt(s[keep])
+        Y = Y @ S
+        BY = BY @ S
+
+    return Y, BY
+
+
+def randomized_eigendecompose(space, A_action, B_action, B_inv_action,
+                              N_eigenvalues, oversampling=10, power_iter=1,
+                              single_pass=False, seed=None, A_block=None,
+                              deflation=None):
+    """
+    Randomized generalized Hermitian eigendecomposition A w = lam B w, for
+    the leading eigenpairs of a symmetric low rank A & symmetric positive
+    definite B, following
+      A. K. Saibaba, J. Lee, P. K. Kitanidis, "Randomized algorithms for
+      generalized Hermitian eigenvalue problems with application to computing
+      Karhunen-Loeve expansion", Numerical Linear Algebra with Applications,
+      23, 2016, algorithms 5 (double pass) & 6 (single pass)
+
+    The range of B^{-1} A is sampled with a block of N_eigenvalues +
+    oversampling random vectors, and (power_iter - 1) further power
+    iterations. The A actions within each sweep are independent of each
+    other (unlike in a Krylov method).
+
+    Arguments:
+
+    space          Eigenvector space.
+    A_action       Callable accepting a function and returning a function or
+                   NumPy array, the action of the left-hand-side matrix (e.g.
+                   the Hessian).
+    B_action       As A_action, for the right-hand-side matrix (e.g. the
+                   prior).
+    B_inv_action   As A_action, for the inverse of the right-hand-side matrix.
+    N_eigenvalues  Number of eigenpairs to compute.
+    oversampling   Number of additional random vectors.
+    power_iter     Number of applications of B^{-1} A in the range finder.
+    single_pass    Whether to avoid the second sweep of A actions, at the
+                   cost of some accuracy.
+    seed           (Optional) Random seed.
+    A_block        (Optional) Callable accepting a block Y (n_owned_dofs x k)
+                   of local values & returning A Y, replacing column by
+                   column application of A_action (e.g. to distribute the
+                   columns over model replicas).
+    deflation      (Optional) Locally owned values (n_owned_dofs x m) of
+                   B-orthonormal eigenvectors which are already known. These
+                   are deflated, and N_eigenvalues further eigenpairs sought.
+
+    Returns:
+
+    lam, V, n_A
+    where lam are the eigenvalues, in descending order, V the locally owned
+    values of the B-orthonormal eigenvectors, (n_owned_dofs x N_eigenvalues),
+    and n_A the number of A actions.
+    """
+    comm = space_comm(space)
+    X = space_new(space)
+    n = function_local_size(X)
+    k = N_eigenvalues + oversampling
+    n_A = 0
+
+    def block_action(action, Y):
+        Z = np.empty_like(Y)
+        for j in range(Y.shape[1]):
+            function_set_values(X, Y[:, j])
+            z = action(X)
+            Z[:, j] = function_get_values(z) if is_function(z) else z
+        return Z
+
+    def B_block(Y):
+        return block_action(B_action, Y)
+
+    if A_block is None:
+        def A_block(Y):
+            return block_action(A_action, Y)
+
+    # As A W = B W Lambda, the sampled subspace decouples from W once
+    # B-orthogonalized against it
+    if deflation is not None and deflation.shape[1] > 0:
+        W, BW = deflation, B_block(deflation)
+    else:
+        W, BW = None, None
+
+    rng = np.random.default_rng(
+        np.random.SeedSequence(seed).spawn(comm.size)[comm.rank])
+    Omega = rng.standard_normal((n, k))
+
+    # Range finder: Q spans the range of (B^{-1} A)^power_iter Omega
+    for i in range(max(power_iter, 1)):
+        AOmega = A_block(Omega)
+        n_A += Omega.shape[1]
+        Q, BQ = _b_orthonormalize(block_action(B_inv_action, AOmega),
+                                  B_block, comm, W=W, BW=BW)
+        if i < power_iter - 1:
+            Omega = Q
+
+    if single_pass:
+        # Q^T A Omega = T Q^T B Omega
+        QAO = np.ascontiguousarray(Q.T @ AOmega)
+        QBO = np.ascontiguousarray(BQ.T @ Omega)
+        comm.Allreduce(MPI.IN_PLACE, QAO, op=MPI.SUM)
+        comm.Allreduce(MPI.IN_PLACE, QBO, op=MPI.SUM)
+        T = np.linalg.lstsq(QBO.T, QAO.T, rcond=None)[0].T
+    else:
+        AQ = A_block(Q)
+        n_A += Q.shape[1]
+        T = np.ascontiguousarray(Q.T @ AQ)
+        comm.Allreduce(MPI.IN_PLACE, T, op=MPI.SUM)
+    T = 0.5 * (T + T.T)
+
+    lam, U = np.linalg.eigh(T)
+    order = np.argsort(lam)[::-1][:N_eigenvalues]
+    lam, U = lam[order], U[:, order]
+
+    if lam.size < N_eigenvalues:
+        log.warning(f"Randomized eigendecomposition found only {lam.size} "
+                    f"of {N_eigenvalues} eigenpairs")
+
+    return lam, Q @ U, n_A
+
+
+def eigenpair_paths(params):
+    """The eigenvalue (pickle) & eigenvector (HDF5) files of run_eigendec"""
+    phase_suffix = params.eigendec.phase_suffix
+    lamfile = params.io.eigenvalue_file
+    vecfile = params.io.eigenvecs_file
+    if len(phase_suffix) > 0:
+        lamfile = params.io.run_name + phase_suffix + '_eigvals.p'
+        vecfile = params.io.run_name + phase_suffix + '_vr.h5'
+    outdir = Path(params.io.output_dir)/params.eigendec.phase_name/phase_suffix
+    return outdir/lamfile, outdir/vecfile
+
+
+def write_eigenpairs(params, space, lam, V):
+    """
+    Write eigenvalues & eigenvectors (locally owned values, n_owned_dofs x
+    n_eig) in the format written by slepc_monitor_callback. Returns the
+    eigenvectors as a list of functions.
+    """
+    lam_file, ev_filepath = eigenpair_paths(params)
+
+    vr = []
+    with HDF5File(space.mesh().mpi_comm(), str(ev_filepath), 'w') as ev_file:
+        for i in range(V.shape[1]):
+            V_r = space_new(space)
+            function_set_values(V_r, V[:, i])
+            V_r.rename("ev", "")
+            ev_file.write(V_r, 'v', i)
+            vr.append(V_r)
+
+    if space_comm(space).rank == 0:
+        with open(lam_file, "wb") as pfile:
+            pickle.dump([lam,
+                         params.eigendec.num_eig,
+                         params.eigendec.power_iter,
+                         params.eigendec.eig_algo,
+                         params.eigendec.misfit_only,
+                         params.io.output_dir,
+                         params.io.input_dir], pfile)
+
+    return vr
+
+
 def test_eigendecomposition(esolver, results, space, params):
     """Check the consistency of the eigendecomposition"""
 
@@ -257,13 +452,21 @@ def slepc_config_callback(prior_action, space, prior_pc):
     return inner_fn
 
 
-def slepc_monitor_callback(params, space, result_list):
+def slepc_monitor_callback(params, space, result_list, resume_basis=None):
     """
     Closure which defines the slepc monitor callback
 
     This allows keeping and modifying non-local variables, params etc
+
+    If resume_basis (an EigenBasis of previously converged eigenpairs, which
+    are deflated) is supplied, the output files are rewritten starting from
+    these, and the newly converged eigenpairs follow them.
+
+    The eigenvector file is held open (& flushed) between calls; call the
+    returned function's close() once the solve is complete.
     """
     nconv_prev = 0
+    n_prev = 0 if resume_basis is None else len(resume_basis)
 
     num_eig = params.eigendec.num_eig if params.eigendec.num_eig is not None \
         else function_global_size(space_new(space))
@@ -285,8 +488,6 @@ def slepc_monitor_callback(params, space, result_list):
     outdir = Path(params.io.output_dir)/params.eigendec.phase_name/params.eigendec.phase_suffix
     diagdir = Path(params.io.diagnostics_dir)/params.eigendec.phase_name/params.eigendec.phase_suffix
     ev_filepath = outdir / eigenvecs_file
-    # Delete files to avoid append
-    ev_filepath.unlink(missing_ok=True)
     p = diagdir / eigenvecs_file
     ev_xdmf_filepath = Path(p).parent / Path(p.stem + "_vis").with_suffix(".xdmf")
 
@@ -295,9 +496,27 @@ def slepc_monitor_callback(params, space, result_list):
     ev_xdmf_file.parameters["functions_share_mesh"] = True
     ev_xdmf_file.parameters["flush_output"] = True
 
-    # Open and close files to ensure they are clear for future appends
-    ev_file = HDF5File(space.mesh().mpi_comm(), str(ev_filepath), 'w')
-    ev_file.close()
+    comm = space.mesh().mpi_comm()
+    if n_prev == 0:
+        ev_file = HDF5File(comm, str(ev_filepath), 'w')
+    else:
+        # Rewrite the previous eigenvectors via a temporary file, so that
+        # they survive a failure here
+        tmp_filepath = ev_filepath.with_name(ev_filepath.name + ".tmp")
+        with HDF5File(comm, str(tmp_filepath), 'w') as tmp_file:
+            for i in range(n_prev):
+                V_r = space_new(space)
+                resume_basis.reconstruct(resume_basis.W[:, i], V_r)
+                V_r.rename("ev", "")
+                result_list["lam"][i] = resume_basis.lam[i]
+                result_list["vr"].append(V_r)
+                tmp_file.write(V_r, 'v', i)
+                ev_xdmf_file.write(V_r, i)
+        comm.barrier()
+        if comm.rank == 0:
+            tmp_filepath.replace(ev_filepath)
+        comm.barrier()
+        ev_file = HDF5File(comm, str(ev_filepath), 'a')
 
     eigenvalue_file = params.io.eigenvalue_file
     phase_suffix = params.eigendec.phase_suffix
@@ -317,20 +536,18 @@ def slepc_monitor_callback(params, space, result_list):
 
         A_matrix, _ = eps.getOperators()
 
-        ev_file = HDF5File(space.mesh().mpi_comm(), str(ev_filepath), 'a')
-
-        for i in range(nconv_prev, min(nconv, num_eig)):
+        for i in range(nconv_prev, min(nconv, num_eig - n_prev)):
             V_r = space_new(space)
             v_r = A_matrix.getVecRight()
             lam_i = eps.getEigenpair(i, v_r)
 
-            result_list["lam"][i] = lam_i.real
+            result_list["lam"][n_prev + i] = lam_i.real
             with v_r.getBuffer(readonly=True) as v_rr:
                 function_set_values(V_r, v_rr)
             V_r.rename("ev", "")
             result_list["vr"].append(V_r)
-            ev_file.write(V_r, 'v', i)
-            ev_xdmf_file.write(V_r, i)
+            ev_file.write(V_r, 'v', n_prev + i)
+            ev_xdmf_file.write(V_r, n_prev + i)
             # for v, name in zip((V_r.sub(0), V_r.sub(1)), ['va', 'vb']):
             #     # ev_xdmf_file.write_checkpoint(v, name, i, append=True)
             #     v.rename(name, '')
@@ -348,11 +565,10 @@ def slepc_monitor_callback(params, space, result_list):
                      params.io.input_dir], pfile)
         pfile.close()
 
-        ev_file.parameters.add("num_eig", nconv)
         # ev_file.parameters.add("eig_algo", eig_algo)
         # ev_file.parameters.add("timestamp", str(datetime.datetime.now()))
 
-        ev_file.close()
+        ev_file.flush()
         # ev_xdmf_file.close()
         nconv_prev = nconv
 
@@ -367,9 +583,69 @@ def slepc_monitor_callback(params, space, result_list):
 
         log.info("Done with monitor")
 
+    def close():
+        ev_file.close()
+
+    inner_fn.close = close
     return inner_fn
 
 
+def relaxed_rtol(tol, resid, rtol_min, rtol_max):
+    """
+    Relative tolerance for the linear solves within inexact Hessian actions,
+    for an eigensolver with (relative) residual resid & tolerance tol.
+
+    Following the relaxation strategy of Bouras & Fraysse (2005) & Simoncini
+    & Szyld (2003), the action error may grow inversely with the residual,
+    here bounded in [rtol_min, rtol_max], & rounded down to a power of ten
+    (to limit the number of distinct solver configurations).
+    """
+    rtol = tol / resid if resid > 0.0 else rtol_max
+    rtol = min(max(rtol, rtol_min), rtol_max)
+    return 10.0 ** np.floor(np.log10(rtol))
+
+
+def inexact_hessian_monitor(set_rtol, tol, rtol_min, rtol_max, N_eigenvalues):
+    """
+    Closure which defines a slepc monitor callback, relaxing the Hessian
+    action tolerance (via set_rtol) as the wanted eigenpairs converge
+    """
+    rtol_prev = None
+
+    def inner_fn(eps, its, nconv, eig, err):
+        nonlocal rtol_prev
+
+        pending = np.asarray(err[nconv:N_eigenvalues]).real
+        if pending.size == 0:
+            return
+        rtol = relaxed_rtol(tol, pending.max(), rtol_min, rtol_max)
+        if rtol != rtol_prev:
+            log.info(f"Hessian action rtol {rtol:.1e} at iteration {its}")
+            set_rtol(rtol)
+            rtol_prev = rtol
+
+    return inner_fn
+
+
+def eigenpair_residuals(A_action, B_action, vr, lam):
+    """
+    Relative residual norms |A v - lam B v| / |lam B v| of the eigenpairs
+    (as ev_resid, but from the actions, and with global norms)
+    """
+    resids = np.empty(len(vr), dtype=np.float64)
+    for i, (v, lam_i) in enumerate(zip(vr, lam)):
+        Av = A_action(v)
+        Bv = B_action(v)
+        Av = function_get_values(Av) if is_function(Av) else Av
+        Bv = function_get_values(Bv) if is_function(Bv) else Bv
+        norms_sq = np.array([np.sum((Av - lam_i * Bv) ** 2),
+                             np.sum((lam_i * Bv) ** 2)])
+        space_comm(v.function_space()).Allreduce(MPI.IN_PLACE, norms_sq,
+                                                 op=MPI.SUM)
+        resids[i] = np.sqrt(norms_sq[0] / norms_sq[1])
+    return resids
+
+
 def ev_resid(esolver, V_r, lam):
     """Given a function V_r, what is the residual norm, i.e. norm(A V_r - lambda B V_r)"""
     A, B = esolver.getOperators()
@@ -385,3 +661,142 @@ def ev_resid(esolver, V_r, lam):
     resid_norm = np.linalg.norm(resid)
 
     return resid_norm
+
+
+class EigenBasis:
+    """
+    Eigenvalues 'lam' & prior-orthonormal eigenvectors of the GHEP, with the
+    locally owned part of the eigenvectors held in one dense block 'W'
+    (n_owned_dofs x n_eig).
+
+    Projections (W^T x) need a single Allreduce, and reconstructions (W c) are
+    purely local.
+    """
+    def __init__(self, space, lam, W):
+        assert W.shape == (function_local_size(space_new(space)), lam.size)
+        self.space = space
+        self.lam = lam
+        self.W = W
+        self.comm = space_comm(space)
+
+    def __len__(self):
+        return self.lam.size
+
+    @staticmethod
+    def _local_values(x):
+        if is_function(x):
+            return function_get_values(x)
+        elif isinstance(x, np.ndarray):
+            return x
+        else:  # a (dolfin) vector
+            return x.get_local()
+
+    def project(self, x):
+        """
+        W^T x, for x a Function, vector, or local block (n_owned_dofs x k)
+        """
+        c = np.ascontiguousarray(self.W.T @ self._local_values(x))
+        self.comm.Allreduce(MPI.IN_PLACE, c, op=MPI.SUM)
+        return c
+
+    def reconstruct(self, c, x=None):
+        """
+        W c (local values), for c of length n_eig or shape (n_eig x k). If x
+        (a Function) is supplied, its values are set.
+        """
+        y = self.W @ c
+        if x is not None:
+            function_set_values(x, y)
+        return y
+
+    def prior_norms_sq(self, reg_op):
+        """Squared norms of the eigenvectors in the prior inner product"""
+        BW = reg_op.action_block(np.ascontiguousarray(self.W))
+        norms_sq = np.sum(self.W * BW, axis=0)
+        self.comm.Allreduce(MPI.IN_PLACE, norms_sq, op=MPI.SUM)
+        return norms_sq
+
+    def check_prior_norms(self, reg_op, tol):
+        """Check the eigenvectors have unit norm in the prior inner product"""
+        norms_sq = self.prior_norms_sq(reg_op)
+        bad = np.flatnonzero(abs(norms_sq - 1.0) >= tol)
+        if bad.size > 0:
+            raise RuntimeError(f"Eigenvector(s) {bad} not normalised in prior "
+                               f"(squared norms {norms_sq[bad]})")
+
+
+# The most recently loaded eigenbasis, reused by later phases in the same
+# process (one entry only, as W may be large)
+_eigenbasis_cache = [None, None]
+
+
+def _eigenbasis_key(space, paths, num_eig, allow_nan, threshold):
+    """
+    Key identifying the eigenpair files & the (locally owned part of the)
+    space, so that a cached basis is reused only if the files are unchanged &
+    the space identically partitioned
+    """
+    own_start, own_end = space.dofmap().ownership_range()
+    coords = space.tabulate_dof_coordinates()[:own_end - own_start, :]
+    return (tuple((str(path), path.stat().st_mtime_ns) for path in paths),
+            num_eig, allow_nan, threshold, str(space.ufl_element()),
+            own_start, own_end,
+            hashlib.sha1(np.ascontiguousarray(coords).tobytes()).hexdigest())
+
+
+def load_eigenbasis(params, space, reg_op=None, num_eig=None,
+                    allow_nan=False, threshold=None):
+    """
+    Load the eigenvalues & eigenvectors written by run_eigendec
+
+    The basis is cached, so that a later call for the same files & an
+    identically partitioned space (e.g. from a later phase in the same
+    process) does not read them again.
+
+    Arguments:
+      reg_op    : the prior, used to check the eigenvectors' norms if
+                  eigendec.check_norms is set
+      num_eig   : only load the leading num_eig eigenpairs (if > 0)
+      allow_nan : truncate at the first NaN eigenvalue (i.e. not converged),
+                  rather than raising an error
+      threshold : only keep eigenvalues greater than this
+    """
+    lam_path, vec_path = eigenpair_paths(params)
+
+    key = _eigenbasis_key(space, (lam_path, vec_path), num_eig, allow_nan,
+                          threshold)
+    comm = space_comm(space)
+    if comm.allreduce(_eigenbasis_cache[0] == key, op=MPI.LAND):
+        cached = _eigenbasis_cache[1]
+        log.info(f"Reusing {len(cached)} eigenpairs from {vec_path}")
+        return EigenBasis(space, cached.lam, cached.W)
+
+    with open(lam_path, 'rb') as ff:
+        eigendata = pickle.load(ff)
+        lam = eigendata[0].real.astype(np.float64)
+
+    # Check if eigendecomposition successfully produced num_eig
+    # or if some are NaN
+    if np.any(np.isnan(lam)):
+        if not allow_nan:
+            raise RuntimeError("NaN eigenvalue(s)")
+        lam = lam[:np.argwhere(np.isnan(lam))[0][0]]
+
+    if num_eig is not None and num_eig > 0:
+        lam = lam[:num_eig]
+
+    indices = np.arange(lam.size)
+    if threshold is not None:
+        indices = np.flatnonzero(lam > threshold)
+        lam = lam[indices]
+
+    W = inout.read_function_block(space, vec_path, "v", indices)
+    basis = EigenBasis(space, lam, W)
+
+    if reg_op is not None and params.eigendec.check_norms:
+        basis.check_prior_norms(reg_op, params.constants.float_eps)
+
+    _eigenbasis_cache[:] = [key, basis]
+
+    log.info(f"Loaded {len(basis)} eigenpairs from {vec_path}")
+    return basis
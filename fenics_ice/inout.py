@@ -39,9 +39,17 @@ from abc import ABC, abstractmethod
 
 import numpy as np
 
+log = logging.getLogger("fenics_ice")
+
 # Regex for catching unnamed vars
 unnamed_re = re.compile("f_[0-9]+")
 
+# XDMFFile parameters for a time-series of several functions on one mesh:
+# the mesh is written once, & each step appends only the function values
+timeseries_parameters = {"functions_share_mesh": True,
+                         "rewrite_function_mesh": False,
+                         "flush_output": False}
+
 class Writer(ABC):
     """Abstract base class for variable writers"""
 
@@ -169,6 +177,11 @@ class XDMFWriter(Writer):
     suffix = '.xdmf'
     # stepped = True  # XDMF file components always have a timestep associated
 
+    def __init__(self, fpath, comm=MPI.COMM_WORLD, parameters=None):
+        super().__init__(fpath, comm=comm)
+        # XDMFFile parameters, e.g. rewrite_function_mesh
+        self.parameters = {} if parameters is None else dict(parameters)
+
     def _write(self, variable, step):
         if step is None:
             self.file_handle.write(variable, 0)
@@ -178,6 +191,8 @@ class XDMFWriter(Writer):
     def open(self):
         """Open XDMFFile (w/ comm)"""
         self.file_handle = XDMFFile(self.comm, str(self._fpath))
+        for key, value in self.parameters.items():
+            self.file_handle.parameters[key] = value
 
     def close(self):
         """Close XDMFFile"""
@@ -206,9 +221,10 @@ def gen_path(params, name, suffix, phase_suffix=''):
     return outdir/outfname
 
 
-def write_qval(Qval, params):
+def write_qval(Qval, params, ts=None):
     """
-    Produces pickle dump with QOI value through time
+    Produces pickle dump with QOI value through time (at times ts, default
+    the fixed timesteps)
     """
 
     outdir = params.io.output_dir
@@ -219,34 +235,40 @@ def write_qval(Qval, params):
     if len(phase_suffix) > 0:
         filename = params.io.run_name + phase_suffix + '_Qval_ts.p'
 
-    run_length = params.time.run_length
-    n_steps = params.time.total_steps
-    ts = np.linspace(0, run_length, n_steps+1)
+    if ts is None:
+        run_length = params.time.run_length
+        n_steps = params.time.total_steps
+        ts = np.linspace(0, run_length, n_steps+1)
 
     outdir_final = Path(outdir)/phase_name/phase_suffix
 
     with open(outdir_final/filename, 'wb') as pickle_file:
         pickle.dump([Qval, ts], pickle_file)
 
+def dqval_path(params):
+    """Path of the .h5 file of dQoi_dCntrl written by write_dqval"""
+    h5_filename = params.io.dqoi_h5file
+    phase_suffix = params.time.phase_suffix
+
+    if len(phase_suffix) > 0:
+        h5_filename = params.io.run_name + phase_suffix + '_dQ_ts.h5'
+
+    return Path(params.io.output_dir)/params.time.phase_name/phase_suffix/h5_filename
+
 def write_dqval(dQ_ts, cntrl_names, params):
     """
     Produces .pvd & .h5 files with dQoi_dCntrl
     """
 
-    outdir = params.io.output_dir
     diagdir = params.io.diagnostics_dir
     phase_name = params.time.phase_name
-    h5_filename = params.io.dqoi_h5file
     phase_suffix = params.time.phase_suffix
 
-    if len(phase_suffix) > 0:
-        h5_filename = params.io.run_name + phase_suffix + '_dQ_ts.h5'
-
+    h5_path = dqval_path(params)
     diagdir_f = Path(diagdir)/phase_name/phase_suffix
-    outdir_f = Path(outdir)/phase_name/phase_suffix
     # TODO add this file to diags once Dan makes his pull request
-    vtkfile = File(str((diagdir_f/h5_filename).with_suffix(".pvd")))
-    hdf5out = HDF5File(MPI.COMM_WORLD, str(outdir_f/h5_filename), 'w')
+    vtkfile = File(str((diagdir_f/h5_path.name).with_suffix(".pvd")))
+    hdf5out = HDF5File(MPI.COMM_WORLD, str(h5_path), 'w')
     n = 0.0
 
     # Loop dQ sample times ('num_sens')
@@ -266,6 +288,62 @@ def write_dqval(dQ_ts, cntrl_names, params):
 
     hdf5out.close()
 
+def read_function_block(space, filename, group, indices):
+    """
+    Read a series of functions written by HDF5File.write(u, group, step) into a
+    single dense (n_owned_dofs x len(indices)) array, column k holding
+    group/vector_{indices[k]}.
+
+    The map from the stored (global) dof ordering to the local dofs is computed
+    once, from the global cell indices & cell dofs saved alongside the vectors,
+    so the functions need not have been written with the same partitioning.
+    Each process then reads only the contiguous range of each vector which
+    contains its dofs.
+    """
+    mesh = space.mesh()
+    dofmap = space.dofmap()
+    tdim = mesh.topology().dim()
+    own_start, own_end = dofmap.ownership_range()
+    n_owned = own_end - own_start
+
+    with h5py.File(filename, "r") as h5:
+        file_cells = h5[f"{group}/cells"][:]
+        x_cell_dofs = h5[f"{group}/x_cell_dofs"][:]
+        file_cell_dofs = h5[f"{group}/cell_dofs"][:]
+
+        # Local cell dofs & the stored cell dofs for the same (global) cells
+        n_cells = mesh.num_cells()
+        cell_dofs = np.array([dofmap.cell_dofs(c) for c in range(n_cells)],
+                             dtype=np.int64).reshape((n_cells, -1))
+        n_cd = cell_dofs.shape[1]
+        assert np.all(np.diff(x_cell_dofs) == n_cd)
+        file_cell_dofs = file_cell_dofs.reshape((-1, n_cd))
+
+        global_cells = np.asarray(mesh.topology().global_indices(tdim))[:n_cells]
+        order = np.argsort(file_cells)
+        rows = order[np.searchsorted(file_cells, global_cells, sorter=order)]
+        assert np.all(file_cells[rows] == global_cells)
+
+        # Stored index of each owned local dof
+        owned = cell_dofs < n_owned
+        file_index = np.full(n_owned, -1, dtype=np.int64)
+        file_index[cell_dofs[owned]] = file_cell_dofs[rows][owned]
+        assert np.all(file_index >= 0)
+
+        lo = file_index.min() if n_owned > 0 else 0
+        hi = file_index.max() + 1 if n_owned > 0 else 0
+
+        block = np.empty((n_owned, len(indices)), dtype=np.float64)
+        for k, i in enumerate(indices):
+            block[:, k] = h5[f"{group}/vector_{i}"][lo:hi][file_index - lo]
+
+    return block
+
+def timeseries_path(params, name, outdir, phase_name='', phase_suffix=''):
+    """Path of the time-series XDMF file for name (prefixed with run name)"""
+    return (Path(outdir) / phase_name / phase_suffix
+            / "_".join((params.io.run_name + phase_suffix, name))).with_suffix(".xdmf")
+
 def write_variable(var, params, name=None, outdir=None, phase_name='', phase_suffix=''):
     """
     Produce xml & vtk output of supplied variable (prefixed with run name)
@@ -297,27 +375,60 @@ def write_variable(var, params, name=None, outdir=None, phase_name='', phase_suf
 
     # Write out output according to user specified format in toml
     output_var_format = params.io.output_var_format
+    comm = outvar.function_space().mesh().mpi_comm()
     if 'pvd' in output_var_format:
         vtk_fname = str(outfname.with_suffix(".pvd"))
-        File(vtk_fname) << outvar
+        File(comm, vtk_fname) << outvar
     if 'xml' in output_var_format:
         xml_fname = str(outfname.with_suffix(".xml"))
-        File(xml_fname) << outvar
+        File(comm, xml_fname) << outvar
     if 'h5' in output_var_format:
-        hdf5out = HDF5File(MPI.COMM_WORLD, str(outfname.with_suffix(".h5")), 'w')
+        hdf5out = HDF5File(comm, str(outfname.with_suffix(".h5")), 'w')
         hdf5out.write(outvar, name)
         hdf5out.close()
     if 'all' in output_var_format:
         vtk_fname = str(outfname.with_suffix(".pvd"))
         xml_fname = str(outfname.with_suffix(".xml"))
-        File(vtk_fname) << outvar
-        File(xml_fname) << outvar
-        hdf5out = HDF5File(MPI.COMM_WORLD, str(outfname.with_suffix(".h5")), 'w')
+        File(comm, vtk_fname) << outvar
+        File(comm, xml_fname) << outvar
+        hdf5out = HDF5File(comm, str(outfname.with_suffix(".h5")), 'w')
         hdf5out.write(outvar, name)
         hdf5out.close()
 
     logging.info("Writing function %s to file %s" % (name, outfname))
 
+def obs_cache_path(params, kind, key, comm):
+    """
+    Path of this process's cache file of 'kind' (e.g. point ownership, or
+    the observation operators) for hash 'key'
+    """
+    cache_dir = Path(params.io.output_dir) / "obs_cache"
+    return cache_dir / f"{params.io.run_name}_{kind}_{key}_{comm.rank}of{comm.size}.npz"
+
+def read_obs_cache(path, comm):
+    """
+    Read the arrays in a cache file written by write_obs_cache. Returns None
+    unless the cache is present for every process.
+    """
+    path = Path(path)
+    if not comm.allreduce(path.exists(), op=MPI.LAND):
+        return None
+
+    log = logging.getLogger("fenics_ice")
+    log.info(f"Reading observation cache {path}")
+    with np.load(path) as data:
+        return {name: data[name] for name in data.files}
+
+def write_obs_cache(path, **arrays):
+    """Write arrays to a cache file (via a temporary file, then renamed)"""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Unique per process, as replicated models may share cache files
+    tmp_path = path.with_name(path.name + f".{MPI.COMM_WORLD.rank}.tmp")
+    with open(tmp_path, "wb") as f:
+        np.savez(f, **arrays)
+    tmp_path.replace(path)
+
 def dict_to_csv(indict, name, params):
     """Write dictionary to CSV file"""
     phase_suffix = params.inversion.phase_suffix
@@ -765,6 +876,17 @@ def configure_tlm_checkpointing(params):
 
     configure_checkpointing(method, config_dict)
 
+def write_adjoint_sweeps(sweep_times, params):
+    """Write out the number of QoI gradients & wall time of each adjoint sweep"""
+    phase_name = params.time.phase_name
+    phase_suffix = params.time.phase_suffix
+    outfname = Path(params.io.diagnostics_dir) / phase_name / phase_suffix / \
+        "_".join((params.io.run_name + phase_suffix, "adjoint_sweeps.csv"))
+
+    if MPI.COMM_WORLD.rank == 0:
+        np.savetxt(outfname, np.array(sweep_times, dtype=np.float64).reshape((-1, 2)),
+                   delimiter=",", header="num_qoi, wall_time")
+
 def write_inversion_info(params, conv_info, header="J, F_crit, G_crit_alpha, G_crit_beta"):
 
     phase_name = params.inversion.phase_name
@@ -20,7 +20,7 @@ Module to handle all things mesh to avoid code repetition in run scripts.
 """
 
 from .backend import FunctionSpace, Mesh, MeshFunction, MeshValueCollection, \
-    VectorFunctionSpace, XDMFFile, parameters
+    Point, VectorFunctionSpace, XDMFFile, parameters
 
 from . import model
 
@@ -30,9 +30,9 @@ import numpy as np
 from pathlib import Path
 import logging
 
-def get_mesh(params):
+def get_mesh(params, comm=MPI.COMM_WORLD):
     """
-    Gets mesh from file
+    Gets mesh from file, distributed over comm
     """
 
     dd = params.io.input_dir
@@ -47,11 +47,11 @@ def get_mesh(params):
     assert meshfile.exists(), "Mesh file '%s' not found" % meshfile
 
     if filetype == '.xml':
-        mesh_in = Mesh(str(meshfile))
+        mesh_in = Mesh(comm, str(meshfile))
 
     elif filetype == '.xdmf':
-        mesh_in = Mesh()
-        mesh_xdmf = XDMFFile(MPI.COMM_WORLD, str(meshfile))
+        mesh_in = Mesh(comm)
+        mesh_xdmf = XDMFFile(comm, str(meshfile))
         mesh_xdmf.read(mesh_in)
 
     else:
@@ -80,6 +80,83 @@ def get_mesh_length(mesh):
 
     return L1
 
+def locate_points(x_coords, mesh, batch_size=50000, k=16, tol=1.0e-10):
+    """
+    Find a local cell containing each point in x_coords (n_points x gdim).
+
+    Returns an array of local cell indices (-1 where no local cell, including
+    ghosts, contains the point). Points are processed in batches: a bounding
+    box prefilter, then a vectorized barycentric test against the k cells with
+    the nearest midpoints. Only points whose containing cell cannot be decided
+    (i.e. within 'tol' of a cell boundary) fall back to the BoundingBoxTree.
+    """
+    from scipy.spatial import cKDTree
+
+    n_points = x_coords.shape[0]
+    located = np.full(n_points, -1, dtype=np.int64)
+    n_cells = mesh.num_cells()
+    if n_points == 0 or n_cells == 0:
+        return located
+
+    bbox = mesh.bounding_box_tree()
+
+    def collide(i):
+        cell = bbox.compute_first_entity_collision(Point(*x_coords[i, :]))
+        return cell if cell < n_cells else -1
+
+    if mesh.ufl_cell().cellname() != "triangle" or mesh.geometry().dim() != 2:
+        for i in range(n_points):
+            located[i] = collide(i)
+        return located
+
+    coords = mesh.coordinates()
+    cells = mesh.cells()
+
+    # Affine map of each triangle, for barycentric coordinates
+    v0 = coords[cells[:, 0]]
+    T_inv = np.linalg.inv(np.stack([coords[cells[:, 1]] - v0,
+                                    coords[cells[:, 2]] - v0], axis=2))
+
+    # Any point in a cell is within 'radius' of its midpoint
+    midpoints = coords[cells].mean(axis=1)
+    radius = np.max(np.linalg.norm(coords[cells] - midpoints[:, None, :], axis=2))
+    radius *= 1.0 + 1.0e-8
+    tree = cKDTree(midpoints)
+    k = min(k, n_cells)
+
+    lower = coords.min(axis=0) - 1.0e-8 * radius
+    upper = coords.max(axis=0) + 1.0e-8 * radius
+
+    for start in range(0, n_points, batch_size):
+        pts = x_coords[start:start + batch_size, :]
+        idx = np.flatnonzero(np.all((pts >= lower) & (pts <= upper), axis=1))
+        if idx.size == 0:
+            continue
+
+        _, cand = tree.query(pts[idx], k=k, distance_upper_bound=radius)
+        cand = cand.reshape((idx.size, k))
+        valid = cand < n_cells
+        cand = np.where(valid, cand, 0)
+
+        lam = np.einsum("pkij,pkj->pki",
+                        T_inv[cand], pts[idx][:, None, :] - v0[cand])
+        lam_min = np.minimum(1.0 - lam.sum(axis=2), lam.min(axis=2))
+        lam_min[~valid] = -np.inf
+
+        # Strictly inside a candidate cell
+        inside = lam_min > tol
+        found = inside.any(axis=1)
+        first = np.argmax(inside, axis=1)
+        located[start + idx[found]] = cand[found, first[found]]
+
+        # Clearly outside every cell within range (all of which were tested)
+        outside = ~valid[:, -1] & np.all(lam_min < -tol, axis=1)
+
+        for i in start + idx[~found & ~outside]:
+            located[i] = collide(i)
+
+    return located
+
 def get_periodic_space(params, mesh, deg=1, dim=1):
     """
     Return a Lagrange FunctionSpace w/ periodic boundary
@@ -129,7 +206,7 @@ def get_ff_from_file(params, model, fill_val=0):
 
     # Read the MeshValueCollection (sparse)
     ff_mvc = MeshValueCollection("size_t", model.mesh, dim=dim-1)
-    ff_xdmf = XDMFFile(MPI.COMM_WORLD, str(ff_file))
+    ff_xdmf = XDMFFile(model.mesh.mpi_comm(), str(ff_file))
     ff_xdmf.read(ff_mvc)
 
     # Create FacetFunction filled w/ default
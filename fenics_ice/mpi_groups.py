@@ -0,0 +1,71 @@
+# For fenics_ice copyright information see ACKNOWLEDGEMENTS in the fenics_ice
+# root directory
+
+# This file is part of fenics_ice.
+#
+# fenics_ice is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# fenics_ice is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with fenics_ice.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Splitting the processes into groups, each holding its own copy of the mesh
+(e.g. sample groups, or eigendecomposition replicas)
+"""
+
+import mpi4py.MPI as MPI  # noqa: N817
+import numpy as np
+
+__all__ = \
+    [
+        "split_groups",
+        "check_group_alignment"
+    ]
+
+
+def split_groups(comm, n_groups):
+    """
+    Split comm into n_groups equally sized groups, each of which holds its
+    own copy of the mesh.
+
+    Returns (group, group_comm, cross_comm), where cross_comm connects the
+    processes with the same rank in every group (for combining results).
+    """
+    if comm.size % n_groups != 0:
+        raise ValueError(f"Cannot split {comm.size} processes into "
+                         f"{n_groups} equally sized groups")
+
+    group_size = comm.size // n_groups
+    group = comm.rank // group_size
+    group_comm = comm.Split(color=group, key=comm.rank)
+    cross_comm = comm.Split(color=group_comm.rank, key=group)
+    return group, group_comm, cross_comm
+
+
+def check_group_alignment(space, cross_comm):
+    """
+    Check that the locally owned dofs of 'space' are the same (in number,
+    order & position) on every process in cross_comm, i.e. that each group
+    has partitioned the mesh identically, so that pointwise results can be
+    combined directly.
+    """
+    own_start, own_end = space.dofmap().ownership_range()
+    coords = space.tabulate_dof_coordinates()
+    coords = np.ascontiguousarray(coords[:own_end - own_start, :])
+
+    sizes = cross_comm.allgather(coords.shape[0])
+    aligned = all(size == sizes[0] for size in sizes)
+    if aligned:
+        coords_0 = coords.copy()
+        cross_comm.Bcast(coords_0, root=0)
+        aligned = np.allclose(coords, coords_0, rtol=0.0, atol=1.0e-10)
+
+    if not cross_comm.allreduce(aligned, op=MPI.LAND):
+        raise RuntimeError("Process groups have different mesh partitions")
@@ -0,0 +1,173 @@
+# For fenics_ice copyright information see ACKNOWLEDGEMENTS in the fenics_ice
+# root directory
+
+# This file is part of fenics_ice.
+#
+# fenics_ice is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# fenics_ice is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with fenics_ice.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+The low rank approximation to the posterior covariance, shared by the
+uncertainty quantification phases
+"""
+
+import logging
+import mpi4py.MPI as MPI  # noqa: N817
+import numpy as np
+import scipy.sparse as sp
+
+log = logging.getLogger("fenics_ice")
+
+__all__ = \
+    [
+        "PosteriorCovariance"
+    ]
+
+
+class PosteriorCovariance:
+    """
+    Low rank approximation to the posterior covariance (Isaac et al. 2015,
+    eq. 20)
+
+      Gamma_post = Gamma_prior - W D W^T,  D = diag(lam / (lam + 1))
+
+    where Gamma_prior is the inverse of the Prior operator, & (lam, W) the
+    prior-orthonormal eigenpairs of the prior preconditioned misfit Hessian
+    (an EigenBasis).
+
+    Methods act on dense blocks (n_owned_dofs x k) of local values, with one
+    column per vector, or on a single Function, vector, or array of local
+    values (returning a 1D array).
+
+    Arguments:
+      reg_op  The Prior.
+      basis   The EigenBasis (e.g. from load_eigenbasis).
+    """
+    def __init__(self, reg_op, basis):
+        self.reg_op = reg_op
+        self.basis = basis
+        self.comm = basis.comm
+        self.n = basis.W.shape[0]
+
+        lam = basis.lam
+        self.D = lam / (lam + 1.0)  # D_r Isaac 20
+        # Gamma_post^{1/2} = Gamma_prior^{1/2} (I + W D_sqrt W^T Gamma^{-1/2})
+        self.D_sqrt = 1.0 / np.sqrt(lam + 1.0) - 1.0
+
+    def __len__(self):
+        return len(self.basis)
+
+    def _block(self, X):
+        """X as a 2D block of local values, & whether it was a single vector"""
+        X = self.basis._local_values(X)
+        if X.ndim == 1:
+            return X[:, None], True
+        return X, False
+
+    def apply(self, X):
+        """Gamma_post X"""
+        X, single = self._block(X)
+        Y = self.reg_op.inv_action_block(np.ascontiguousarray(X))
+        Y -= self.basis.reconstruct(self.D[:, None] * self.basis.project(X))
+        return Y[:, 0] if single else Y
+
+    def _sqrt_actions(self, X):
+        """Gamma_prior^{1/2} X & Gamma_post^{1/2} X"""
+        # The mass matrix root is common to both square roots
+        S = self.reg_op.sqrt_mass_action_block(X)
+        Z = self.reg_op.sqrt_inv_action_block(X, sqrt_mass=S)  # Gamma^{1/2} X
+        Y = self.reg_op.sqrt_action_block(X, sqrt_mass=S)  # Gamma^{-1/2} X
+
+        # Z + W D_sqrt W^T Y
+        C = self.basis.project(Y)
+        C *= self.D_sqrt[:, None]
+        A = self.basis.reconstruct(C)
+        A += Z
+        return Z, A
+
+    def apply_sqrt(self, X):
+        """
+        Gamma_post^{1/2} X, for a factor satisfying Gamma_post =
+        Gamma_post^{1/2} Gamma_post^{T/2} (so that X ~ N(0, I) gives
+        posterior samples)
+        """
+        X, single = self._block(X)
+        _, A = self._sqrt_actions(np.ascontiguousarray(X))
+        return A[:, 0] if single else A
+
+    def sample(self, k, rng):
+        """
+        Draw k (zero mean) samples, given a numpy Generator (see
+        sampling.sample_rng). Returns (prior, posterior) sample blocks, both
+        from the same white noise.
+        """
+        X = rng.standard_normal((self.n, k))
+        return self._sqrt_actions(X)
+
+    def variance_reductions(self, G):
+        """
+        Per eigenpair reductions D_i (w_i^T g)^2 in the variance of the linear
+        functionals g, as an (n_eig x k) array
+        """
+        if sp.issparse(G):
+            WG = np.ascontiguousarray((G.T @ self.basis.W).T)
+            self.comm.Allreduce(MPI.IN_PLACE, WG, op=MPI.SUM)
+        else:
+            G, single = self._block(G)
+            WG = self.basis.project(G)
+            if single:
+                WG = WG[:, 0]
+        return (self.D * WG.T ** 2).T
+
+    def variance_of_functional(self, G, prior_variance=None):
+        """
+        Posterior & prior variances (g^T Gamma g) of the linear functionals g,
+        the columns of G (dual vectors, e.g. the derivative of a QoI, in a
+        dense or scipy.sparse block). prior_variance optionally supplies the
+        prior variances, if known (e.g. estimated by sampling).
+
+        Returns (var_post, var_prior), each of length k.
+        """
+        if prior_variance is None:
+            if sp.issparse(G):
+                G_dense = G.toarray()
+            else:
+                G_dense, _ = self._block(G)
+            Y = self.reg_op.inv_action_block(np.ascontiguousarray(G_dense))
+            prior_variance = np.sum(Y * G_dense, axis=0)
+            self.comm.Allreduce(MPI.IN_PLACE, prior_variance, op=MPI.SUM)
+            if not sp.issparse(G) and self.basis._local_values(G).ndim == 1:
+                prior_variance = prior_variance[0]
+
+        reductions = self.variance_reductions(G)
+        return prior_variance - np.sum(reductions, axis=0), prior_variance
+
+    def pointwise_variance_estimate(self, n_samples, rng, block_size=16):
+        """
+        Estimate the pointwise (diagonal) variances of the posterior & prior.
+
+        diag(W D W^T) is computed exactly (& locally), so only the prior
+        variance is estimated, from n_samples samples Gamma_prior^{1/2} N,
+        which has lower variance than estimating from posterior samples.
+
+        Returns (var_post, var_prior) as local values.
+        """
+        var_prior = np.zeros(self.n, dtype=np.float64)
+        for i0 in range(0, n_samples, block_size):
+            k = min(block_size, n_samples - i0)
+            Z = self.reg_op.sqrt_inv_action_block(
+                rng.standard_normal((self.n, k)))
+            var_prior += np.sum(Z * Z, axis=1)
+        var_prior /= n_samples
+
+        var_post = var_prior - np.sum(self.basis.W ** 2 * self.D, axis=1)
+        return var_post, var_prior
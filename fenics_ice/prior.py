@@ -15,8 +15,9 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with fenics_ice.  If not, see <https://www.gnu.org/licenses/>.
 
-from .backend import Constant, Function, KrylovSolver, TestFunctions, \
-    TrialFunctions, Vector, assemble, dx, grad, inner, solve
+from .backend import Constant, EquationSolver, Function, KrylovSolver, \
+    PETScLUSolver, TestFunctions, TrialFunctions, Vector, assemble, dx, grad, \
+    inner
 
 from .decorators import count_calls, timer
 from .eigendecomposition import flag_errors
@@ -24,8 +25,45 @@ from fenics_ice.sqrt_matrix_action import A_root_action, LumpedPCSqrtMassAction
 
 
 from abc import ABC, abstractmethod
+import numpy as np
 import ufl
 
+
+def operator_solver(A, method, params):
+    """
+    A linear solver for the (symmetric positive definite) operator A
+
+    'lu' & 'cholesky' factorize A once, on the first solve, & reuse the
+    factors for all subsequent solves. 'cholesky' uses factor_package, or
+    mumps if none is set, as PETSc's own Cholesky is serial only. 'cg' &
+    'amg' are conjugate gradient with SOR & algebraic multigrid
+    preconditioning respectively.
+    """
+    if method == "lu":
+        if params.factor_package is None:
+            solver = PETScLUSolver(A.mpi_comm())
+        else:
+            solver = PETScLUSolver(A.mpi_comm(), params.factor_package)
+        solver.set_operator(A)
+
+    elif method == "cholesky":
+        # Changing the PC type resets the factor package, so set it after
+        solver = PETScLUSolver(A.mpi_comm())
+        pc = solver.ksp().getPC()
+        pc.setType("cholesky")
+        pc.setFactorSolverType(params.factor_package or "mumps")
+        solver.set_operator(A)
+
+    else:
+        pc = {"cg": "sor", "amg": "hypre_amg"}[method]
+        solver = KrylovSolver("cg", pc)
+        solver.parameters.update({"absolute_tolerance": params.atol,
+                                  "relative_tolerance": params.rtol})
+        solver.set_operator(A)
+
+    return solver
+
+
 class Prior(ABC):
     """Abstraction for prior used by both comp_J_inv and run_eigendec.py"""
 
@@ -86,8 +124,57 @@ class Prior(ABC):
         self.A.init_vector(self.tmp1, 0)
         self.A.init_vector(self.tmp2, 1)
 
+        # Mass form for the (annotated) J_reg solves. Never used in mixed
+        # space mode, so no need to mess with alpha_idx, beta_idx
+        self.reg_mass_form = self.test[0] * self.trial[0] * dx
+
         # preconditioned solver object to find square root of mass matrix (not used)
-        self.lumpedPCMassSolver = LumpedPCSqrtMassAction(space=self.space, tol=1.0e-16, beta=2.0/3.0)
+        self.lumpedPCMassSolver = LumpedPCSqrtMassAction(
+            space=self.space, tol=1.0e-16, beta=2.0/3.0, M=self.M,
+            method=self.solver.params.prior.sqrt_method)
+
+    def inv_action_block(self, X, Y=None):
+        """
+        The inverse action of the prior on each column of a dense block X
+        (n_owned_dofs x k) of local values, returned in Y.
+
+        The operators & their solvers are constructed once, so each
+        right-hand side reuses the same (already set up) preconditioners.
+        """
+        if Y is None:
+            Y = np.empty_like(X)
+        assert X.shape == Y.shape
+
+        x, y = Vector(), Vector()
+        self.A.init_vector(x, 1)
+        self.A.init_vector(y, 0)
+        for k in range(X.shape[1]):
+            x.set_local(X[:, k])
+            x.apply("insert")
+            self.inv_action(x, y)
+            Y[:, k] = y.get_local()
+
+        return Y
+
+    def action_block(self, X, Y=None):
+        """
+        The action of the prior on each column of a dense block X
+        (n_owned_dofs x k) of local values, returned in Y.
+        """
+        if Y is None:
+            Y = np.empty_like(X)
+        assert X.shape == Y.shape
+
+        x, y = Vector(), Vector()
+        self.A.init_vector(x, 1)
+        self.A.init_vector(y, 0)
+        for k in range(X.shape[1]):
+            x.set_local(X[:, k])
+            x.apply("insert")
+            self.action(x, y)
+            Y[:, k] = y.get_local()
+
+        return Y
 
     def placeholder_fn(self, name, idx):
         """
@@ -109,10 +196,9 @@ class Prior(ABC):
         """Construct the mass operator self.M and its solver self.M_solver"""
         self.M = assemble(sum(self.var_m) * dx)
 
-        self.M_solver = KrylovSolver("cg", "sor")
-        self.M_solver.parameters.update({"absolute_tolerance": 1.0e-32,
-                                         "relative_tolerance": 1.0e-14})
-        self.M_solver.set_operator(self.M)
+        prior_params = self.solver.params.prior
+        self.M_solver = operator_solver(self.M, prior_params.M_solver,
+                                        prior_params)
 
     def construct_prior_operator(self):
         """
@@ -139,15 +225,27 @@ class Prior(ABC):
                 self.A_form = beta_form
 
         self.A = assemble(self.A_form)
-        self.A_solver = KrylovSolver("cg", "sor")
-        self.A_solver.parameters.update({"absolute_tolerance": 1.0e-32,
-                                         "relative_tolerance": 1.0e-14})
-        self.A_solver.set_operator(self.A)
+
+        prior_params = self.solver.params.prior
+        self.A_solver = operator_solver(self.A, prior_params.A_solver,
+                                        prior_params)
 
         self.tmp1, self.tmp2 = Vector(), Vector()
         self.A.init_vector(self.tmp1, 0)
         self.A.init_vector(self.tmp2, 1)
 
+    def mass_solve(self, L, f):
+        """
+        Solve M f = L (annotated)
+
+        The mass matrix & its factorization are cached by tlm_adjoint, and
+        reused by every J_reg solve (& their adjoints) with this Prior
+        """
+        EquationSolver(self.reg_mass_form == L, f,
+                       solver_parameters={"linear_solver": "direct"},
+                       cache_jacobian=True,
+                       cache_adjoint_jacobian=True).solve()
+
     def J_reg(self, **kwargs):
         """
         Compute the regularisation term of the cost function
@@ -167,21 +265,13 @@ class Prior(ABC):
         space = self.space
         result = [None, None]
 
-        # Note - because this is never used in mixed space mode,
-        # no need to mess with alpha_idx, beta_idx
-        trial = self.trial[0]
-        test = self.test[0]
-
         if self.alpha_active:
 
             f_alpha = Function(space, name='f_alpha')
             L = ufl.replace(self.alpha_form, placeholder_map)
 
-            a = test * trial * dx
-
             # alpha form is negative laplacian
-            solve(a == L, f_alpha,  # M^{-1} L alpha
-                  solver_parameters={"linear_solver": "direct"})
+            self.mass_solve(L, f_alpha)  # M^{-1} L alpha
 
             J_reg_alpha = self.norm_sq(f_alpha)  # L M^{-1} M M^{-1} L alpha
                                                  # = L M^{-1} L alpha
@@ -192,9 +282,8 @@ class Prior(ABC):
             f_beta = Function(space, name='f_beta')
 
             L = ufl.replace(self.beta_form, placeholder_map)
-            a = test * trial * dx
 
-            solve(a == L, f_beta, solver_parameters={"linear_solver": "direct"})
+            self.mass_solve(L, f_beta)
             J_reg_beta = self.norm_sq(f_beta)
             result[1] = J_reg_beta
 
@@ -221,19 +310,12 @@ class Prior(ABC):
         # result = [None, None]
         result = {}
 
-        # Note - because this is never used in mixed space mode,
-        # no need to mess with alpha_idx, beta_idx
-        trial = self.trial[0]
-        test = self.test[0]
-
         for term_key in self.terms:
             term = self.terms[term_key]
             f = Function(space, name=term_key)
             L = ufl.replace(term, placeholder_map)
-            a = test * trial * dx
 
-            solve(a == L, f,  # M^{-1} L alpha
-                  solver_parameters={"linear_solver": "direct"})
+            self.mass_solve(L, f)  # M^{-1} L alpha
 
             result[term_key] = self.norm_sq(f)   # L M^{-1} M M^{-1} L alpha
         #                                          # = L M^{-1} L alpha
@@ -311,6 +393,52 @@ class Laplacian(Prior):
         self.tmp1, terms = self.lumpedPCMassSolver.action(x)
         self.A_solver.solve(y, self.tmp1)
 
+    def sqrt_mass_action_block(self, X):
+        """M^{1/2} (see LumpedPCSqrtMassAction) acting on a block of columns"""
+        if self.solver.params.prior.sqrt_method == "chebyshev":
+            return self.lumpedPCMassSolver.action_block(X)[0]
+
+        Y = np.empty_like(X)
+        x = self.tmp1.copy()
+        for j in range(X.shape[1]):
+            x.set_local(X[:, j])
+            x.apply("insert")
+            Y[:, j] = self.lumpedPCMassSolver.action(x)[0].get_local()
+        return Y
+
+    def sqrt_action_block(self, X, Y=None, sqrt_mass=None):
+        """
+        sqrt_action for each column of a block X (n_owned_dofs x k). sqrt_mass
+        optionally supplies sqrt_mass_action_block(X), if already computed.
+        """
+        S = self.sqrt_mass_action_block(X) if sqrt_mass is None else sqrt_mass
+        if Y is None:
+            Y = np.empty_like(X)
+
+        for j in range(X.shape[1]):
+            self.tmp1.set_local(S[:, j])
+            self.tmp1.apply("insert")
+            self.M_solver.solve(self.tmp2, self.tmp1)
+            self.A.mult(self.tmp2, self.tmp1)
+            Y[:, j] = self.tmp1.get_local()
+        return Y
+
+    def sqrt_inv_action_block(self, X, Y=None, sqrt_mass=None):
+        """
+        sqrt_inv_action for each column of a block X (n_owned_dofs x k). sqrt_mass
+        optionally supplies sqrt_mass_action_block(X), if already computed.
+        """
+        S = self.sqrt_mass_action_block(X) if sqrt_mass is None else sqrt_mass
+        if Y is None:
+            Y = np.empty_like(X)
+
+        for j in range(X.shape[1]):
+            self.tmp1.set_local(S[:, j])
+            self.tmp1.apply("insert")
+            self.A_solver.solve(self.tmp2, self.tmp1)
+            Y[:, j] = self.tmp2.get_local()
+        return Y
+
 class Laplacian_flt(Laplacian):
     """
     Laplacian prior implementation
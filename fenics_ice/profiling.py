@@ -0,0 +1,187 @@
+# For fenics_ice copyright information see ACKNOWLEDGEMENTS in the fenics_ice
+# root directory
+
+# This file is part of fenics_ice.
+#
+# fenics_ice is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# fenics_ice is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with fenics_ice.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Per-call timing & iteration counts of the expensive operations in a run
+(Hessian actions, prior actions & solves), written as JSON & CSV
+"""
+
+import contextlib
+import csv
+import functools
+import json
+import logging
+import mpi4py.MPI as MPI  # noqa: N817
+import resource
+import time
+
+log = logging.getLogger("fenics_ice")
+
+__all__ = \
+    [
+        "Profiler"
+    ]
+
+
+class _ProfiledSolver:
+    """Proxy for a dolfin linear solver, recording the time & iterations of
+    each solve"""
+    def __init__(self, solver, profiler, name):
+        self._solver = solver
+        self._profiler = profiler
+        self._name = name
+
+    def solve(self, *args):
+        start = time.perf_counter()
+        its = self._solver.solve(*args)
+        self._profiler.record(self._name, time.perf_counter() - start,
+                              iterations=its)
+        return its
+
+    def __getattr__(self, key):
+        return getattr(self._solver, key)
+
+
+class Profiler:
+    """
+    Records the wall time of each call to the profiled operations on this
+    process, with (for linear solves) the iteration count. Operations are
+    profiled by wrapping functions (wrap), solvers held as attributes
+    (profile_solver), or blocks of code (time).
+    """
+    def __init__(self, comm=MPI.COMM_WORLD):
+        self.comm = comm
+        self.records = []
+        self._start = time.perf_counter()
+
+    def record(self, name, seconds, iterations=None):
+        self.records.append((name, seconds, iterations))
+
+    @contextlib.contextmanager
+    def time(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def wrap(self, name, fn):
+        """Return fn, recording the time of each call under name"""
+        @functools.wraps(fn)
+        def wrapped(*args, **kwargs):
+            with self.time(name):
+                return fn(*args, **kwargs)
+        return wrapped
+
+    def profile_method(self, obj, attr, name=None):
+        """Record calls to the method obj.attr (for this instance only)"""
+        name = attr if name is None else name
+        setattr(obj, attr, self.wrap(name, getattr(obj, attr)))
+
+    def profile_solver(self, obj, attr, name=None):
+        """Record the solves of the linear solver obj.attr"""
+        name = attr if name is None else name
+        setattr(obj, attr, _ProfiledSolver(getattr(obj, attr), self, name))
+
+    def profile_hessian(self, ddJ):
+        """
+        Record each action of a tlm_adjoint CachedHessian under
+        'hessian_action', split into the forward & tangent-linear replay
+        ('hessian_tlm') & the adjoint sweep ('hessian_adjoint'). Only the
+        sweeps made within an action are recorded.
+        """
+        setup_manager = getattr(ddJ, "_setup_manager", None)
+        if setup_manager is None:
+            log.warning("Unable to separate Hessian tangent-linear & "
+                        "adjoint timings")
+            self.profile_method(ddJ, "action", "hessian_action")
+            return
+
+        def profiled_setup_manager(*args, **kwargs):
+            # The forward & tangent-linear equations are replayed here, &
+            # the adjoint is then solved by the returned manager
+            with self.time("hessian_tlm"):
+                manager, *other = setup_manager(*args, **kwargs)
+            manager.compute_gradient = self.wrap("hessian_adjoint",
+                                                 manager.compute_gradient)
+            return (manager, *other)
+
+        action = ddJ.action
+
+        @functools.wraps(action)
+        def profiled_action(*args, **kwargs):
+            ddJ._setup_manager = profiled_setup_manager
+            try:
+                with self.time("hessian_action"):
+                    return action(*args, **kwargs)
+            finally:
+                del ddJ._setup_manager
+
+        ddJ.action = profiled_action
+
+    def summary(self):
+        """Per operation statistics (on this process)"""
+        stats = {}
+        for name, seconds, iterations in self.records:
+            s = stats.setdefault(name, {"calls": 0, "total": 0.0,
+                                        "min": float("inf"), "max": 0.0})
+            s["calls"] += 1
+            s["total"] += seconds
+            s["min"] = min(s["min"], seconds)
+            s["max"] = max(s["max"], seconds)
+            if iterations is not None:
+                s["iterations"] = s.get("iterations", 0) + int(iterations)
+
+        for s in stats.values():
+            s["mean"] = s["total"] / s["calls"]
+            if "iterations" in s:
+                s["mean_iterations"] = s["iterations"] / s["calls"]
+        return stats
+
+    def write(self, filename):
+        """
+        Write the summary, wall time & memory high water mark to
+        filename.json, & the individual calls to filename.csv (on rank 0, for
+        the operations on rank 0). Collective on comm.
+        """
+        mem_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        wall = time.perf_counter() - self._start
+        mem_max = self.comm.allreduce(mem_kb, op=MPI.MAX)
+        mem_total = self.comm.allreduce(mem_kb, op=MPI.SUM)
+        wall_max = self.comm.allreduce(wall, op=MPI.MAX)
+
+        if self.comm.rank != 0:
+            return
+
+        output = {"processes": self.comm.size,
+                  "wall_time": wall_max,
+                  "memory_high_water_kb": {"max": mem_max,
+                                           "total": mem_total},
+                  "operations": self.summary()}
+        with open(f"{filename}.json", "w") as f:
+            json.dump(output, f, indent=2)
+
+        with open(f"{filename}.csv", "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["operation", "call", "seconds", "iterations"])
+            calls = {}
+            for name, seconds, iterations in self.records:
+                calls[name] = calls.get(name, 0) + 1
+                writer.writerow([name, calls[name], seconds,
+                                 "" if iterations is None else iterations])
+
+        log.info(f"Wrote profile to {filename}.json")
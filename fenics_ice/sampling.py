@@ -0,0 +1,149 @@
+# For fenics_ice copyright information see ACKNOWLEDGEMENTS in the fenics_ice
+# root directory
+
+# This file is part of fenics_ice.
+#
+# fenics_ice is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# fenics_ice is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with fenics_ice.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Block sampling of the (Laplacian) prior & the low rank posterior
+approximation, and streaming sample statistics
+"""
+
+import logging
+import mpi4py.MPI as MPI  # noqa: N817
+import numpy as np
+
+from .posterior import PosteriorCovariance
+
+log = logging.getLogger("fenics_ice")
+
+__all__ = \
+    [
+        "RunningStats",
+        "sample_rng",
+        "GaussianSampler"
+    ]
+
+
+def sample_rng(comm, seed=None):
+    """
+    A numpy Generator for this process, independent of those on the other
+    processes in comm, and reproducible given 'seed' (and the number of
+    processes).
+
+    If seed is None, fresh entropy is drawn on rank 0 & shared (and logged, so
+    the run can be repeated).
+    """
+    if seed is None:
+        seed = comm.bcast(np.random.SeedSequence().entropy, root=0)
+        log.info(f"Sampling with seed {seed}")
+
+    seq = np.random.SeedSequence(seed).spawn(comm.size)[comm.rank]
+    return np.random.default_rng(seq)
+
+
+class RunningStats:
+    """
+    Running (pointwise) mean & population variance of a stream of sample
+    blocks, each of shape (n x k), accumulated in place using Welford's
+    algorithm (with the Chan et al. update for combining blocks).
+    """
+    def __init__(self, n):
+        self.count = 0
+        self.mean = np.zeros(n, dtype=np.float64)
+        self._M2 = np.zeros(n, dtype=np.float64)
+        self._block_mean = np.empty(n, dtype=np.float64)
+        self._delta = np.empty(n, dtype=np.float64)
+
+    def update(self, X):
+        """Add the samples in the columns of X"""
+        X = X.reshape((self.mean.shape[0], -1))
+        k = X.shape[1]
+        if k == 0:
+            return
+
+        n_a, n_b = self.count, k
+        n_ab = n_a + n_b
+
+        np.mean(X, axis=1, out=self._block_mean)
+        np.subtract(self._block_mean, self.mean, out=self._delta)
+
+        # M2 += sum_j (x_j - mean_b)^2 + delta^2 n_a n_b / n_ab
+        self._M2 += np.sum((X - self._block_mean[:, None]) ** 2, axis=1)
+        self._M2 += self._delta * self._delta * (n_a * n_b / n_ab)
+
+        self.mean += self._delta * (n_b / n_ab)
+        self.count = n_ab
+
+    def allreduce(self, comm):
+        """
+        Combine, in place, with the statistics for the same points on the
+        other processes in comm (in a single reduction)
+        """
+        n = self.mean.shape[0]
+        count = float(self.count)
+        buf = np.empty(1 + 2 * n, dtype=np.float64)
+        buf[0] = count
+        np.multiply(self.mean, count, out=buf[1:n + 1])
+        buf[n + 1:] = self._M2 + count * self.mean * self.mean
+        comm.Allreduce(MPI.IN_PLACE, buf, op=MPI.SUM)
+
+        total = buf[0]
+        self.count = int(round(total))
+        np.divide(buf[1:n + 1], total, out=self.mean)
+        # Sum of (M2 + n mean^2) over the parts, less N mean^2
+        np.subtract(buf[n + 1:], total * self.mean * self.mean, out=self._M2)
+        np.maximum(self._M2, 0.0, out=self._M2)
+
+    @property
+    def variance(self):
+        """The population variance"""
+        if self.count == 0:
+            return np.full_like(self._M2, np.nan)
+        return self._M2 / self.count
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+
+class GaussianSampler:
+    """
+    Draw blocks of samples from the prior N(0, Gamma_prior) and, given the
+    eigenbasis of the prior preconditioned misfit Hessian, from the low rank
+    approximation to the posterior (see PosteriorCovariance), as dense
+    (n_owned_dofs x k) arrays of local values.
+
+    Arguments:
+      reg_op  The Prior.
+      rng     A numpy Generator (see sample_rng).
+      basis   (Optional) EigenBasis, for posterior samples.
+    """
+    def __init__(self, reg_op, rng, basis=None):
+        self.reg_op = reg_op
+        self.rng = rng
+        self.n = reg_op.tmp1.local_size()
+        self.posterior = None if basis is None \
+            else PosteriorCovariance(reg_op, basis)
+
+    def sample(self, k):
+        """
+        Draw k samples. Returns (prior, posterior), the latter None if no
+        eigenbasis was supplied.
+        """
+        if self.posterior is not None:
+            return self.posterior.sample(k, self.rng)
+
+        X = self.rng.standard_normal((self.n, k))  # N
+        return self.reg_op.sqrt_inv_action_block(X), None  # Gamma^{1/2} N
@@ -18,10 +18,14 @@
 from .backend import *
 
 from . import inout
+from . import mesh as fice_mesh
 from .minimize_l_bfgs import minimize_l_bfgs
 from .minimize_l_bfgs import \
     line_search_rank0_scipy_scalar_search_wolfe1 as line_search_rank0
 
+from collections import OrderedDict
+import copy
+import hashlib
 import logging
 import mpi4py.MPI as MPI  # noqa: N817
 import numpy as np
@@ -34,17 +38,9 @@ log = logging.getLogger("fenics_ice")
 
 
 def interior(x_coords, y_space):
-    bbox = y_space.mesh().bounding_box_tree()
-    y_cells = y_space.mesh().num_cells()
-
-    interior_local = np.full(x_coords.shape[0], -1, dtype=np.uint8)
-    for i in range(x_coords.shape[0]):
-        point = Point(*x_coords[i, :])
-        cell = bbox.compute_first_entity_collision(point)
-        if cell < y_cells:
-            interior_local[i] = 1
-        else:
-            interior_local[i] = 0
+    """Whether each point in x_coords lies within the (global) mesh"""
+    y_cells = fice_mesh.locate_points(x_coords, y_space.mesh())
+    interior_local = np.array(y_cells >= 0, dtype=np.uint8)
 
     interior_global = np.full(x_coords.shape[0], -1, dtype=np.uint8)
     space_comm(y_space).Allreduce(interior_local, interior_global,
@@ -54,20 +50,38 @@ def interior(x_coords, y_space):
     return np.array(interior_global == 1, dtype=bool)
 
 
-def interpolation_matrix(x_coords, y_space):
+def interpolation_matrix(x_coords, y_space, cache_path=None):
+    """
+    Interpolation matrix from y_space to the locally owned points of x_coords
+
+    If cache_path is supplied, the point ownership is read from (or written
+    to) this per-process file (see obs_cache_key)
+    """
     from tlm_adjoint.fenics.fenics_equations import greedy_coloring, \
         interpolation_matrix, point_owners
 
-    y_cells = point_owners(x_coords, y_space, tolerance=np.inf)
-    x_local = np.array(y_cells >= 0, dtype=bool)
-
-    x_global = interior(x_coords, y_space)
-    for i in range(x_coords.shape[0]):
-        if x_local[i] and not x_global[i]:
+    comm = space_comm(y_space)
+    cached = None
+    if cache_path is not None:
+        cached = inout.read_obs_cache(cache_path, comm)
+
+    if comm.allreduce(cached is not None and "y_cells" in cached, op=MPI.LAND):
+        x_local = cached["x_local"]
+        y_cells = cached["y_cells"]
+    else:
+        y_cells = point_owners(x_coords, y_space, tolerance=np.inf)
+        x_local = np.array(y_cells >= 0, dtype=bool)
+
+        x_global = interior(x_coords, y_space)
+        discarded = x_local & ~x_global
+        for i in np.flatnonzero(discarded):
             log.info("Observation point %i discarded, coordinate (%s)"
                      % (i, ", ".join(map(lambda c: f"{c}",
                                          x_coords[i, :]))))
-            x_local[i] = False
+        x_local[discarded] = False
+
+        if cache_path is not None:
+            inout.write_obs_cache(cache_path, x_local=x_local, y_cells=y_cells)
 
     y_colors = greedy_coloring(y_space)
     P = interpolation_matrix(x_coords[x_local, :], space_new(y_space),
@@ -76,6 +90,39 @@ def interpolation_matrix(x_coords, y_space):
     return x_local, P
 
 
+def obs_cache_key(x_coords, y_space, *arrays):
+    """
+    Hash identifying this process's mesh partition, the observation points
+    (plus any other 'arrays') and the interpolation space
+    """
+    mesh = y_space.mesh()
+    comm = space_comm(y_space)
+
+    key = hashlib.sha1()
+    for array in (mesh.coordinates(), mesh.cells(), x_coords) + arrays:
+        key.update(np.ascontiguousarray(array).tobytes())
+    key.update(str(y_space.ufl_element()).encode())
+    key.update(f"{comm.rank}/{comm.size}".encode())
+    return key.hexdigest()
+
+
+def csr_to_arrays(A, name):
+    """Arrays (keyed by name) defining the scipy CSR matrix A, for caching"""
+    return {f"{name}_data": A.data,
+            f"{name}_indices": A.indices,
+            f"{name}_indptr": A.indptr,
+            f"{name}_shape": np.array(A.shape)}
+
+
+def csr_from_arrays(arrays, name):
+    """Inverse of csr_to_arrays"""
+    from scipy.sparse import csr_matrix
+    return csr_matrix((arrays[f"{name}_data"],
+                       arrays[f"{name}_indices"],
+                       arrays[f"{name}_indptr"]),
+                      shape=tuple(arrays[f"{name}_shape"]))
+
+
 def Amat_obs_action(P, Rvec, vec_cg, dg_space):
     # This function implements the Rvec*P*D action on a P1 function
     #  where D is a projection into DG space
@@ -183,9 +230,46 @@ class ssa_solver:
 
         self.dt = Constant(self.params.time.dt, name="dt")
 
+        # Persistent momentum solver state
+        if self.params.momsolve.reuse_solver:
+            self.mom_solver_cache = MomentumSolverCache()
+        else:
+            self.mom_solver_cache = None
+        # Does self.U hold a converged velocity (for newton_warm_start)?
+        self.U_converged = False
+
+        # Converged velocities to seed forward solves during inversion
+        invconfig = self.params.inversion
+        if invconfig.velocity_cache_size > 0:
+            self.velocity_cache = VelocityCache(invconfig.velocity_cache_size,
+                                                invconfig.velocity_cache_method)
+        else:
+            self.velocity_cache = None
+
         self.eigenvals = None
         self.eigenfuncs = None
 
+        # Regularisation operator for comp_J_inv, see get_prior
+        self._prior = None
+        self._prior_key = None
+
+    def get_prior(self):
+        """
+        The prior (regularisation operator) on the control space (self.Qp)
+
+        Constructed on first use & then reused, so that the mass & prior
+        operators and their solvers are set up once per inversion rather than
+        once per cost function evaluation. Reconstructed if the regularisation
+        parameters change (e.g. zero_inv_params).
+        """
+        key = (self.delta_alpha, self.gamma_alpha, self.delta_beta,
+               self.delta_beta_gnd, self.gamma_beta)
+        if self._prior is None or self._prior_key != key:
+            Prior = self.model.get_prior()
+            self._prior = Prior(self, self.Qp)
+            self._prior_key = key
+        return self._prior
+
     def set_inv_params(self):
         """Set delta_alpha, gamma_alpha, etc from config"""
         invparam = self.params.inversion
@@ -360,6 +444,17 @@ class ssa_solver:
     def def_mom_eq(self):
         """Define the momentum equation to be solved in solve_mom_eq"""
 
+        # Forms only need rebuilding if the control functions have been
+        # redefined (see set_control_fns)
+        cache = self.mom_solver_cache
+        controls = (self._alpha, self._beta, self._alphaXbeta)
+        if cache is not None and cache.controls is not None and \
+           all(c is c_cached for c, c_cached in zip(controls, cache.controls)):
+            (self.mom_F, self.mom_Jac_p, self.mom_Jac,
+             self.flow_bcs, self.neumann_bcs) = cache.forms
+            cache.counts["form_reuses"] += 1
+            return
+
         # Simplify accessing fields and parameters
         constants = self.params.constants
         bed = self.bed
@@ -443,23 +538,14 @@ class ssa_solver:
         # Boundary Conditions
         ##########################################
 
-        # Dirichlet
-        self.flow_bcs = []
-        for bc in self.params.bcs:
-            if bc.flow_bc == "obs_vel":
-                dirichlet_condition = self.latbc
-            elif bc.flow_bc == "no_slip":
-                dirichlet_condition = Constant((0.0, 0.0))
-            elif bc.flow_bc == "free_slip":
-                raise NotImplementedError
-            else:
-                continue
-
-            # Add the dirichlet condition to list
-            self.flow_bcs.extend([DirichletBC(self.V,
-                                              dirichlet_condition,
-                                              self.ff,
-                                              lab) for lab in bc.labels])
+        # Dirichlet - DirichletBCs are kept by the persistent solver, as they
+        # cache their boundary dofs on first application
+        if cache is not None and cache.flow_bcs is not None:
+            self.flow_bcs = cache.flow_bcs
+        else:
+            self.flow_bcs = self.def_flow_bcs()
+            if cache is not None:
+                cache.flow_bcs = self.flow_bcs
 
         # Neumann
         # We construct a MeasureSum of different exterior facet sections
@@ -495,6 +581,33 @@ class ssa_solver:
         self.mom_Jac = ufl.algorithms.expand_derivatives(
             derivative(self.mom_F, self.U))
 
+        if cache is not None:
+            cache.controls = controls
+            cache.forms = (self.mom_F, self.mom_Jac_p, self.mom_Jac,
+                           self.flow_bcs, self.neumann_bcs)
+            cache.counts["form_setups"] += 1
+
+    def def_flow_bcs(self):
+        """Construct the Dirichlet BCs on velocity from the BC config"""
+        flow_bcs = []
+        for bc in self.params.bcs:
+            if bc.flow_bc == "obs_vel":
+                dirichlet_condition = self.latbc
+            elif bc.flow_bc == "no_slip":
+                dirichlet_condition = Constant((0.0, 0.0))
+            elif bc.flow_bc == "free_slip":
+                raise NotImplementedError
+            else:
+                continue
+
+            # Add the dirichlet condition to list
+            flow_bcs.extend([DirichletBC(self.V,
+                                         dirichlet_condition,
+                                         self.ff,
+                                         lab) for lab in bc.labels])
+
+        return flow_bcs
+
     def sliding_law(self, alpha, U):
 
         constants = self.params.constants
@@ -548,24 +661,42 @@ class ssa_solver:
 
         t0 = time.perf_counter()
 
-        newton_params = self.params.momsolve.newton_params
-        picard_params = self.params.momsolve.picard_params
-        quad_degree = self.params.momsolve.quadrature_degree
+        momsolve = self.params.momsolve
+        newton_params = momsolve.newton_params
+        picard_params = momsolve.picard_params
+        quad_degree = momsolve.quadrature_degree
         J_p = self.mom_Jac_p
 
+        # Picard terminates on residual reduction, rather than increment size
+        if momsolve.picard_switch_rtol is not None:
+            picard_params = copy.deepcopy(picard_params)
+            picard_params["newton_solver"].update(
+                {"convergence_criterion": "residual",
+                 "relative_tolerance": momsolve.picard_switch_rtol,
+                 "absolute_tolerance": 0.0})
+
         momsolver = MomentumSolver(self.mom_F == 0,
                                    self.U,
                                    bcs=self.flow_bcs,
                                    J_p=J_p,
                                    picard_params=picard_params,
                                    solver_parameters=newton_params,
-                                   form_compiler_parameters=None if quad_degree == -1 else {"quadrature_degree": quad_degree})
+                                   form_compiler_parameters=None if quad_degree == -1 else {"quadrature_degree": quad_degree},
+                                   cache=self.mom_solver_cache,
+                                   warm_start=momsolve.newton_warm_start and self.U_converged)
 
         momsolver.solve(annotate=annotate_flag)
+        self.U_converged = True
 
         t1 = time.perf_counter()
         info("Time for solve: {0}".format(t1-t0))
 
+        if self.mom_solver_cache is not None:
+            log.info("Momentum solver setups (reused): " + ", ".join(
+                f"{name} {self.mom_solver_cache.counts[name + '_setups']}"
+                f" ({self.mom_solver_cache.counts[name + '_reuses']})"
+                for name in ["form", "solver"]))
+
     def def_thickadv_eq(self):
         """
         Define the thickness advection problem
@@ -663,22 +794,211 @@ class ssa_solver:
 
         self.H_bcs = []
 
+        # Explicit scheme sub-step equations, by number of sub-steps
+        self._thickadv_explicit_eqs = {}
+
+        # Persistent thickness solve & DG projection
+        mass_solve = self.params.mass_solve
+        if mass_solve.reuse_solver and mass_solve.scheme == "implicit":
+            self.thickadv_solver = ThicknessSolver(
+                lhs(self.thickadv) == rhs(self.thickadv), H, bcs=self.H_bcs,
+                solver_parameters=thickness_solver_parameters(mass_solve),
+                mass_solve=mass_solve)
+        else:
+            self.thickadv_solver = None
+        if self.thickadv_solver is not None or mass_solve.scheme == "explicit":
+            self.H_DG_projection = LocalProjection(H_DG, H)
+
+    def thickadv_cfl_dt(self, cfl=None):
+        """
+        The largest stable timestep for the explicit upwind DG0 thickness
+        update, i.e. cfl (by default mass_solve.cfl) divided by the largest
+        (over cells K) outflow rate (1/|K|) int_{dK} max(U_np.n, 0) ds
+        """
+        if cfl is None:
+            cfl = self.params.mass_solve.cfl
+
+        U_np = self.U_np
+        Ksi = self.Ksi
+        nm = self.nm
+
+        un = dot(U_np, nm)
+        un_out = 0.5 * (un + abs(un))
+        with paused_manager():
+            outflow = assemble((Ksi('+') * un_out('+') + Ksi('-') * un_out('-'))
+                               * self.dS + Ksi * un_out * self.ds)
+        rate = outflow.get_local() / self.thickadv_cell_volumes()
+
+        max_rate = self.mesh.mpi_comm().allreduce(
+            rate.max() if rate.size > 0 else 0.0, op=MPI.MAX)
+        return np.inf if max_rate <= 0.0 else cfl / max_rate
+
+    def thickadv_cell_volumes(self):
+        """The (local) cell volumes |K|, as the DG0 thickness dofs"""
+        if not hasattr(self, "_thickadv_cell_volumes"):
+            with paused_manager():
+                self._thickadv_cell_volumes = \
+                    assemble(self.Ksi * self.dx).get_local()
+        return self._thickadv_cell_volumes
+
+    def thickadv_explicit_eq(self, n_sub):
+        """
+        Forward Euler upwind thickness update of H over dt / n_sub, from H_np,
+        as a local (cell-wise) projection: the DG0 mass matrix is diagonal, so
+        each sub-step scales the assembled fluxes by dt_sub / |K| with no
+        global solve. The equation is defined once for each n_sub.
+        """
+        eq = self._thickadv_explicit_eqs.get(n_sub, None)
+        if eq is not None:
+            return eq
+
+        U_np = self.U_np
+        Ksi = self.Ksi
+        H_np = self.H_np
+        nm = self.nm
+        dt_sub = self.dt / n_sub
+
+        un = dot(U_np, nm)
+        flux = (inner(grad(Ksi), U_np * H_np) * self.dx
+                - inner(jump(Ksi), jump(0.5 * (un + abs(un)) * H_np)) * self.dS
+                # Outflow
+                - conditional(un > 0, 1.0, 0.0) * inner(Ksi, un * H_np) * self.ds
+                # Inflow
+                - conditional(un < 0, 1.0, 0.0) * inner(Ksi, un * self.H_init) * self.ds
+                - self.bmelt * Ksi * self.dx
+                + self.smb * Ksi * self.dx)
+
+        eq = LocalProjection(self.H, inner(Ksi, H_np) * self.dx + dt_sub * flux,
+                             cache_jacobian=True)
+        self._thickadv_explicit_eqs[n_sub] = eq
+        return eq
+
+    def solve_thickadv_eq_explicit(self):
+        """
+        Explicit thickness update, sub-stepped to satisfy the CFL condition
+        for the current velocity (see thickadv_explicit_eq)
+        """
+        mass_solve = self.params.mass_solve
+        H = self.H
+
+        n_sub = max(1, int(np.ceil(float(self.dt) / self.thickadv_cfl_dt())))
+        if n_sub > mass_solve.max_substeps:
+            raise RuntimeError(f"Explicit thickness update needs {n_sub} "
+                               f"sub-steps (max_substeps {mass_solve.max_substeps})")
+        log.info(f"Explicit thickness update: {n_sub} sub-step(s)")
+
+        eq = self.thickadv_explicit_eq(n_sub)
+        for k in range(n_sub):
+            if k > 0:
+                self.H_np.assign(H)
+            eq.solve()
+        self.H_DG_projection.solve()
+
     def solve_thickadv_eq(self):
         """Solve the thickness equation defined in def_thickadv_eq"""
+        if self.params.mass_solve.scheme == "explicit":
+            self.solve_thickadv_eq_explicit()
+            return
+
+        if self.thickadv_solver is not None:
+            self.thickadv_solver.solve()
+            self.H_DG_projection.solve()
+            return
+
         H = self.H
         a, L = lhs(self.thickadv), rhs(self.thickadv)
         solve(a == L, H, bcs=self.H_bcs,
-              solver_parameters={"linear_solver": "lu"})
+              solver_parameters=thickness_solver_parameters(self.params.mass_solve))
         LocalProjection(self.H_DG, H).solve() 
 
+    def set_timestep(self, dt):
+        """
+        Use timestep dt for the thickness equation. Each distinct dt has its
+        own (unchanging) Constant, forms & solvers, defined on first use &
+        then kept, so that no Constant is modified during the recorded run.
+        """
+        dt = float(dt)
+        cached = self._thickadv_by_dt.get(dt, None)
+        if cached is None:
+            self.dt = Constant(dt, name="dt")
+            self.def_thickadv_eq()
+            self._thickadv_by_dt[dt] = (self.dt, self.thickadv,
+                                        self.thickadv_solver,
+                                        self._thickadv_explicit_eqs)
+        else:
+            (self.dt, self.thickadv, self.thickadv_solver,
+             self._thickadv_explicit_eqs) = cached
+
+    def adaptive_dt(self, t, t_next, dt_prev, dH_max):
+        """
+        The next timestep in adaptive mode, from the CFL estimate for U_np,
+        & optionally the largest thickness change dH_max over the previous
+        step dt_prev (aiming for time.dH_tol), limited to growth by
+        time.dt_growth. It is rounded down to dt_max / 2^k (limiting the
+        number of distinct timesteps), limited below by time.dt_min, then
+        shortened to land exactly on the next sensitivity time t_next.
+        """
+        config = self.params.time
+        dt_max = config.dt_max if config.dt_max is not None else config.dt
+
+        dt = min(dt_max, self.thickadv_cfl_dt(cfl=config.cfl))
+        if dt_prev is not None:
+            if config.dH_tol is not None and dH_max > 0.0:
+                dt = min(dt, dt_prev * config.dH_tol / dH_max)
+            dt = min(dt, config.dt_growth * dt_prev)
+
+        if dt < dt_max:
+            dt = dt_max / 2.0 ** np.ceil(np.log2(dt_max / dt))
+        if config.dt_min is not None and dt < config.dt_min:
+            # The smallest dt_max / 2^k no smaller than dt_min
+            dt_floor = dt_max / 2.0 ** max(np.floor(np.log2(dt_max / config.dt_min)), 0.0)
+            log.warning(f"Adaptive timestep {dt} below dt_min, using {dt_floor}")
+            dt = dt_floor
+
+        if t + dt > t_next - 1.0e-9 * config.run_length:
+            return t_next - t, dt
+        return dt, dt
+
+    def write_timestep_output(self, var, name, n, t, writers):
+        """
+        Write var at step n (time t), either to its own files (see
+        inout.write_variable), or with io.timeseries_output to a single
+        time-series XDMF file, via a writer kept in writers (to be closed by
+        the caller)
+        """
+        io_config = self.params.io
+        outdir = io_config.diagnostics_dir
+        phase_name = self.params.time.phase_name
+        phase_suffix = self.params.time.phase_suffix
+
+        if not io_config.timeseries_output:
+            inout.write_variable(var, self.params, name=f"{name}_timestep_{n}",
+                                 outdir=outdir, phase_name=phase_name,
+                                 phase_suffix=phase_suffix)
+            return
+
+        if "timesteps" not in writers:
+            path = inout.timeseries_path(self.params, "timesteps", outdir,
+                                         phase_name=phase_name,
+                                         phase_suffix=phase_suffix)
+            writers["timesteps"] = inout.XDMFWriter(
+                path, comm=var.function_space().mesh().mpi_comm(),
+                parameters=inout.timeseries_parameters)
+        writers["timesteps"].write(var, name=name, step=t)
+
     def timestep(self, adjoint_flag=1, qoi_func=None ):
         """
         Time evolving model
         Returns the QoI
+
+        With time.adaptive set, the timestep is chosen at each step (see
+        adaptive_dt), landing exactly on the QoI sensitivity times. The times
+        & QoI values are kept in self.t_ts & self.Qval_ts.
         """
 
         # Read timestep info
         config = self.params.time
+        adaptive = config.adaptive
         n_steps = config.total_steps
         dt = config.dt
         run_length = config.run_length
@@ -693,9 +1013,11 @@ class ssa_solver:
         diag_dir = self.params.io.diagnostics_dir
 
         t = 0.0
+        t_eps = 1.0e-9 * run_length
 
         # Initialize QoI structures
-        self.Qval_ts = np.zeros(n_steps+1)
+        Qval_ts = [0.0]
+        t_ts = [0.0]
         Q = Functional(name="Q")
         Q_is = []
 
@@ -704,11 +1026,13 @@ class ssa_solver:
         # H = self.H
         H_np = self.H_np
 
+        # QoI sampling times (also the times adaptive timesteps land on)
+        num_sens = self.params.time.num_sens
+        t_sens = np.flip(np.linspace(run_length, 0, num_sens))
+        i_sens = 0
+
         if adjoint_flag:
             # Define QoI sampling times & configure checkpointing
-            num_sens = self.params.time.num_sens
-            t_sens = np.flip(np.linspace(run_length, 0, num_sens))
-
             n_sens = np.round(t_sens/dt)
 
             reset_manager()
@@ -719,6 +1043,9 @@ class ssa_solver:
 
         # Initial definition of momentum & thickness eqs
         self.def_thickadv_eq()
+        self._thickadv_by_dt = {float(self.dt): (self.dt, self.thickadv,
+                                                 self.thickadv_solver,
+                                                 self._thickadv_explicit_eqs)}
         self.def_mom_eq()
         # Initial momentum solve
         self.solve_mom_eq()
@@ -727,11 +1054,17 @@ class ssa_solver:
         # Initial QoI computation
         if qoi_func is not None:
             qoi = qoi_func()
-            self.Qval_ts[0] = assemble(qoi)
+            Qval_ts[0] = assemble(qoi)
 
         # Save QoI_0 if requested
+        if adaptive:
+            sample_0 = abs(t_sens[0]) <= t_eps
+            if sample_0:
+                i_sens += 1
+        else:
+            sample_0 = adjoint_flag and 0.0 in n_sens
         if adjoint_flag:
-            if 0.0 in n_sens:
+            if sample_0:
                 Q_i = Functional(name="Q_i")
                 Q_i.assign(qoi)
                 Q_is.append(Q_i)
@@ -740,35 +1073,40 @@ class ssa_solver:
             new_block()
 
         # Write out U & H at each timestep.
+        writers = {}
         if (save_frequency>0):
 
-            phase_name = self.params.time.phase_name
-            phase_suffix = self.params.time.phase_suffix
-
-            Hname = "H_timestep_" + str(0)
-            inout.write_variable(H_np, self.params, name=Hname, outdir=diag_dir, \
-               phase_name=phase_name, phase_suffix=phase_suffix)
-            Uname = "U_timestep_" + str(0)
-            inout.write_variable(U_np, self.params, name=Uname, outdir=diag_dir, \
-               phase_name=phase_name, phase_suffix=phase_suffix)
+            self.write_timestep_output(H_np, "H", 0, t, writers)
+            self.write_timestep_output(U_np, "U", 0, t, writers)
 
             if self.params.melt.use_melt_parameterisation:
 
-              Mname = "Melt_timestep_" + str(0)
-              inout.write_variable(self.melt_field, self.params, name=Mname, \
-                 outdir=diag_dir, phase_name=phase_name, phase_suffix=phase_suffix)
+              self.write_timestep_output(self.melt_field, "Melt", 0, t, writers)
 
+        dt_prev, dH_max = None, 0.0
 
         ########################
         # Main timestepping loop
         ########################
-        for n in range(n_steps):
-            begin("Starting timestep %i of %i, time = %.16e a" % (n + 1, n_steps, t))
+        n = 0
+        while (t < run_length - t_eps) if adaptive else (n < n_steps):
+            if adaptive:
+                dt_n, dt_prev = self.adaptive_dt(t, t_sens[i_sens], dt_prev, dH_max)
+                self.set_timestep(dt_n)
+                H_prev = function_get_values(H_np)
+            if adaptive:
+                begin("Starting timestep %i, dt = %.6e a, time = %.16e a" % (n + 1, dt_n, t))
+            else:
+                begin("Starting timestep %i of %i, time = %.16e a" % (n + 1, n_steps, t))
 
             # Solve
 
             # Simple Scheme
             self.solve_thickadv_eq()
+            if adaptive:
+                dH_max = self.mesh.mpi_comm().allreduce(
+                    np.max(np.abs(function_get_values(self.H) - H_prev), initial=0.0),
+                    op=MPI.MAX)
             H_np.assign(self.H)
 
             self.solve_mom_eq()
@@ -776,42 +1114,90 @@ class ssa_solver:
 
             # increment time
             n += 1
-            t = n * float(dt)
+            t_prev = t
+            if adaptive:
+                t = t_sens[i_sens] if abs(t + dt_n - t_sens[i_sens]) <= t_eps else t + dt_n
+            else:
+                t = n * float(dt)
+            t_ts.append(t)
+
+            # Sample QoI?
+            if adaptive:
+                sample = abs(t - t_sens[i_sens]) <= t_eps
+                if sample:
+                    i_sens += 1
+            else:
+                sample = n in n_sens if adjoint_flag else False
 
             # Save QoI
+            Qval_ts.append(0.0)
             if qoi_func is not None:
                 qoi = qoi_func()
-                self.Qval_ts[n] = assemble(qoi)
+                Qval_ts[n] = assemble(qoi)
 
                 if adjoint_flag:
-                    if n in n_sens:
+                    if sample:
                         Q_i = Functional(name="Q_i")
                         Q_i.assign(qoi)
                         Q_is.append(Q_i)
                         Q.addto(Q_i.function())
 
-            if n < n_steps and adjoint_flag:
+            if adjoint_flag and \
+               ((t < run_length - t_eps) if adaptive else (n < n_steps)):
                 new_block()
 
-            if ((save_frequency>0) and (n%n_save_frequency==0)):
+            if adaptive:
+                # Crossed a multiple of save_frequency
+                save = save_frequency > 0 and \
+                    np.floor(t / save_frequency + 1.0e-9) \
+                    > np.floor(t_prev / save_frequency + 1.0e-9)
+            else:
+                save = (save_frequency>0) and (n%n_save_frequency==0)
+            if save:
 
-                Hname = "H_timestep_" + str(n)
-                inout.write_variable(H_np, self.params, name=Hname, outdir=diag_dir, \
-                  phase_name=phase_name, phase_suffix=phase_suffix)
-                Uname = "U_timestep_" + str(n)
-                inout.write_variable(U_np, self.params, name=Uname, outdir=diag_dir, \
-                  phase_name=phase_name, phase_suffix=phase_suffix)
+                self.write_timestep_output(H_np, "H", n, t, writers)
+                self.write_timestep_output(U_np, "U", n, t, writers)
 
                 if self.params.melt.use_melt_parameterisation:
                   self.melt_field = project(self.bmelt, self.M)
-                  Mname = "Melt_timestep_" + str(n)
-                  inout.write_variable(self.melt_field, self.params, name=Mname, \
-                    outdir=diag_dir, phase_name=phase_name, phase_suffix=phase_suffix)
+                  self.write_timestep_output(self.melt_field, "Melt", n, t, writers)
 
         # End of timestepping loop
 
+        for writer in writers.values():
+            if writer.is_open():
+                writer.close()
+
+        self.Qval_ts = np.array(Qval_ts)
+        self.t_ts = np.array(t_ts)
+        if adaptive:
+            log.info(f"Adaptive timestepping: {n} steps "
+                     f"({n_steps} with fixed dt)")
+
         return Q_is if qoi_func is not None else None
 
+    def compute_qoi_gradients(self, Q_is, cntrl):
+        """
+        Gradients of each sampled QoI Q_i (as returned by timestep) with
+        respect to the controls.
+
+        The forward is recorded once (by timestep), & a single reverse sweep
+        restores the forward state from its checkpoints & computes the
+        adjoints of all the QoIs simultaneously. The wall time of the sweep
+        is logged & kept in self.adjoint_sweep_times.
+
+        Returns a list (over Q_i) of gradients (for each control).
+        """
+        t0 = time.perf_counter()
+        dQ_ts = compute_gradient(Q_is, cntrl)
+        t1 = time.perf_counter()
+
+        self.adjoint_sweep_times = [(len(Q_is), t1 - t0)]
+        log.info(f"Adjoint sweep: {len(Q_is)} QoI gradient(s) in "
+                 f"{t1 - t0:.2f} s")
+
+        return dQ_ts
+
     # def forward_ts_alpha(self,aa):
     #     clear_caches()
     #     self.timestep()
@@ -843,8 +1229,15 @@ class ssa_solver:
         #     self.test_outfile = File(os.path.join('invoutput_data','alpha_test.pvd'))
         # self.test_outfile << self.alpha
 
+        if self.velocity_cache is not None:
+            self.velocity_cache.initial_guess(self.get_control(), self.U)
+
         self.def_mom_eq()
         self.solve_mom_eq()
+
+        if self.velocity_cache is not None:
+            self.velocity_cache.store(self.get_control(), self.U)
+
         J = self.comp_J_inv(verbose=verbose)
         return J
 
@@ -1298,37 +1691,78 @@ class ssa_solver:
             from tlm_adjoint.fenics.fenics_equations import LocalMatrix
             from scipy.sparse import spdiags
 
-            obs_local, P = interpolation_matrix(uv_obs_pts, interp_space)
+            comm = space_comm(interp_space)
+            cached = None
+            if self.params.obs.cache_operators:
+                cache_path = inout.obs_cache_path(
+                    self.params, "operators",
+                    obs_cache_key(uv_obs_pts, interp_space,
+                                  u_obs, v_obs, u_std, v_std),
+                    comm)
+                points_cache_path = inout.obs_cache_path(
+                    self.params, "points",
+                    obs_cache_key(uv_obs_pts, interp_space), comm)
+                cached = inout.read_obs_cache(cache_path, comm)
+            else:
+                cache_path = points_cache_path = None
+
+            # Collective agreement, as the fallback is collective
+            use_cached = comm.allreduce(cached is not None and "P_data" in cached,
+                                        op=MPI.LAND)
+            if use_cached:
+                obs_local = cached["x_local"]
+                P = csr_from_arrays(cached, "P")
+                u_PRP_mat = csr_from_arrays(cached, "u_PRP")
+                v_PRP_mat = csr_from_arrays(cached, "v_PRP")
+                l_u_obs_vals = cached["l_u_obs"]
+                l_v_obs_vals = cached["l_v_obs"]
+                J_u_obs, J_v_obs = cached["J_obs"]
 
-            u_PRP = LocalMatrix(
-                P.T @ spdiags(1.0 / (u_std[obs_local] ** 2),
-                              0, P.shape[0], P.shape[0]) @ P)
-            v_PRP = LocalMatrix(
-                P.T @ spdiags(1.0 / (v_std[obs_local] ** 2),
-                              0, P.shape[0], P.shape[0]) @ P)
+            else:
+                obs_local, P = interpolation_matrix(uv_obs_pts, interp_space,
+                                                    cache_path=points_cache_path)
+                P = P.tocsr()
+
+                u_PRP_mat = (P.T @ spdiags(1.0 / (u_std[obs_local] ** 2),
+                                           0, P.shape[0], P.shape[0]) @ P).tocsr()
+                v_PRP_mat = (P.T @ spdiags(1.0 / (v_std[obs_local] ** 2),
+                                           0, P.shape[0], P.shape[0]) @ P).tocsr()
+
+                l_u_obs_vals = P.T @ (u_obs[obs_local] / (u_std[obs_local] ** 2))
+                l_v_obs_vals = P.T @ (v_obs[obs_local] / (v_std[obs_local] ** 2))
+
+                J_u_obs_local = np.dot(u_obs[obs_local],
+                                       u_obs[obs_local] / (u_std[obs_local] ** 2))
+                J_u_obs = np.full(1, np.NAN, dtype=J_u_obs_local.dtype)
+                comm.Allreduce(
+                    np.array([J_u_obs_local], dtype=J_u_obs_local.dtype),
+                    J_u_obs, op=MPI.SUM)
+                J_u_obs, = J_u_obs
+
+                J_v_obs_local = np.dot(v_obs[obs_local],
+                                       v_obs[obs_local] / (v_std[obs_local] ** 2))
+                J_v_obs = np.full(1, np.NAN, dtype=J_v_obs_local.dtype)
+                comm.Allreduce(
+                    np.array([J_v_obs_local], dtype=J_v_obs_local.dtype),
+                    J_v_obs, op=MPI.SUM)
+                J_v_obs, = J_v_obs
+
+                if cache_path is not None:
+                    inout.write_obs_cache(
+                        cache_path, x_local=obs_local,
+                        **csr_to_arrays(P, "P"),
+                        **csr_to_arrays(u_PRP_mat, "u_PRP"),
+                        **csr_to_arrays(v_PRP_mat, "v_PRP"),
+                        l_u_obs=l_u_obs_vals, l_v_obs=l_v_obs_vals,
+                        J_obs=np.array([J_u_obs, J_v_obs]))
+
+            u_PRP = LocalMatrix(u_PRP_mat)
+            v_PRP = LocalMatrix(v_PRP_mat)
 
             l_u_obs = function_new_conjugate_dual(uf, name="l_u_obs")
-            function_set_values(
-                l_u_obs, P.T @ (u_obs[obs_local] / (u_std[obs_local] ** 2)))
+            function_set_values(l_u_obs, l_u_obs_vals)
             l_v_obs = function_new_conjugate_dual(vf, name="l_v_obs")
-            function_set_values(
-                l_v_obs, P.T @ (v_obs[obs_local] / (v_std[obs_local] ** 2)))
-
-            J_u_obs_local = np.dot(u_obs[obs_local],
-                                   u_obs[obs_local] / (u_std[obs_local] ** 2))
-            J_u_obs = np.full(1, np.NAN, dtype=J_u_obs_local.dtype)
-            function_comm(uf).Allreduce(
-                np.array([J_u_obs_local], dtype=J_u_obs_local.dtype),
-                J_u_obs, op=MPI.SUM)
-            J_u_obs, = J_u_obs
-
-            J_v_obs_local = np.dot(v_obs[obs_local],
-                                   v_obs[obs_local] / (v_std[obs_local] ** 2))
-            J_v_obs = np.full(1, np.NAN, dtype=J_v_obs_local.dtype)
-            function_comm(vf).Allreduce(
-                np.array([J_v_obs_local], dtype=J_v_obs_local.dtype),
-                J_v_obs, op=MPI.SUM)
-            J_v_obs, = J_v_obs
+            function_set_values(l_v_obs, l_v_obs_vals)
 
             u_std_local = u_std[obs_local]
             v_std_local = v_std[obs_local]
@@ -1384,17 +1818,13 @@ class ssa_solver:
         J.addto(J_ls_term_v)
 
         # Regularization
-        Prior = self.model.get_prior()
-        lap = Prior(self, self.Qp)
+        lap = self.get_prior()
 
         J_reg_alpha, J_reg_beta = lap.J_reg(alpha=alpha, beta=beta, beta_diff=betadiff)
 
         if do_alpha: J.addto(J_reg_alpha)
         if do_beta: J.addto(J_reg_beta)
 
-        # Get dict of regularisation components for e.g. L-curve analysis
-        J_reg_terms = lap.J_reg_terms(alpha=alpha, beta=beta, beta_diff=betadiff)
-
         # for block in manager()._blocks + [manager()._block]:
         #     for eq in block:
         #         if isinstance(eq, EquationSolver):
@@ -1414,6 +1844,12 @@ class ssa_solver:
             J2 = (function_scalar_value(J_ls_term_u)
                   + function_scalar_value(J_ls_term_v))
 
+            # Get dict of regularisation components for e.g. L-curve analysis
+            # (not needed for J itself, so not annotated)
+            with paused_manager():
+                J_reg_terms = lap.J_reg_terms(alpha=alpha, beta=beta,
+                                              beta_diff=betadiff)
+
             # Assemble & write out terms of regularisation term
             J3 = 0.0
             J_fields = {}
@@ -1432,10 +1868,6 @@ class ssa_solver:
                                        "J_ls": J2,
                                        "J_reg": J3}}
 
-            # Additional separate regularisation terms
-            for term in J_reg_terms:
-                J_fields[f"J_{term}"] = assemble(J_reg_terms[term])
-
             info('Inversion Details')
             for key in J_fields:
                 info(f"{key}: {J_fields[key]}")
@@ -1508,6 +1940,35 @@ class ssa_solver:
         stop_manager()
 
         self.ddJ = CachedHessian(J)
+        self._hessian_solver_parameters = None
+
+    def set_hessian_rtol(self, rtol=None):
+        """
+        Set the relative tolerance of the Krylov solves in the tangent-linear
+        & adjoint equations of the recorded forward model, i.e. within the
+        Hessian action, or restore the original tolerances if rtol is None.
+        """
+        if self._hessian_solver_parameters is None:
+            # The recorded equations (shared with the CachedHessian, which
+            # derives its tangent-linear equations from them at each action)
+            # & their original solver parameters. tlm_adjoint has no public
+            # interface for this: test_hessian_rtol checks it takes effect.
+            self._hessian_solver_parameters = []
+            for block in manager()._blocks + [manager()._block]:
+                for eq in block:
+                    if isinstance(eq, EquationSolver):
+                        for attr in ["_tlm_solver_parameters",
+                                     "_adjoint_solver_parameters"]:
+                            self._hessian_solver_parameters.append(
+                                (eq, attr, getattr(eq, attr)))
+
+        for eq, attr, orig in self._hessian_solver_parameters:
+            if rtol is None:
+                setattr(eq, attr, orig)
+            elif "krylov_solver" in orig:
+                solver_parameters = copy.deepcopy(orig)
+                solver_parameters["krylov_solver"]["relative_tolerance"] = rtol
+                setattr(eq, attr, solver_parameters)
 
     def save_ts_zero(self):
         self.H_init = Function(self.H_np.function_space())
@@ -1538,10 +1999,240 @@ class ddJ_wrapper(object):
         return self.ddJ_action(self.ddJ_F).vector().get_local()
 
 
+class VelocityCache:
+    """
+    LRU cache of converged velocities indexed by control iterate.
+
+    Used by ssa_solver.forward to start each momentum solve (e.g. a line search
+    trial) from the stored velocity whose controls are nearest to the new
+    controls, or from a linear extrapolation along the line through the two
+    most recent iterates when the new controls lie on it. At most 'size'
+    velocities (& their controls) are held.
+    """
+    def __init__(self, size, method="nearest"):
+        assert size > 0
+        assert method in ["nearest", "extrapolate"]
+        self.size = size
+        self.method = method
+        self._entries = OrderedDict()  # least recently used first
+        self._stored = []  # keys, in the order stored
+        self._count = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _control_values(controls):
+        return np.concatenate([function_get_values(c) for c in controls])
+
+    def store(self, controls, U):
+        """Add the converged velocity U for 'controls'"""
+        self._entries[self._count] = (self._control_values(controls),
+                                      function_get_values(U))
+        self._stored.append(self._count)
+        self._count += 1
+        while len(self._entries) > self.size:
+            key, _ = self._entries.popitem(last=False)
+            self._stored.remove(key)
+
+    def initial_guess(self, controls, U):
+        """
+        Set U to the initial guess for 'controls'. Returns False (leaving U
+        unchanged) if the cache is empty.
+        """
+        if len(self._entries) == 0:
+            return False
+
+        comm = function_comm(U)
+        m = self._control_values(controls)
+        keys = list(self._entries.keys())
+
+        # Squared distances to each stored iterate, with a single reduction
+        dist = np.array([np.sum((m - m_i) ** 2) for m_i, _ in self._entries.values()])
+        dist = comm.allreduce(dist, op=MPI.SUM)
+        nearest = keys[int(np.argmin(dist))]
+        self._entries.move_to_end(nearest)
+        U_guess = self._entries[nearest][1]
+        method = "nearest"
+
+        if self.method == "extrapolate" and len(keys) > 1:
+            # Two most recently stored iterates
+            (m_1, U_1), (m_2, U_2) = (self._entries[k] for k in self._stored[-2:])
+            dm = m_2 - m_1
+            sums = comm.allreduce(np.array([np.dot(m - m_2, dm),
+                                            np.dot(dm, dm),
+                                            np.dot(m - m_2, m - m_2)]),
+                                  op=MPI.SUM)
+            if sums[1] > 0.0:
+                t = sums[0] / sums[1]
+                # Only extrapolate if m lies (numerically) on the line
+                off_line = sums[2] - t * sums[0]
+                if off_line <= 1.0e-6 * sums[2]:
+                    U_guess = U_2 + t * (U_2 - U_1)
+                    method = f"extrapolate (t = {t:.3g})"
+
+        function_set_values(U, U_guess)
+        function_update_state(U)
+        log.info(f"Velocity initial guess from cache: {method}")
+        return True
+
+
+def thickness_solver_parameters(mass_solve):
+    """dolfin linear solver parameters for the thickness solve"""
+    if mass_solve.linear_solver == "lu":
+        return {"linear_solver": "lu"}
+    return {"linear_solver": mass_solve.linear_solver,
+            "preconditioner": mass_solve.preconditioner,
+            "krylov_solver": {"relative_tolerance": mass_solve.rtol,
+                              "absolute_tolerance": mass_solve.atol,
+                              "nonzero_initial_guess": True}}
+
+
+class ThicknessSolver(EquationSolver):
+    """
+    The (linear) thickness advection solve, keeping the assembled matrix (&
+    so its sparsity pattern) and the linear solver between timesteps, so that
+    only the matrix values are re-assembled as U_np changes. With LU, PETSc
+    then repeats only the numeric factorization, as the nonzero pattern is
+    unchanged. Adjoint solves are as for EquationSolver.
+    """
+    def __init__(self, *args, **kwargs):
+        self.mass_solve = kwargs.pop("mass_solve")
+        super(ThicknessSolver, self).__init__(*args, **kwargs)
+        self._A = None
+        self._linear_solver = None
+        self.counts = {"solves": 0, "solver_setups": 0}
+
+    def _new_linear_solver(self, comm):
+        if self.mass_solve.linear_solver == "lu":
+            linear_solver = PETScLUSolver(comm)
+        else:
+            linear_solver = PETScKrylovSolver(comm,
+                                              self.mass_solve.linear_solver,
+                                              self.mass_solve.preconditioner)
+            linear_solver.parameters.update(
+                thickness_solver_parameters(self.mass_solve)["krylov_solver"])
+        linear_solver.set_operator(self._A)
+        self.counts["solver_setups"] += 1
+        return linear_solver
+
+    def forward_solve(self, x, deps=None):
+        from tlm_adjoint.fenics.backend import backend_assemble
+
+        if deps is None:
+            def replace_deps(form):
+                return form
+        else:
+            replace_map = dict(zip(self.dependencies(), deps))
+            replace_map[self.x()] = x
+
+            def replace_deps(form):
+                return ufl.replace(form, replace_map)
+
+        fcp = self._form_compiler_parameters
+        comm = x.function_space().mesh().mpi_comm()
+        if self._A is None:
+            self._A = PETScMatrix(comm)
+        backend_assemble(replace_deps(self._lhs), tensor=self._A,
+                         form_compiler_parameters=fcp)
+        b = backend_assemble(replace_deps(self._rhs),
+                             form_compiler_parameters=fcp)
+        for bc in self._bcs:
+            bc.apply(self._A, b)
+
+        if self._linear_solver is None:
+            self._linear_solver = self._new_linear_solver(comm)
+        self._linear_solver.solve(x.vector(), b)
+        self.counts["solves"] += 1
+
+
+class MomentumProblem(NonlinearProblem):
+    """
+    The momentum equation as a NonlinearProblem, assembling F & J into the
+    tensors owned by the NewtonSolver (as NonlinearVariationalSolver does).
+    """
+    def __init__(self, F, J, bcs, form_compiler_parameters=None):
+        super(MomentumProblem, self).__init__()
+        self._F = F
+        self._J = J
+        self._bcs = bcs
+        self._fcp = form_compiler_parameters
+
+    def F(self, b, x):
+        from tlm_adjoint.fenics.backend import backend_assemble
+        backend_assemble(self._F, tensor=b, form_compiler_parameters=self._fcp)
+        for bc in self._bcs:
+            bc.apply(b, x)
+
+    def J(self, A, x):
+        from tlm_adjoint.fenics.backend import backend_assemble
+        backend_assemble(self._J, tensor=A, form_compiler_parameters=self._fcp)
+        for bc in self._bcs:
+            bc.apply(A)
+
+
+class MomentumSolverCache:
+    """
+    State kept between momentum solves when momsolve.reuse_solver is set
+    (otherwise a new MomentumSolverCache is used for each solve).
+
+    Holds the UFL forms & DirichletBCs from def_mom_eq, and one NewtonSolver
+    per solve phase (picard & newton). A NewtonSolver owns its
+    Jacobian, residual & linear solver, so reusing it keeps the sparsity pattern
+    and the Krylov/AMG objects, and subsequent solves only re-assemble values.
+    'counts' records how many setups were performed & how many were avoided.
+    """
+    def __init__(self):
+        self.controls = None
+        self.forms = None
+        self.flow_bcs = None
+
+        self._newton_solvers = {}
+
+        self.counts = {"solves": 0,
+                       "form_setups": 0, "form_reuses": 0,
+                       "solver_setups": 0, "solver_reuses": 0,
+                       "picard_iterations": 0, "newton_iterations": 0,
+                       "picard_skipped": 0}
+
+    def newton_solver(self, key, comm, solver_parameters):
+        """Return the NewtonSolver for phase 'key', creating it if necessary"""
+        assert solver_parameters.get("nonlinear_solver", "newton") == "newton"
+
+        newton_solver = self._newton_solvers.get(key, None)
+        if newton_solver is None:
+            newton_solver = NewtonSolver(comm)
+            self._newton_solvers[key] = newton_solver
+            self.counts["solver_setups"] += 1
+        else:
+            self.counts["solver_reuses"] += 1
+
+        newton_solver.parameters.update(solver_parameters["newton_solver"])
+        return newton_solver
+
+    def solve(self, key, F, J, x, bcs, form_compiler_parameters,
+              solver_parameters):
+        """Solve F == 0 for x with Jacobian J, using the phase 'key' solver"""
+        problem = MomentumProblem(F, J, bcs, form_compiler_parameters)
+        newton_solver = self.newton_solver(key,
+                                           x.function_space().mesh().mpi_comm(),
+                                           solver_parameters)
+
+        for bc in bcs:
+            bc.apply(x.vector())
+
+        self.counts["solves"] += 1
+        iterations, converged = newton_solver.solve(problem, x.vector())
+        self.counts[key + "_iterations"] += iterations
+        return iterations, converged
+
+
 class MomentumSolver(EquationSolver):
     def __init__(self, *args, **kwargs):
         self.picard_params = kwargs.pop("picard_params", None)
         self.J_p = kwargs.pop("J_p", None)
+        self.cache = kwargs.pop("cache", None)
+        self.warm_start = kwargs.pop("warm_start", False)
         super(MomentumSolver, self).__init__(*args, **kwargs)
 
     def drop_references(self):
@@ -1569,14 +2260,62 @@ class MomentumSolver(EquationSolver):
             assert isinstance(rhs, int) and rhs == 0
         J_p = replace_deps(self.J_p)
         J = replace_deps(self._J)
+        fcp = self._form_compiler_parameters
+        F = lhs if isinstance(rhs, int) else lhs - rhs
+
+        if self.cache is None and not self.warm_start:
+            # As solve(F == 0, ...), returning the iteration count
+            def nonlinear_solve(J, solver_parameters):
+                problem = NonlinearVariationalProblem(
+                    F, x, self._bcs, J, form_compiler_parameters=fcp)
+                solver = NonlinearVariationalSolver(problem)
+                solver.parameters.update(solver_parameters)
+                iterations, _ = solver.solve()
+                end()
+                return iterations
+
+            # First order approx - inconsistent jacobian
+            picard_its = nonlinear_solve(J_p, self.picard_params)
+
+            # Newton solver
+            newton_its = nonlinear_solve(J, self._solver_parameters)
+
+            log.info(f"Momentum solve: picard {picard_its} iterations, "
+                     f"newton {newton_its} iterations")
+            return
+
+        # With a persistent cache, or a warm start, drive the NewtonSolvers
+        # directly, reusing their setup
+        cache = self.cache if self.cache is not None else MomentumSolverCache()
+
+        # Starting from a nearby solution, go straight to Newton, falling
+        # back to picard + newton if this fails
+        if self.warm_start:
+            x_0 = function_get_values(x)
+            try:
+                newton_its, converged = cache.solve("newton", F, J, x, self._bcs,
+                                                    fcp, self._solver_parameters)
+            except RuntimeError:
+                converged = False
+            end()
+
+            if converged:
+                cache.counts["picard_skipped"] += 1
+                log.info(f"Momentum solve: picard skipped, newton {newton_its} iterations")
+                return
+
+            log.warning("Warm started newton solve failed, restarting with picard")
+            function_set_values(x, x_0)
+
         # First order approx - inconsistent jacobian
-        solve(lhs == rhs, x, self._bcs, J=J_p,
-              form_compiler_parameters=self._form_compiler_parameters,
-              solver_parameters=self.picard_params)
+        picard_its, _ = cache.solve("picard", F, J_p, x, self._bcs,
+                                    fcp, self.picard_params)
         end()
 
         # Newton solver
-        solve(lhs == rhs, x, self._bcs, J=J,
-              form_compiler_parameters=self._form_compiler_parameters,
-              solver_parameters=self._solver_parameters)
+        newton_its, _ = cache.solve("newton", F, J, x, self._bcs,
+                                    fcp, self._solver_parameters)
         end()
+
+        log.info(f"Momentum solve: picard {picard_its} iterations, "
+                 f"newton {newton_its} iterations")
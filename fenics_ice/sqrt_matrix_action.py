@@ -1,15 +1,20 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from fenics import TestFunction, TrialFunction, assemble, dx, inner, split
+from fenics import TestFunction, TrialFunction, as_backend_type, assemble, \
+    dx, inner, split
 
+import mpi4py.MPI as MPI  # noqa: N817
 import numpy as np
 import ufl
 
 __all__ = \
     [
         "A_root_action",
-        "LumpedPCSqrtMassAction"
+        "ChebyshevSqrtAction",
+        "LumpedPCSqrtMassAction",
+        "gershgorin_bounds",
+        "lanczos_bounds"
     ]
 
 
@@ -66,8 +71,247 @@ def A_root_action(A, x, tol, beta=1.0, max_terms=1000):
     return y * np.sqrt(beta), j + 1
 
 
+def lanczos_bounds(A_action, n, comm, its=30, seed=0):
+    """
+    Estimate the extreme eigenvalues of the symmetric operator A from the
+    Ritz values of a Lanczos iteration.
+    Arguments:
+      A_action  A callable of the form
+                    def A_action(X, Y):
+                setting Y = A X for X, Y arrays of locally owned values, of
+                shape (n x k).
+      n         The local size.
+      comm      Communicator over which the vectors are distributed.
+      its       Maximum number of Lanczos iterations.
+      seed      Random seed for the start vector (offset by the rank).
+    Returns:
+      lam_min, lam_max
+    Ritz values lie within the spectrum, so these are interior estimates.
+    """
+
+    def inner_product(x, y):
+        return comm.allreduce(np.dot(x, y))
+
+    rng = np.random.default_rng(seed + comm.rank)
+    q = rng.standard_normal(n).reshape((n, 1))
+    q /= np.sqrt(inner_product(q[:, 0], q[:, 0]))
+    q_prev = np.zeros_like(q)
+    w = np.empty_like(q)
+
+    alpha, beta = [], []
+    b = 0.0
+    for i in range(min(its, comm.allreduce(n))):
+        A_action(q, w)
+        w -= b * q_prev
+        a = inner_product(w[:, 0], q[:, 0])
+        w -= a * q
+        alpha.append(a)
+
+        b = np.sqrt(inner_product(w[:, 0], w[:, 0]))
+        if b <= 1.0e-14 * abs(a):
+            break
+        beta.append(b)
+        q_prev[:] = q
+        np.divide(w, b, out=q)
+
+    T = np.diag(alpha)
+    off = beta[:len(alpha) - 1]
+    T += np.diag(off, 1) + np.diag(off, -1)
+    lam = np.linalg.eigvalsh(T)
+    return lam[0], lam[-1]
+
+
+def gershgorin_bounds(A_mat, d, comm):
+    """
+    Bound the eigenvalues of D^{-1} A, and so of the similar
+    D^{-1/2} A D^{-1/2}, using the Gershgorin discs of the rows of D^{-1} A.
+    Arguments:
+      A_mat  A PETSc Mat.
+      d      The locally owned values of the positive diagonal D.
+      comm   Communicator over which A is distributed.
+    Returns:
+      lam_min, lam_max
+    These bound the spectrum, but lam_min may be non-positive.
+    """
+
+    ai, _, av = A_mat.getValuesCSR()
+    n = len(ai) - 1
+    rows = np.repeat(np.arange(n), np.diff(ai))
+    abs_sums = np.bincount(rows, weights=np.abs(av), minlength=n)
+    diag = A_mat.getDiagonal().array_r
+
+    radius = (abs_sums - np.abs(diag)) / d
+    centre = diag / d
+    lam_min = comm.allreduce(np.min(centre - radius, initial=np.inf),
+                             op=MPI.MIN)
+    lam_max = comm.allreduce(np.max(centre + radius, initial=-np.inf),
+                             op=MPI.MAX)
+    return lam_min, lam_max
+
+
+class ChebyshevSqrtAction:
+    def __init__(self, A_action, n, comm, tol=1.0e-15, bounds=None,
+                 margin=0.1, max_terms=1000, max_widenings=4):
+        """
+        Class for the calculation of the action of the principal square root
+        of a symmetric positive definite operator A, using a Chebyshev
+        expansion of sqrt on an interval [a, b] containing the spectrum of A,
+        as in
+          N. J. Higham, "Functions of Matrices: Theory and Computation", SIAM,
+          2008, section 4.4
+        The expansion is computed once, & applied to a block of vectors by
+        the three term Chebyshev recurrence, with all work arrays
+        preallocated.
+        Arguments:
+          A_action       A callable of the form
+                             def A_action(X, Y):
+                         setting Y = A X for X, Y arrays of locally owned
+                         values, of shape (n x k).
+          n              The local size.
+          comm           Communicator over which the vectors are distributed.
+          tol            Relative tolerance for the truncated expansion.
+                         Positive float.
+          bounds         (Optional) (a, b), 0 < a < b, bounding the spectrum
+                         of A. Otherwise estimated by lanczos_bounds & widened
+                         by 'margin'.
+          margin         Relative widening of estimated bounds. Positive
+                         float.
+          max_terms      Maximum number of terms in the expansion. Integer.
+          max_widenings  Estimated bounds may not contain the spectrum, so
+                         are checked (see residual), & widened by a factor
+                         of two at each end, at most max_widenings times, if
+                         the check fails. Integer.
+        """
+
+        self._A_action = A_action
+        self._n = n
+        self._comm = comm
+        self._tol = tol
+        self._max_terms = max_terms
+        self._work = {}
+
+        if bounds is None:
+            lam_min, lam_max = lanczos_bounds(A_action, n, comm)
+            self._set_bounds(lam_min / (1.0 + margin),
+                             lam_max * (1.0 + margin))
+
+            # Ritz values lie within the spectrum, so the expansion may be
+            # evaluated outside [a, b]
+            for i in range(max_widenings + 1):
+                if self.residual() < np.sqrt(tol):
+                    break
+                if i == max_widenings:
+                    raise RuntimeError("Unable to bound the spectrum")
+                a, b = self._bounds
+                self._set_bounds(0.5 * a, 2.0 * b)
+        else:
+            self._set_bounds(*bounds)
+
+    def _set_bounds(self, a, b):
+        """Compute the expansion on [a, b]"""
+        if not (0.0 < a < b):
+            raise ValueError("Invalid spectrum bounds")
+        tol = self._tol
+
+        # Expansion coefficients, doubling the degree until the tail is
+        # negligible
+        deg = 8
+        while True:
+            c = np.polynomial.chebyshev.Chebyshev.interpolate(
+                np.sqrt, deg, domain=[a, b]).coef
+            if np.sum(np.abs(c[-2:])) < tol * abs(c[0]):
+                break
+            deg *= 2
+            if deg >= self._max_terms:
+                raise RuntimeError("Maximum terms exceeded")
+        terms = len(c)
+        while terms > 1 and np.sum(np.abs(c[terms - 1:])) < tol * abs(c[0]):
+            terms -= 1
+
+        self._bounds = (a, b)
+        self._coef = c[:terms]
+        # Chebyshev variable: S = (2 A - (a + b) I) / (b - a)
+        self._scale = 2.0 / (b - a)
+        self._shift = (a + b) / (b - a)
+
+    def residual(self, seed=0):
+        """
+        The relative error ||S S x - A x|| / ||A x||, for the computed
+        action S of the square root & a random probe vector x (seeded by
+        seed, offset by the rank). Collective on the communicator.
+        """
+
+        rng = np.random.default_rng(seed + self._comm.rank)
+        X = rng.standard_normal((self._n, 1))
+        AX = np.empty_like(X)
+        self._A_action(X, AX)
+        Y, _ = self.action(X)
+        SSX, _ = self.action(Y)
+        SSX -= AX
+        err_sq = self._comm.allreduce(np.dot(SSX[:, 0], SSX[:, 0]))
+        norm_sq = self._comm.allreduce(np.dot(AX[:, 0], AX[:, 0]))
+        return np.sqrt(err_sq / norm_sq)
+
+    @property
+    def bounds(self):
+        return self._bounds
+
+    @property
+    def terms(self):
+        return len(self._coef)
+
+    def _work_arrays(self, k):
+        if k not in self._work:
+            self._work[k] = tuple(np.empty((self._n, k), dtype=np.float64)
+                                  for i in range(4))
+        return self._work[k]
+
+    def _S_action(self, X, Y, work):
+        """Y = S X, using the work array 'work' (of the same shape)"""
+        self._A_action(X, Y)
+        Y *= self._scale
+        np.multiply(X, self._shift, out=work)
+        Y -= work
+
+    def action(self, X, Y=None):
+        """
+        Compute
+            Y = A^{1/2} X
+        Arguments:
+            X  Array (n or n x k) of locally owned values.
+            Y  (Optional) Array, of the same shape as X, for the result.
+        Returns:
+          Y, terms
+        where terms is the number of terms in the expansion.
+        """
+
+        if Y is None:
+            Y = np.empty_like(X, dtype=np.float64)
+        X2 = X.reshape((self._n, -1))
+        Y2 = Y.reshape((self._n, -1))
+        t0, t1, t2, tmp = self._work_arrays(X2.shape[1])
+        c = self._coef
+
+        t0[:] = X2
+        np.multiply(t0, c[0], out=Y2)
+        if len(c) > 1:
+            self._S_action(t0, t1, tmp)
+            np.multiply(t1, c[1], out=tmp)
+            Y2 += tmp
+        for j in range(2, len(c)):
+            # T_{j} = 2 S T_{j - 1} - T_{j - 2}
+            self._S_action(t1, t2, tmp)
+            t2 *= 2.0
+            t2 -= t0
+            np.multiply(t2, c[j], out=tmp)
+            Y2 += tmp
+            t0, t1, t2 = t1, t2, t0
+
+        return Y, len(c)
+
+
 class LumpedPCSqrtMassAction:
-    def __init__(self, space, tol, beta=1.0, M=None):
+    def __init__(self, space, tol, beta=1.0, M=None, method="binomial"):
         """
         Class for the calculation of matrix actions
             A x,
@@ -77,11 +321,12 @@ class LumpedPCSqrtMassAction:
             A A^T = M,
         where M is the mass matrix and M_L the row-summed lumped mass matrix.
         The square root of M_L^{-1/2} M M_L^{-1/2} is computed using
-        A_root_action.
+        A_root_action ("binomial") or ChebyshevSqrtAction ("chebyshev").
         Arguments:
             space      The function space.
-            tol, beta  As for A_root_action.
+            tol, beta  As for A_root_action. Used by "binomial" only.
             M          (Optional) Mass matrix.
+            method     "binomial" or "chebyshev".
         """
 
         test = TestFunction(space)
@@ -105,6 +350,51 @@ class LumpedPCSqrtMassAction:
         self._sqrt_M_L = sqrt_M_L
         self._sqrt_M_L_inv = sqrt_M_L_inv
 
+        if method == "chebyshev":
+            M_mat = as_backend_type(M).mat()
+            self._x_vec, self._y_vec = M_mat.createVecs()
+            self._M_mat = M_mat
+            self._sqrt_M_L_inv_local = \
+                sqrt_M_L_inv.get_local().reshape((-1, 1))
+            self._sqrt_M_L_local = sqrt_M_L.get_local().reshape((-1, 1))
+            # The spectrum of M_L^{-1/2} M M_L^{-1/2} is bounded using
+            # Gershgorin discs, or if these do not exclude zero estimated
+            comm = space.mesh().mpi_comm()
+            bounds = gershgorin_bounds(M_mat, M_L.get_local(), comm)
+            if bounds[0] <= 0.0:
+                bounds = None
+            self._chebyshev = ChebyshevSqrtAction(
+                self._transformed_M_block_action,
+                self._sqrt_M_L_local.shape[0], comm, bounds=bounds)
+        elif method == "binomial":
+            self._chebyshev = None
+        else:
+            raise ValueError(f"Invalid method: {method}")
+
+    def _transformed_M_block_action(self, X, Y):
+        """Y = M_L^{-1/2} M M_L^{-1/2} X, for blocks of local values"""
+        np.multiply(X, self._sqrt_M_L_inv_local, out=Y)
+        for j in range(X.shape[1]):
+            self._x_vec.array[:] = Y[:, j]
+            self._M_mat.mult(self._x_vec, self._y_vec)
+            Y[:, j] = self._y_vec.array_r
+        Y *= self._sqrt_M_L_inv_local
+
+    def action_block(self, X, Y=None):
+        """
+        Compute A X (see action) for a block X (n x k) of locally owned
+        values, using the "chebyshev" method.
+        Returns:
+          Y, terms
+        """
+
+        if self._chebyshev is None:
+            raise RuntimeError("Block action requires method 'chebyshev'")
+        Y, terms = self._chebyshev.action(X, Y)
+        Y2 = Y.reshape((self._sqrt_M_L_local.shape[0], -1))
+        Y2 *= self._sqrt_M_L_local
+        return Y, terms
+
     def action(self, x):
         """
         Compute.
@@ -121,6 +411,13 @@ class LumpedPCSqrtMassAction:
         terms added in A_root_action.
         """
 
+        if self._chebyshev is not None:
+            y = x.copy()
+            Y, terms = self.action_block(x.get_local())
+            y.set_local(Y)
+            y.apply("insert")
+            return y, terms
+
         def transformed_M_action(x):
             return self._sqrt_M_L_inv * (self._M * (self._sqrt_M_L_inv * x))
 
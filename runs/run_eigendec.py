@@ -17,12 +17,14 @@
 
 #!/usr/bin/env python
 
-from fenics_ice.backend import Function, Vector, function_get_values
+from fenics_ice.backend import Function, Vector, function_get_values, \
+    function_global_size, function_set_values, space_new
 
 import os
 os.environ["OMP_NUM_THREADS"] = "1"
 os.environ["OPENBLAS_NUM_THREADS"] = "1"
 
+import mpi4py.MPI as MPI  # noqa: N817
 import sys
 import resource
 
@@ -39,6 +41,8 @@ from fenics_ice import model, solver, prior, inout
 from fenics_ice import mesh as fice_mesh
 from fenics_ice.config import ConfigParser
 from fenics_ice.decorators import count_calls, timer
+from fenics_ice.profiling import Profiler
+from fenics_ice.mpi_groups import check_group_alignment, split_groups
 
 import numpy as np
 import matplotlib as mpl
@@ -61,11 +65,26 @@ def run_eigendec(config_file):
     log = inout.setup_logging(params)
     inout.log_preamble("eigendecomp", params)
 
+    def diag_path(suffix):
+        """Path (without extension) of a diagnostic output of this phase"""
+        return str(Path(params.io.diagnostics_dir)/params.eigendec.phase_name/
+                   params.eigendec.phase_suffix/
+                   (params.io.run_name + params.eigendec.phase_suffix + suffix))
+
     # Load the static model data (geometry, smb, etc)
     input_data = inout.InputData(params)
 
+    # Optionally split the processes into replicas, each holding the full
+    # model, which compute independent Hessian actions concurrently
+    n_replicas = params.eigendec.n_replicas
+    if n_replicas > 1:
+        replica, replica_comm, cross_comm = \
+            split_groups(MPI.COMM_WORLD, n_replicas)
+    else:
+        replica, replica_comm = 0, MPI.COMM_WORLD
+
     # Get mesh & define model
-    mesh = fice_mesh.get_mesh(params)
+    mesh = fice_mesh.get_mesh(params, comm=replica_comm)
     mdl = model.model(mesh, input_data, params)
     # Load alpha/beta fields
     mdl.alpha_from_inversion()
@@ -116,71 +135,209 @@ def run_eigendec(config_file):
         reg_op.action(x.vector(), xg.vector())
         return function_get_values(xg)
 
+    def prior_inv_action(x):
+        """Define the action of the inverse of the B matrix (prior)"""
+        reg_op.inv_action(x.vector(), xb.vector())
+        return function_get_values(xb)
+
+    # Optional per-call profiling of the Hessian & prior
+    profiler = None
+    prior_pc = prior.LaplacianPC(reg_op)
+    if params.eigendec.profile:
+        profiler = Profiler(replica_comm)
+        ghep_action = profiler.wrap("ghep_action", ghep_action)
+        prior_action = profiler.wrap("prior_action", prior_action)
+        prior_inv_action = profiler.wrap("prior_inv_action", prior_inv_action)
+        profiler.profile_method(prior_pc, "apply", "LaplacianPC.apply")
+        profiler.profile_hessian(slvr.ddJ)
+        profiler.profile_solver(reg_op, "A_solver", "prior_A_solve")
+        profiler.profile_solver(reg_op, "M_solver", "prior_M_solve")
+
+    # Inexact Hessian actions: the TLM/adjoint Krylov tolerance is relaxed
+    # from that of the forward solve (rtol_min) towards hessian_rtol_max
+    inexact = params.eigendec.inexact_hessian
+    if inexact:
+        rtol_min = params.momsolve.newton_params["newton_solver"].get(
+            "krylov_solver", {}).get("relative_tolerance", None)
+        if rtol_min is None:
+            log.warning("inexact_hessian has no effect without Krylov "
+                        "momentum solves")
+            inexact = False
+        else:
+            rtol_max = max(params.eigendec.hessian_rtol_max, rtol_min)
+
     # opts = {'prior': gnhep_prior_action, 'mass': gnhep_mass_action}
     # gnhep_func = opts[params.eigendec.precondition_by]
 
     num_eig = params.eigendec.num_eig
-    n_iter = params.eigendec.power_iter  # <- not used yet
+    n_iter = params.eigendec.power_iter  # random only
+
+    # Optionally continue from the eigenpairs written by a previous (e.g.
+    # interrupted) run, deflating them
+    resume_basis = None
+    if params.eigendec.resume:
+        lam_path, vec_path = ED.eigenpair_paths(params)
+        if lam_path.exists() and vec_path.exists():
+            resume_basis = ED.load_eigenbasis(params, space, reg_op=reg_op,
+                                              num_eig=num_eig, allow_nan=True)
+            log.info(f"Resuming with {len(resume_basis)} eigenpairs")
+        else:
+            log.warning("No previous eigenpairs found to resume from")
+    n_prev = 0 if resume_basis is None else len(resume_basis)
+    n_total = num_eig if num_eig is not None \
+        else function_global_size(space_new(space))
 
     # Hessian eigendecomposition using SLEPSc
     eig_algo = params.eigendec.eig_algo
     if eig_algo == "slepc":
         results = {}  # Create this empty dict & pass it to slepc_monitor_callback to fill
-        # Eigendecomposition
-        import slepc4py.SLEPc as SLEPc
-        esolver = eigendecompose(space,
-                                 ghep_action,
-                                 tolerance=params.eigendec.tol,
-                                 max_it=params.eigendec.max_iter,
-                                 N_eigenvalues=num_eig,
-                                 problem_type=SLEPc.EPS.ProblemType.GHEP,
-                                 solver_type=SLEPc.EPS.Type.KRYLOVSCHUR,
-                                 configure=slepc_config_callback(prior_action, space,
-                                                                 prior_pc=prior.LaplacianPC(reg_op)),
-                                 monitor=slepc_monitor_callback(params, space, results))
+        output_monitor = slepc_monitor_callback(params, space, results,
+                                                resume_basis=resume_basis)
+        if inexact:
+            rtol_monitor = ED.inexact_hessian_monitor(
+                slvr.set_hessian_rtol, params.eigendec.tol,
+                rtol_min, rtol_max, n_total - n_prev)
+
+            def monitor(*args):
+                output_monitor(*args)
+                rtol_monitor(*args)
+        else:
+            monitor = output_monitor
+
+        if n_prev < n_total:
+            # Eigendecomposition
+            import slepc4py.SLEPc as SLEPc
+            esolver = eigendecompose(space,
+                                     ghep_action,
+                                     tolerance=params.eigendec.tol,
+                                     max_it=params.eigendec.max_iter,
+                                     N_eigenvalues=n_total - n_prev,
+                                     problem_type=SLEPc.EPS.ProblemType.GHEP,
+                                     solver_type=SLEPc.EPS.Type.KRYLOVSCHUR,
+                                     configure=slepc_config_callback(prior_action, space,
+                                                                     prior_pc=prior_pc),
+                                     monitor=monitor,
+                                     deflation_space=results['vr'][:n_prev])
+        else:
+            esolver = None
+        output_monitor.close()
 
         log.info("Finished eigendecomposition")
         vr = results['vr']
         lam = results['lam']
 
         # Check the eigenvectors & eigenvalues
-        if(params.eigendec.test_ed):
+        if(params.eigendec.test_ed and esolver is not None):
             ED.test_eigendecomposition(esolver, results, space, params)
 
-            if num_eig > 100:
-                log.warning("Requesting inner product of more than 100 EVs, this is expensive!")
-            # Check for B (not B') orthogonality & normalisation
-            for i in range(num_eig):
-                reg_op.action(vr[i].vector(), xg.vector())
-                norm = xg.vector().inner(Vector(vr[i].vector())) ** 0.5
-                if (abs(1.0 - norm) > params.eigendec.tol):
-                    raise Exception(f"Eigenvector norm is {norm}")
-
-            for i in range(num_eig):
-                reg_op.action(vr[i].vector(), xg.vector())
-                for j in range(i+1, num_eig):
-                    inn = xg.vector().inner(Vector(vr[j].vector()))
-                    if(abs(inn) > params.eigendec.tol):
-                        raise Exception(f"Eigenvectors {i} & {j} inner product nonzero: {inn}")
-
-        # Uses extreme amounts of disk space; suitable for ismipc only
-        # #Save eigenfunctions
-        # vtkfile = File(os.path.join(outdir,'vr.pvd'))
-        # for v in vr:
-        #     v.rename('v', v.label())
-        #     vtkfile << v
-        #
-        # vtkfile = File(os.path.join(outdir,'vi.pvd'))
-        # for v in vi:
-        #     v.rename('v', v.label())
-        #     vtkfile << v
+    elif eig_algo == "random":
+        seed = params.constants.random_seed
+        if n_replicas > 1:
+            check_group_alignment(space, cross_comm)
+
+            # The replicas hold the same random vectors, but each computes
+            # the Hessian actions for its share of the columns
+            if seed is None:
+                seed = MPI.COMM_WORLD.bcast(
+                    np.random.SeedSequence().entropy, root=0)
+
+            x_rep = Function(space)
+
+            def ghep_block(Y):
+                Z = np.zeros_like(Y)
+                for j in range(replica, Y.shape[1], n_replicas):
+                    function_set_values(x_rep, Y[:, j])
+                    Z[:, j] = ghep_action(x_rep)
+                cross_comm.Allreduce(MPI.IN_PLACE, Z, op=MPI.SUM)
+                return Z
+        else:
+            ghep_block = None
+
+        # There is no convergence history to relax against, so the loosest
+        # tolerance is used throughout (the range finder is approximate in
+        # any case), with the residuals checked below
+        if inexact:
+            slvr.set_hessian_rtol(rtol_max)
+
+        # Randomized GHEP: blocks of independent Hessian actions
+        if n_prev < n_total:
+            lam, V, n_hess = ED.randomized_eigendecompose(
+                space, ghep_action, prior_action, prior_inv_action,
+                N_eigenvalues=n_total - n_prev,
+                oversampling=params.eigendec.oversampling,
+                power_iter=n_iter,
+                single_pass=params.eigendec.single_pass,
+                seed=seed, A_block=ghep_block,
+                deflation=None if resume_basis is None else resume_basis.W)
+        else:
+            lam, V, n_hess = np.empty(0), np.empty((xg.vector().local_size(), 0)), 0
+        log.info(f"Finished randomized eigendecomposition with {n_hess} "
+                 f"Hessian actions over {n_replicas} replica(s)")
+
+        if resume_basis is not None:
+            lam = np.concatenate((resume_basis.lam, lam))
+            V = np.hstack((resume_basis.W, V))
+            order = np.argsort(lam)[::-1]
+            lam, V = lam[order], V[:, order]
+
+        if replica != 0:
+            # Replica 0 holds identical results & writes the output
+            if profiler is not None:
+                profiler.write(diag_path(f"_profile_replica{replica}"))
+            return mdl
+
+        vr = ED.write_eigenpairs(params, space, lam, V)
 
     else:
         raise NotImplementedError
 
+    if inexact:
+        # Check the eigenpairs against full accuracy Hessian actions
+        slvr.set_hessian_rtol(None)
+        resids = ED.eigenpair_residuals(ghep_action, prior_action,
+                                        vr, lam[:len(vr)])
+        for i, resid in enumerate(resids):
+            log.info(f"Relative residual norm for eigenpair {i} is {resid}")
+        n_bad = np.count_nonzero(resids > rtol_max)
+        if n_bad > 0:
+            log.warning(f"{n_bad} eigenpair(s) have relative residual norm "
+                        f"above {rtol_max} with exact Hessian actions")
+
+    if(params.eigendec.test_ed):
+        if num_eig > 100:
+            log.warning("Requesting inner product of more than 100 EVs, this is expensive!")
+        # Check for B (not B') orthogonality & normalisation
+        for i in range(len(vr)):
+            reg_op.action(vr[i].vector(), xg.vector())
+            norm = xg.vector().inner(Vector(vr[i].vector())) ** 0.5
+            if (abs(1.0 - norm) > params.eigendec.tol):
+                raise Exception(f"Eigenvector norm is {norm}")
+
+        for i in range(len(vr)):
+            reg_op.action(vr[i].vector(), xg.vector())
+            for j in range(i+1, len(vr)):
+                inn = xg.vector().inner(Vector(vr[j].vector()))
+                if(abs(inn) > params.eigendec.tol):
+                    raise Exception(f"Eigenvectors {i} & {j} inner product nonzero: {inn}")
+
+    # Uses extreme amounts of disk space; suitable for ismipc only
+    # #Save eigenfunctions
+    # vtkfile = File(os.path.join(outdir,'vr.pvd'))
+    # for v in vr:
+    #     v.rename('v', v.label())
+    #     vtkfile << v
+    #
+    # vtkfile = File(os.path.join(outdir,'vi.pvd'))
+    # for v in vi:
+    #     v.rename('v', v.label())
+    #     vtkfile << v
+
     slvr.eigenvals = lam
     slvr.eigenfuncs = vr
 
+    if profiler is not None:
+        profiler.write(diag_path("_profile"))
+
     # Plot of eigenvals
     lpos = np.argwhere(lam > 0)
     lneg = np.argwhere(lam < 0)
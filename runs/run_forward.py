@@ -15,7 +15,7 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with tlm_adjoint.  If not, see <https://www.gnu.org/licenses/>.
 
-from fenics_ice.backend import compute_gradient, project
+from fenics_ice.backend import project
 
 import os
 os.environ["OMP_NUM_THREADS"] = "1"
@@ -68,17 +68,17 @@ def run_forward(config_file):
 
     qoi_func = slvr.get_qoi_func()
 
-    # TODO here - cntrl now returns a list - so compute_gradient returns a list of tuples
+    # Run the forward model, returning the QoI at each of the num_sens times
+    Q_is = slvr.timestep(adjoint_flag=1, qoi_func=qoi_func)
 
-    # Run the forward model
-    Q = slvr.timestep(adjoint_flag=1, qoi_func=qoi_func)
-
-    # Run the adjoint model, computing gradient of Qoi w.r.t cntrl
-    dQ_ts = compute_gradient(Q, cntrl)  # Isaac 27
+    # Run the adjoint model, computing the gradient of each Qoi w.r.t cntrl
+    # (a list, over sensitivity times, of per-control gradients)
+    dQ_ts = slvr.compute_qoi_gradients(Q_is, cntrl)  # Isaac 27
+    inout.write_adjoint_sweeps(slvr.adjoint_sweep_times, params)
 
     # Output model variables in ParaView+Fenics friendly format
     # Output QOI & DQOI (needed for next steps)
-    inout.write_qval(slvr.Qval_ts, params)
+    inout.write_qval(slvr.Qval_ts, params, ts=slvr.t_ts)
     inout.write_dqval(dQ_ts, [var.name() for var in cntrl], params)
 
     # Output final velocity, surface & thickness (visualisation)
@@ -16,7 +16,8 @@
 # along with tlm_adjoint.  If not, see <https://www.gnu.org/licenses/>.
 
 from fenics_ice.backend import FiniteElement, Function, FunctionSpace, \
-    HDF5File, TestFunction, assemble, assign, inner, dx
+    HDF5File, TestFunction, TrialFunction, as_backend_type, assemble, assign, \
+    inner, dx, space_comm
 
 import os
 os.environ["OMP_NUM_THREADS"] = "1"
@@ -31,6 +32,10 @@ import sys
 from fenics_ice import model, solver, inout
 from fenics_ice import mesh as fice_mesh
 from fenics_ice.config import ConfigParser
+from fenics_ice.eigendecomposition import load_eigenbasis
+from fenics_ice.posterior import PosteriorCovariance
+from fenics_ice.sampling import sample_rng
+from scipy.sparse import csr_matrix, diags
 
 
 def patch_fun(mesh_in, params):
@@ -44,13 +49,13 @@ def patch_fun(mesh_in, params):
     import random
     from scipy.spatial import KDTree
 
-    comm = MPI.COMM_WORLD
-    rank = comm.rank
-    root = rank == 0
-
     # Test DG function
     # DG0 gives triangle centroids
     dg = FunctionSpace(mesh_in, 'DG', 0)
+
+    comm = space_comm(dg)
+    rank = comm.rank
+    root = rank == 0
     dg_fun = Function(dg)
 
     # Get a random sample of cells (root bcast)
@@ -112,11 +117,89 @@ def patch_fun(mesh_in, params):
     return dg_fun, ntgt
 
 
+def patch_functionals(space, clust_fun, npatches, j, dual):
+    """
+    All normalised patch indicator functionals (clust_lump in the patch loop)
+    for control component j, as the locally owned rows of a sparse
+    (n_dofs x npatches) matrix, from a single DG0 -> control space mass
+    matrix assembly.
+    """
+    from petsc4py import PETSc
+
+    comm = space_comm(space)
+    dg_space = clust_fun.function_space()
+
+    test = TestFunction(space)
+    trial = TrialFunction(dg_space)
+    if dual:
+        test = test[j]
+    B = as_backend_type(assemble(inner(trial, test)*dx)).mat()
+
+    # Patch indicator matrix, distributed as the DG0 dofs (the columns of B),
+    # with one nonzero (in the column of its patch) per row
+    patch_ids = clust_fun.vector().get_local().astype(PETSc.IntType)
+    n_local = patch_ids.size
+    P = PETSc.Mat().createAIJ(size=((n_local, PETSc.DETERMINE),
+                                    (PETSc.DECIDE, npatches)),
+                              nnz=1, comm=B.getComm())
+    P.setValuesCSR(np.arange(n_local + 1, dtype=PETSc.IntType), patch_ids,
+                   np.ones(n_local, dtype=PETSc.ScalarType))
+    P.assemble()
+
+    # Local rows of B P
+    BP = B.matMult(P)
+    row_start, row_end = BP.getOwnershipRange()
+    indptr, indices, data = BP.getValuesCSR()
+    C = csr_matrix((data, indices, indptr),
+                   shape=(row_end - row_start, npatches)).tocsc()
+    BP.destroy()
+    P.destroy()
+
+    # Normalise by patch area
+    patch_area = np.asarray(C.sum(axis=0)).ravel()
+    comm.Allreduce(MPI.IN_PLACE, patch_area, op=MPI.SUM)
+    C = C @ diags(1.0 / patch_area)
+    return C.tocsc()
+
+
+def patch_prior_variances(reg_op, C, params, comm):
+    """
+    c_i^T Gamma_prior c_i for every column c_i of C ("exact", by blocks of
+    multi-RHS prior inverse actions, or "sampled", estimated from prior
+    samples Gamma^{1/2} N, one per sqrt_inv_action, independent of the
+    number of patches)
+    """
+    block_size = params.inv_sigma.block_size
+    npatches = C.shape[1]
+
+    cov_prior = np.zeros(npatches, dtype=np.float64)
+    if params.inv_sigma.prior_variance == "exact":
+        for i0 in range(0, npatches, block_size):
+            C_block = C[:, i0:i0 + block_size].toarray()
+            Y = reg_op.inv_action_block(C_block)
+            cov_prior[i0:i0 + C_block.shape[1]] = np.sum(Y * C_block, axis=0)
+        comm.Allreduce(MPI.IN_PLACE, cov_prior, op=MPI.SUM)
+
+    else:
+        n_samples = params.inv_sigma.prior_variance_samples
+        rng = sample_rng(comm, params.constants.random_seed)
+        CT = C.T.tocsr()
+        for i0 in range(0, n_samples, block_size):
+            k = min(block_size, n_samples - i0)
+            Z = reg_op.sqrt_inv_action_block(
+                rng.standard_normal((C.shape[0], k)))
+            # Patch averages of each sample
+            avg = CT @ Z
+            comm.Allreduce(MPI.IN_PLACE, avg, op=MPI.SUM)
+            cov_prior += np.sum(avg * avg, axis=1)
+        cov_prior /= n_samples
+
+    return cov_prior
+
+
 def run_invsigma(config_file):
     """Compute control sigma values from eigendecomposition"""
 
-    comm = MPI.COMM_WORLD
-
     # Read run config file
     params = ConfigParser(config_file)
 
@@ -129,16 +212,6 @@ def run_invsigma(config_file):
     # Load the static model data (geometry, smb, etc)
     input_data = inout.InputData(params)
 
-    # Eigen decomposition params
-    phase_suffix_e = params.eigendec.phase_suffix
-    eigendir = Path(outdir)/params.eigendec.phase_name/phase_suffix_e
-    lamfile = params.io.eigenvalue_file
-    vecfile = params.io.eigenvecs_file
-
-    if len(phase_suffix_e) > 0:
-        lamfile = params.io.run_name + phase_suffix_e + '_eigvals.p'
-        vecfile = params.io.run_name + phase_suffix_e + '_vr.h5'
-
     # Get model mesh
     mesh = fice_mesh.get_mesh(params)
 
@@ -160,36 +233,11 @@ def run_invsigma(config_file):
     Prior = mdl.get_prior()
     reg_op = Prior(slvr, space)
 
-    # Loads eigenvalues from file
-    with open(os.path.join(eigendir, lamfile), 'rb') as ff:
-        eigendata = pickle.load(ff)
-        lam = eigendata[0].real.astype(np.float64)
-        nlam = len(lam)
-
-    # Check if eigendecomposition successfully produced num_eig
-    # or if some are NaN
-    if np.any(np.isnan(lam)):
-        raise RuntimeError("NaN eigenvalue(s)")
-
-    # and eigenvectors from .h5 file
-    eps = params.constants.float_eps
-    W = []
-    with HDF5File(comm,
-                  os.path.join(eigendir, vecfile), 'r') as hdf5data:
-        for i in range(nlam):
-            w = Function(space)
-            hdf5data.read(w, f'v/vector_{i}')
-
-            # Test squared norm in prior == 1.0
-            B_inv_w = Function(space, space_type="conjugate_dual")
-            reg_op.action(w.vector(), B_inv_w.vector())
-            norm_sq_in_prior = w.vector().inner(B_inv_w.vector())
-            assert (abs(norm_sq_in_prior - 1.0) < eps)
-            del B_inv_w
-
-            W.append(w)
-
-    D = np.diag(lam / (lam + 1))  # D_r Isaac 20
+    # Loads eigenvalues & eigenvectors from file
+    basis = load_eigenbasis(params, space, reg_op=reg_op)
+
+    # Gamma_prior - W D W^T (Isaac 20)
+    posterior = PosteriorCovariance(reg_op, basis)
 
     # TODO make this a model method
     cntrl_names = []
@@ -227,61 +275,76 @@ def run_invsigma(config_file):
     test = TestFunction(space)
 
     neg_flag = 0
-    for i in range(npatches):
-
-        print(f"Working on patch {i+1} of {npatches}")
+    if params.inv_sigma.batched:
+        # All patches at once: P_i^T W for every patch is a single sparse x
+        # dense product
+        patch_ids = clust_fun.vector().get_local().astype(np.int64)
+        for j in range(len(cntrl_names)):
+            C = patch_functionals(space, clust_fun, npatches, j, dual)
+
+            cov_prior = patch_prior_variances(reg_op, C, params,
+                                              space_comm(space))
+            cov_post, cov_prior = posterior.variance_of_functional(
+                C, prior_variance=cov_prior)
+
+            negative = cov_post < 0
+            if np.any(negative):
+                log.warning(f'WARNING: {np.count_nonzero(negative)} '
+                            'Negative Sigma(s), min: '
+                            f'{cov_post[negative].min()}')
+                log.warning('Setting as Zero and Continuing.')
+                neg_flag = 1
+            cov_post[negative] = 0.0
+            cov_prior[negative] = 0.0
 
-        # Create DG indicator function for patch i
-        indic_1.vector()[:] = (clust_fun.vector()[:] == i).astype(int)
-        indic_1.vector().apply("insert")
+            sigmas[j].vector().set_local(np.sqrt(cov_post)[patch_ids])
+            sigmas[j].vector().apply("insert")
+            sigma_priors[j].vector().set_local(np.sqrt(cov_prior)[patch_ids])
+            sigma_priors[j].vector().apply("insert")
 
-        # Loop alpha & beta as appropriate
-        for j in range(len(cntrl_names)):
+    else:
+        for i in range(npatches):
 
-            if(dual):
-                indic.vector()[:] = 0.0
-                indic.vector().apply("insert")
-                assign(indic.sub(j), indic_1)
-            else:
-                assign(indic, indic_1)
+            print(f"Working on patch {i+1} of {npatches}")
 
-            clust_lump = assemble(inner(indic, test)*dx)
-            patch_area = clust_lump.sum()  # Duplicate work here...
+            # Create DG indicator function for patch i
+            indic_1.vector()[:] = (clust_fun.vector()[:] == i).astype(int)
+            indic_1.vector().apply("insert")
 
-            clust_lump /= patch_area
+            # Loop alpha & beta as appropriate
+            for j in range(len(cntrl_names)):
 
-            # Prior variance
-            reg_op.inv_action(clust_lump, x.vector())
-            cov_prior = x.vector().inner(clust_lump)
+                if(dual):
+                    indic.vector()[:] = 0.0
+                    indic.vector().apply("insert")
+                    assign(indic.sub(j), indic_1)
+                else:
+                    assign(indic, indic_1)
 
-            # P_i^T W D W^T P_i
-            # P_i is clust_lump
-            # P_i^T has dims [1 x M], W has dims [M x N]
-            # where N is num eigs & M is size of ev function space
-            PiW = np.asarray([clust_lump.inner(w.vector()) for w in W])
+                clust_lump = assemble(inner(indic, test)*dx)
+                patch_area = clust_lump.sum()  # Duplicate work here...
 
-            # PiW & PiWD are [1 x N]
-            PiWD = PiW * D.diagonal()
-            # PiWDWPi, [1 x N] * [N x 1]
-            PiWDWPi = np.inner(PiWD, PiW)  # np.inner OK here because already parallel reduced
+                clust_lump /= patch_area
 
-            cov_reduction = PiWDWPi
-            cov_post = cov_prior - cov_reduction
+                # Prior variance, less P_i^T W D W^T P_i
+                # P_i is clust_lump
+                cov_post, cov_prior = \
+                    posterior.variance_of_functional(clust_lump)
 
-            if cov_post < 0:
-                log.warning(f'WARNING: Negative Sigma: {cov_post}')
-                log.warning('Setting as Zero and Continuing.')
-                neg_flag = 1
-                continue
+                if cov_post < 0:
+                    log.warning(f'WARNING: Negative Sigma: {cov_post}')
+                    log.warning('Setting as Zero and Continuing.')
+                    neg_flag = 1
+                    continue
 
-            # NB: "+=" here but each DOF will only be contributed to *once*
-            # Essentially we are constructing the sigmas functions from
-            # non-overlapping patches.
-            sigmas[j].vector()[:] += indic_1.vector()[:] * np.sqrt(cov_post)
-            sigmas[j].vector().apply("insert")
+                # NB: "+=" here but each DOF will only be contributed to *once*
+                # Essentially we are constructing the sigmas functions from
+                # non-overlapping patches.
+                sigmas[j].vector()[:] += indic_1.vector()[:] * np.sqrt(cov_post)
+                sigmas[j].vector().apply("insert")
 
-            sigma_priors[j].vector()[:] += indic_1.vector()[:] * np.sqrt(cov_prior)
-            sigma_priors[j].vector().apply("insert")
+                sigma_priors[j].vector()[:] += indic_1.vector()[:] * np.sqrt(cov_prior)
+                sigma_priors[j].vector().apply("insert")
 
     if neg_flag:
         log.warning('Negative value(s) of sigma encountered')
@@ -15,7 +15,7 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with tlm_adjoint.  If not, see <https://www.gnu.org/licenses/>.
 
-from fenics_ice.backend import Function, HDF5File
+from fenics_ice.backend import Function, HDF5File, function_set_values
 from tlm_adjoint import set_manager, stop_manager, \
         configure_tlm, function_tlm, restore_manager, \
         EquationManager, start_manager
@@ -31,6 +31,8 @@ import sys
 from fenics_ice import model, solver, inout
 from fenics_ice import mesh as fice_mesh
 from fenics_ice.config import ConfigParser
+from fenics_ice.eigendecomposition import load_eigenbasis
+from fenics_ice.posterior import PosteriorCovariance
 from ufl import split
 from fenics_ice.solver import Amat_obs_action
 
@@ -71,20 +73,11 @@ def run_obs_sens_prop(config_file):
     # Load the static model data (geometry, smb, etc)
     input_data = inout.InputData(params)
 
-    # Eigen decomposition params
-    phase_eigen = params.eigendec.phase_name
-    phase_suffix_e = params.eigendec.phase_suffix
-    lamfile = params.io.eigenvalue_file
-    vecfile = params.io.eigenvecs_file
-
     # Qoi forward params
     phase_time = params.time.phase_name
     phase_suffix_qoi = params.time.phase_suffix
     dqoi_h5file = params.io.dqoi_h5file
 
-    if len(phase_suffix_e) > 0:
-        lamfile = params.io.run_name + phase_suffix_e + '_eigvals.p'
-        vecfile = params.io.run_name + phase_suffix_e + '_vr.h5'
     if len(phase_suffix_qoi) > 0:
         dqoi_h5file = params.io.run_name + phase_suffix_qoi + '_dQ_ts.h5'
 
@@ -112,36 +105,11 @@ def run_obs_sens_prop(config_file):
     Prior = mdl.get_prior()
     reg_op = Prior(slvr, space)
 
-    # Loads eigenvalues from file
-    outdir_e = Path(outdir)/phase_eigen/phase_suffix_e
-    with open(outdir_e/lamfile, 'rb') as ff:
-        eigendata = pickle.load(ff)
-        lam = eigendata[0].real.astype(np.float64)
-        nlam = len(lam)
-
-    # Check if eigendecomposition successfully produced num_eig
-    # or if some are NaN
-    if np.any(np.isnan(lam)):
-        raise RuntimeError("NaN eigenvalue(s)")
-
-    # and eigenvectors from .h5 file
-    eps = params.constants.float_eps
-    W = []
-    with HDF5File(MPI.COMM_WORLD, str(outdir_e/vecfile), 'r') as hdf5data:
-        for i in range(nlam):
-            w = Function(space)
-            hdf5data.read(w, f'v/vector_{i}')
-
-            # Test squared norm in prior == 1.0
-            B_inv_w = Function(space, space_type="conjugate_dual")
-            reg_op.action(w.vector(), B_inv_w.vector())
-            norm_sq_in_prior = w.vector().inner(B_inv_w.vector())
-            assert (abs(norm_sq_in_prior - 1.0) < eps)
-            del B_inv_w
-
-            W.append(w)
-
-    D = np.diag(lam / (lam + 1))  # D_r Isaac 20
+    # Loads eigenvalues & eigenvectors from file
+    basis = load_eigenbasis(params, space, reg_op=reg_op)
+
+    # Gamma_prior - W D W^T (Isaac 20)
+    posterior = PosteriorCovariance(reg_op, basis)
 
     # File containing dQoi_dCntrl (i.e. Jacobian of parameter to observable (Qoi))
     outdir_qoi = Path(outdir)/phase_time/phase_suffix_qoi
@@ -191,27 +159,14 @@ def run_obs_sens_prop(config_file):
             
         hdf5data.read(dQ_cntrl, f'dQd{cntrl[0].name()}/vector_{j}')
 
-        # the rest of this loop implements the same operations as 
-        # lines 137-147 of run_errorprop.py, ie
+        # the rest of this loop implements the same operations as
+        # run_errorprop.py, ie
         #
         #   (Gamma_{prior} - W D W^T) acting on (dQ/dm)
-        #
-        # P3 needed to be defined as it is because
-        # P_vec = P2.vector() - P1.vector() led to errors later on (cannot recall specifics)
-            
-        tmp1 = np.asarray([w.vector().inner(dQ_cntrl.vector()) for w in W])
-        tmp2 = np.dot(D, tmp1)
-
-        P1 = Function(space)
-        for tmp, w in zip(tmp2, W):
-            P1.vector().axpy(tmp, w.vector())
-
-        P2 = Function(space)
-        reg_op.inv_action(dQ_cntrl.vector(), P2.vector())
 
         P3 = Function(space)
-        P3.vector()[:] = P2.vector()[:] - P1.vector()[:]
-        
+        function_set_values(P3, posterior.apply(dQ_cntrl))
+
 
         # tau is  d(U,V)/dm * (Gamma_{prior} - W D W^T) * (dQ/dm), or
         #         d(U,V)/dm * P3
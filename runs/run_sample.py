@@ -15,7 +15,8 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with tlm_adjoint.  If not, see <https://www.gnu.org/licenses/>.
 
-from fenics_ice.backend import Function, HDF5File, project
+from fenics_ice.backend import Function, HDF5File, function_set_values, \
+    project
 
 import os
 os.environ["OMP_NUM_THREADS"] = "1"
@@ -30,7 +31,9 @@ from pathlib import Path
 from fenics_ice import model, solver, prior, inout
 from fenics_ice import mesh as fice_mesh
 from fenics_ice.config import ConfigParser
-from numpy import random
+from fenics_ice.eigendecomposition import load_eigenbasis
+from fenics_ice.mpi_groups import check_group_alignment, split_groups
+from fenics_ice.sampling import GaussianSampler, RunningStats, sample_rng
 
 import matplotlib as mpl
 mpl.use("Agg")
@@ -60,10 +63,6 @@ def run_sample(config_file):
     input_data = inout.InputData(params)
 
     #Eigen value params
-    phase_name_e = params.eigendec.phase_name
-    phase_suffix_e = params.eigendec.phase_suffix
-    lamfile = params.io.eigenvalue_file
-    vecfile = params.io.eigenvecs_file
     threshlam = params.eigendec.eigenvalue_thresh
 
     # Qoi forward params
@@ -71,12 +70,16 @@ def run_sample(config_file):
     phase_suffix_qoi = params.time.phase_suffix
     dqoi_h5file = params.io.dqoi_h5file
 
-    if len(phase_suffix_e) > 0:
-        lamfile = params.io.run_name + phase_suffix_e + '_eigvals.p'
-        vecfile = params.io.run_name + phase_suffix_e + '_vr.h5'
+    # Optionally split the processes into groups, each with its own copy of
+    # the mesh, which draw their shares of the samples independently
+    n_groups = params.sample.n_groups
+    if n_groups > 1:
+        group, group_comm, cross_comm = split_groups(MPI.COMM_WORLD, n_groups)
+    else:
+        group, group_comm = 0, MPI.COMM_WORLD
 
     # Get model mesh
-    mesh = fice_mesh.get_mesh(params)
+    mesh = fice_mesh.get_mesh(params, comm=group_comm)
 
     # Define the model
     mdl = model.model(mesh, input_data, params)
@@ -98,119 +101,80 @@ def run_sample(config_file):
 
     if (sample_posterior):
 
-        # Loads eigenvalues from file
-        outdir_e = Path(outdir)/phase_name_e/phase_suffix_e
-        with open(outdir_e/lamfile, 'rb') as ff:
-            eigendata = pickle.load(ff)
-            lam = eigendata[0].real.astype(np.float64)
-            nlam = len(lam)
-
-
-        # Check if eigendecomposition successfully produced num_eig
-        # or if some are NaN
-        if np.any(np.isnan(lam)):
-            nlam = np.argwhere(np.isnan(lam))[0][0]
-            lam = lam[:nlam]
-
-        # and eigenvectors from .h5 file
-        eps = params.constants.float_eps
-        W = []
-
-        max_lam = params.sample.num_eigenvals
-        if (max_lam > 0):
-            lam = lam[:max_lam] 
-
-        y = Function(space)
-        with HDF5File(MPI.COMM_WORLD, str(outdir_e/vecfile), 'r') as hdf5data:
-            for i in range(len(lam)):
-                w = Function(space)
-                hdf5data.read(w, f'v/vector_{i}')
-
-                # Test norm in prior == 1.0
-                reg_op.action(w.vector(), y.vector())
-                norm_in_prior = w.vector().inner(y.vector())
-                assert (abs(norm_in_prior - 1.0) < eps)
-
-                W.append(w)
-
-
-      # take only the largest eigenvalues
-        pind = np.flatnonzero(lam > threshlam)
-        lam = lam[pind]
-        nlam = len(lam)
-        W = [W[i] for i in pind]
-
-### ABOVE THIS POINT CODE IS BORROWED FROM RUN_ERRORPROP.PY
-
-        D = np.diag(1 / np.sqrt(lam + 1) - 1)  
-
-    x, z, zm = [Function(space) for i in range(3)]
-    if (ssize>1):
-        zstd = Function(space)
+        # Loads eigenvalues & eigenvectors from file, taking only the
+        # largest eigenvalues
+        basis = load_eigenbasis(params, space, reg_op=reg_op,
+                                num_eig=params.sample.num_eigenvals,
+                                allow_nan=True, threshold=threshlam)
+    else:
+        basis = None
+
+    if n_groups > 1:
+        check_group_alignment(space, cross_comm)
+        # This group's share of the samples
+        group_ssize = ssize // n_groups + (1 if group < ssize % n_groups else 0)
+    else:
+        group_ssize = ssize
+
+    # Independent streams on every process (in every group)
+    rng = sample_rng(MPI.COMM_WORLD, params.constants.random_seed)
+    sampler = GaussianSampler(reg_op, rng, basis=basis)
+
+    prior_stats = RunningStats(sampler.n)
     if (sample_posterior):
-        a, am = [Function(space) for i in range(2)]
-        if (ssize>1):
-            astd = Function(space)
-
-    shp = np.shape(z.vector().get_local())
-
-    zm.vector().zero()
-    zm.vector().apply("insert")
-    if (ssize>1):
-        zstd.vector().zero()
-        zstd.vector().apply("insert")
-    
-    if (sample_posterior):
-        am.vector().zero()
-        am.vector().apply("insert")
-        y.vector().zero()
-        y.vector().apply("insert")
-        if (ssize>1):
-            astd.vector().zero()
-            astd.vector().apply("insert")
-
-    np.random.seed()
-    for i in range(params.sample.sample_size):
-
-        x.vector().set_local(random.normal(np.zeros(shp),  # N
-                         np.ones(shp),shp))
-        x.vector().apply("insert")
-	  
-        reg_op.sqrt_inv_action(x.vector(),z.vector())  # Gamma 1/2 N
-
-        zm.vector().set_local(zm.vector().get_local() + z.vector().get_local()/float(ssize))
-        zm.vector().apply("insert")
-        if (ssize>1):
-            zstd.vector().set_local(zstd.vector().get_local() + z.vector().get_local()**2/float(ssize))
-            zstd.vector().apply("insert")
-
+        post_stats = RunningStats(sampler.n)
+
+    # Optionally stream the samples to disk
+    if params.sample.write_samples:
+        outdir_sample = Path(outdir)/phase_name_sample/phase_suffix_sample
+        sample_fname = params.io.run_name + phase_suffix_sample + '_samples'
+        if n_groups > 1:
+            sample_fname += f'_group{group}'
+        sample_h5 = HDF5File(group_comm,
+                             str(outdir_sample/(sample_fname + '.h5')), 'w')
+        z, a = Function(space, name="prior_sample"), \
+            Function(space, name="posterior_sample")
+
+    block_size = params.sample.block_size
+    for i0 in range(0, group_ssize, block_size):
+        k = min(block_size, group_ssize - i0)
+
+        Z, A = sampler.sample(k)
+        prior_stats.update(Z)
         if (sample_posterior):
-            reg_op.sqrt_action(x.vector(),y.vector())  # Gamma -1/2 N
-
-            tmp1 = np.asarray([w.vector().inner(y.vector()) for w in W])
-            tmp2 = np.dot(D,tmp1)
-
-            P1 = Function(space)
-            for ind in range(len(tmp2)):
-                P1.vector().axpy(tmp2[ind],W[ind].vector())
-
-            a.vector().set_local(z.vector().get_local() + P1.vector())
-            a.vector().apply("insert")
-
-            am.vector().set_local(am.vector().get_local() + a.vector().get_local()/float(ssize))
-            am.vector().apply("insert")
-            if (ssize>1):
-                astd.vector().set_local(astd.vector().get_local() + a.vector().get_local()**2/float(ssize))
-                astd.vector().apply("insert")
+            post_stats.update(A)
+
+        if params.sample.write_samples:
+            for j in range(k):
+                function_set_values(z, Z[:, j])
+                sample_h5.write(z, "prior_sample", float(i0 + j))
+                if (sample_posterior):
+                    function_set_values(a, A[:, j])
+                    sample_h5.write(a, "posterior_sample", float(i0 + j))
+
+    if params.sample.write_samples:
+        sample_h5.close()
+
+    if n_groups > 1:
+        # Combine the group statistics, then output from the first group
+        prior_stats.allreduce(cross_comm)
+        if (sample_posterior):
+            post_stats.allreduce(cross_comm)
+        if group != 0:
+            return mdl
 
+    zm = Function(space)
+    function_set_values(zm, prior_stats.mean)
     if (ssize>1):
-        zstd.vector().set_local(np.sqrt(zstd.vector().get_local() - zm.vector().get_local()**2))   
-        zstd.vector().apply("insert")
-     
+        zstd = Function(space)
+        function_set_values(zstd, prior_stats.std)
+
     if (sample_posterior):
+        am = Function(space)
+        function_set_values(am, post_stats.mean)
         if (ssize>1):
-            astd.vector().set_local(np.sqrt(astd.vector().get_local() - am.vector().get_local()**2))
-            astd.vector().apply("insert")
+            astd = Function(space)
+            function_set_values(astd, post_stats.std)
 
     if params.inversion.dual:
         alpha_prior_sample_mean = project(zm[0], slvr.Qp)
@@ -288,6 +252,8 @@ def run_sample(config_file):
                           phase_name=phase_name_sample, 
                           phase_suffix=phase_suffix_sample)
 
+    return mdl
+
 if __name__ == "__main__":
     assert len(sys.argv) == 2, "Expected a configuration file (*.toml)"
     run_sample(sys.argv[1])
@@ -17,13 +17,24 @@
 
 # -*- coding: utf-8 -*-
 
-from fenics_ice.backend import Function, function_update_state, norm
+from fenics_ice.backend import Function, FunctionSpace, Point, \
+    UnitIntervalMesh, function_update_state, norm
 
 import pytest
+import copy
 import os
+import json
+import mpi4py.MPI as MPI  # noqa: N817
 import numpy as np
+import petsc4py.PETSc as PETSc
 import fenics_ice as fice
 from fenics_ice import model, config, inout, solver
+from fenics_ice.eigendecomposition import EigenBasis
+from fenics_ice.posterior import PosteriorCovariance
+from fenics_ice.profiling import Profiler
+from fenics_ice.sampling import RunningStats
+from fenics_ice.sqrt_matrix_action import ChebyshevSqrtAction, \
+    LumpedPCSqrtMassAction
 
 def init_model(model_dir, toml_file):
 
@@ -227,6 +238,408 @@ def test_control_separation(request, setup_deps, temp_model):
     assert norm_as != norm_am
     assert norm_bs != norm_bm
 
+@pytest.mark.dependency()
+def test_momsolve_reuse_solver(request, setup_deps, temp_model):
+    """Check the persistent & warm started momentum solves match the default"""
+
+    setup_deps.set_case_dependency(request, ["test_init_model",
+                                             "test_initialize_fields"])
+    work_dir = temp_model["work_dir"]
+    toml_file = temp_model["toml_filename"]
+
+    mdl = init_model(work_dir, toml_file)
+    initialize_fields(mdl)
+    initialize_vel_obs(mdl)
+    mdl.gen_alpha()
+
+    slvr = solver.ssa_solver(mdl)
+    slvr.def_mom_eq()
+    slvr.solve_mom_eq()
+    U_norm = norm(slvr.U.vector())
+
+    override_param(mdl.params.momsolve, "reuse_solver", True)
+    slvr = solver.ssa_solver(mdl)
+    for i in range(2):
+        slvr.def_mom_eq()
+        slvr.solve_mom_eq()
+
+    counts = slvr.mom_solver_cache.counts
+    assert counts["form_setups"] == 1
+    assert counts["form_reuses"] == 1
+    assert counts["solver_setups"] == 2  # picard & newton
+    assert counts["solver_reuses"] == 2
+
+    assert np.isclose(norm(slvr.U.vector()), U_norm, rtol=1.0e-6)
+
+    # Starting from the converged velocity, picard should be skipped
+    override_param(mdl.params.momsolve, "newton_warm_start", True)
+    slvr.solve_mom_eq()
+    assert counts["picard_skipped"] == 1
+    assert np.isclose(norm(slvr.U.vector()), U_norm, rtol=1.0e-6)
+
+@pytest.mark.dependency()
+def test_hessian_rtol(request, setup_deps, temp_model):
+    """Check the relaxed tolerance reaches the Hessian's Krylov solves"""
+
+    setup_deps.set_case_dependency(request, ["test_init_model",
+                                             "test_initialize_fields"])
+    work_dir = temp_model["work_dir"]
+    toml_file = temp_model["toml_filename"]
+
+    mdl = init_model(work_dir, toml_file)
+    initialize_fields(mdl)
+    initialize_vel_obs(mdl)
+    mdl.gen_alpha()
+
+    # Iterative momentum solves, so that the tolerance matters
+    newton_params = copy.deepcopy(mdl.params.momsolve.newton_params)
+    newton_params["newton_solver"].update(
+        {"linear_solver": "gmres", "preconditioner": "ilu",
+         "krylov_solver": {"relative_tolerance": 1.0e-12,
+                           "absolute_tolerance": 1.0e-30,
+                           "maximum_iterations": 10000}})
+    override_param(mdl.params.momsolve, "newton_params", newton_params)
+
+    slvr = solver.ssa_solver(mdl)
+    cntrl = slvr.get_control()[0]
+    slvr.set_hessian_action(cntrl)
+
+    dm = Function(cntrl.function_space())
+    dm.vector()[:] = 1.0
+    dm.vector().apply("insert")
+
+    # Krylov iterations, counted by PETSc's MatMult events
+    PETSc.Log.begin()
+    mat_mult = PETSc.Log.Event("MatMult")
+
+    def action():
+        start = mat_mult.getPerfInfo()["count"]
+        _, _, ddJ_val = slvr.ddJ.action(cntrl, dm)
+        return mat_mult.getPerfInfo()["count"] - start, norm(ddJ_val.vector())
+
+    n_exact, ddJ_norm = action()
+    slvr.set_hessian_rtol(1.0e-4)
+    n_relaxed, ddJ_norm_relaxed = action()
+    slvr.set_hessian_rtol(None)
+    n_restored, _ = action()
+
+    assert n_relaxed < n_exact
+    assert n_restored == n_exact
+    assert np.isclose(ddJ_norm_relaxed, ddJ_norm, rtol=1.0e-2)
+
+def test_velocity_cache():
+    """Check nearest & extrapolated velocity initial guesses"""
+
+    mesh = UnitIntervalMesh(MPI.COMM_WORLD, 10)
+    space = FunctionSpace(mesh, "Lagrange", 1)
+    m = Function(space, name="m")
+    U = Function(space, name="U")
+
+    def set_value(x, value):
+        x.vector()[:] = value
+        x.vector().apply("insert")
+
+    def store(cache, m_value, U_value):
+        set_value(m, m_value)
+        set_value(U, U_value)
+        cache.store([m], U)
+
+    def guess(cache, m_value):
+        set_value(m, m_value)
+        set_value(U, 0.0)
+        assert cache.initial_guess([m], U)
+        return U.vector().max()
+
+    nearest = solver.VelocityCache(2, "nearest")
+    assert not nearest.initial_guess([m], U)
+    store(nearest, 1.0, 10.0)
+    store(nearest, 2.0, 20.0)
+    assert np.isclose(guess(nearest, 1.2), 10.0)
+    assert np.isclose(guess(nearest, 5.0), 20.0)
+
+    extrapolate = solver.VelocityCache(2, "extrapolate")
+    store(extrapolate, 1.0, 10.0)
+    store(extrapolate, 2.0, 20.0)
+    assert np.isclose(guess(extrapolate, 3.0), 30.0)
+
+    # Using the first entry makes the second least recently used, so it is
+    # evicted, & the extrapolation is from the first & third stored
+    guess(extrapolate, 1.0)
+    store(extrapolate, 4.0, 40.0)
+    assert len(extrapolate) == 2
+    assert np.isclose(guess(extrapolate, 7.0), 70.0)
+
+@pytest.mark.dependency()
+def test_obs_cache(request, setup_deps, temp_model, monkeypatch):
+    """Check a second comp_J_inv reads the cached observation operators"""
+
+    setup_deps.set_case_dependency(request, ["test_init_model",
+                                             "test_initialize_fields"])
+    work_dir = temp_model["work_dir"]
+    toml_file = temp_model["toml_filename"]
+
+    mdl = init_model(work_dir, toml_file)
+    initialize_fields(mdl)
+    initialize_vel_obs(mdl)
+    mdl.gen_alpha()
+    override_param(mdl.params.obs, "cache_operators", True)
+
+    def comp_J():
+        slvr = solver.ssa_solver(mdl)
+        slvr.def_mom_eq()
+        slvr.solve_mom_eq()
+        return slvr.comp_J_inv().value()
+
+    J_0 = comp_J()
+
+    # The operators must now come from the cache
+    def no_interpolation_matrix(*args, **kwargs):
+        raise AssertionError("Observation operators not read from the cache")
+    monkeypatch.setattr(solver, "interpolation_matrix", no_interpolation_matrix)
+
+    J_1 = comp_J()
+    assert np.isclose(J_1, J_0, rtol=1.0e-12)
+
+@pytest.mark.dependency()
+def test_locate_points(request, setup_deps, temp_model):
+    """Check batched point location agrees with the BoundingBoxTree"""
+
+    setup_deps.set_case_dependency(request, ["test_init_model"])
+    work_dir = temp_model["work_dir"]
+    toml_file = temp_model["toml_filename"]
+
+    mdl = init_model(work_dir, toml_file)
+    mesh = mdl.mesh
+
+    # Random points covering (& extending beyond) the mesh, plus the vertices
+    coords = mesh.coordinates()
+    lower, upper = coords.min(axis=0), coords.max(axis=0)
+    rng = np.random.default_rng(0)
+    pts = lower + (upper - lower) * rng.uniform(-0.1, 1.1, (2000, 2))
+    pts = np.concatenate([pts, coords])
+
+    cells = fice.mesh.locate_points(pts, mesh, batch_size=500)
+
+    bbox = mesh.bounding_box_tree()
+    for i, cell in enumerate(cells):
+        collisions = bbox.compute_entity_collisions(Point(*pts[i, :]))
+        if cell < 0:
+            assert len(collisions) == 0
+        else:
+            assert cell in collisions
+
+@pytest.mark.dependency()
+def test_prior_solvers(request, setup_deps, temp_model):
+    """Check the factorized & AMG prior solvers match the default CG"""
+
+    setup_deps.set_case_dependency(request, ["test_init_model",
+                                             "test_initialize_fields"])
+    work_dir = temp_model["work_dir"]
+    toml_file = temp_model["toml_filename"]
+
+    mdl = init_model(work_dir, toml_file)
+    initialize_fields(mdl)
+    initialize_vel_obs(mdl)
+    slvr = solver.ssa_solver(mdl)
+    space = slvr.get_control_space()
+
+    x = Function(space, space_type="conjugate_dual")
+    rng = np.random.default_rng(0)
+    x.vector().set_local(rng.standard_normal(x.vector().local_size()))
+    x.vector().apply("insert")
+
+    def inv_action():
+        reg_op = mdl.get_prior()(slvr, space)
+        y = Function(space)
+        reg_op.inv_action(x.vector(), y.vector())
+        return reg_op, y.vector().get_local()
+
+    _, y_cg = inv_action()
+    for A_solver, M_solver, factor_package in [("lu", "lu", None),
+                                               ("amg", "cg", None),
+                                               ("cholesky", "cholesky", None),
+                                               ("cholesky", "lu", "mumps")]:
+        override_param(mdl.params.prior, "A_solver", A_solver)
+        override_param(mdl.params.prior, "M_solver", M_solver)
+        override_param(mdl.params.prior, "factor_package", factor_package)
+        reg_op, y = inv_action()
+        assert np.linalg.norm(y - y_cg) <= 1.0e-8 * np.linalg.norm(y_cg)
+
+        if A_solver == "cholesky":
+            # The factor package must survive the PC type change
+            pc = reg_op.A_solver.ksp().getPC()
+            assert pc.getType() == "cholesky"
+            assert pc.getFactorSolverType() == (factor_package or "mumps")
+
+@pytest.mark.dependency()
+def test_prior_cache(request, setup_deps, temp_model):
+    """Check the solver reuses its prior until the reg params change"""
+
+    setup_deps.set_case_dependency(request, ["test_init_model",
+                                             "test_initialize_fields"])
+    work_dir = temp_model["work_dir"]
+    toml_file = temp_model["toml_filename"]
+
+    mdl = init_model(work_dir, toml_file)
+    initialize_fields(mdl)
+    initialize_vel_obs(mdl)
+    slvr = solver.ssa_solver(mdl)
+
+    lap = slvr.get_prior()
+    assert slvr.get_prior() is lap
+
+    slvr.zero_inv_params()
+    assert slvr.get_prior() is not lap
+
+@pytest.mark.dependency()
+def test_sqrt_mass_chebyshev(request, setup_deps, temp_model):
+    """Check the Chebyshev mass matrix root matches the binomial series"""
+
+    setup_deps.set_case_dependency(request, ["test_init_model"])
+    work_dir = temp_model["work_dir"]
+    toml_file = temp_model["toml_filename"]
+
+    mdl = init_model(work_dir, toml_file)
+    space = mdl.Qp
+
+    binomial = LumpedPCSqrtMassAction(space, tol=1.0e-16, beta=2.0/3.0)
+    chebyshev = LumpedPCSqrtMassAction(space, tol=1.0e-16,
+                                       method="chebyshev")
+
+    x = Function(space).vector()
+    rng = np.random.default_rng(0)
+    X = rng.standard_normal((x.local_size(), 3))
+
+    Y, terms = chebyshev.action_block(X)
+    assert terms < 100
+    for j in range(X.shape[1]):
+        x.set_local(X[:, j])
+        x.apply("insert")
+        y, _ = binomial.action(x)
+        y = y.get_local()
+        assert np.linalg.norm(Y[:, j] - y) <= 1.0e-10 * np.linalg.norm(y)
+
+def test_chebyshev_sqrt_bounds():
+    """Check the Chebyshev square root is accurate with estimated bounds, &
+    that bounds not containing the spectrum are detected"""
+    d = np.logspace(-2.0, 0.0, 200)
+
+    def A_action(X, Y):
+        np.multiply(X, d.reshape((-1, 1)), out=Y)
+
+    sqrt_A = ChebyshevSqrtAction(A_action, d.shape[0], MPI.COMM_WORLD)
+    assert sqrt_A.residual(seed=1) < 1.0e-7
+
+    X = np.random.default_rng(0).standard_normal((d.shape[0], 2))
+    Y, _ = sqrt_A.action(X)
+    assert np.allclose(Y, np.sqrt(d).reshape((-1, 1)) * X, rtol=1.0e-10)
+
+    too_narrow = ChebyshevSqrtAction(A_action, d.shape[0], MPI.COMM_WORLD,
+                                     bounds=(1.0e-2, 0.25))
+    assert too_narrow.residual() > 1.0
+
+def test_posterior_covariance(request, setup_deps, temp_model):
+    """Check posterior variances of functionals match the covariance action"""
+
+    setup_deps.set_case_dependency(request, ["test_init_model",
+                                             "test_initialize_fields"])
+    work_dir = temp_model["work_dir"]
+    toml_file = temp_model["toml_filename"]
+
+    mdl = init_model(work_dir, toml_file)
+    initialize_fields(mdl)
+    initialize_vel_obs(mdl)
+    slvr = solver.ssa_solver(mdl)
+    reg_op = slvr.get_prior()
+
+    n = reg_op.tmp1.local_size()
+    rng = np.random.default_rng(0)
+    basis = EigenBasis(reg_op.space, np.array([10.0, 1.0, 0.1]),
+                       1.0e-3 * rng.standard_normal((n, 3)))
+    posterior = PosteriorCovariance(reg_op, basis)
+
+    G = rng.standard_normal((n, 4))
+    var_post, var_prior = posterior.variance_of_functional(G)
+    expected = np.sum(G * posterior.apply(G), axis=0)
+    basis.comm.Allreduce(MPI.IN_PLACE, expected, op=MPI.SUM)
+
+    assert np.all(var_post < var_prior)
+    assert np.allclose(var_post, expected)
+
+def test_running_stats():
+    """Check blockwise Welford statistics match numpy"""
+    rng = np.random.default_rng(0)
+    X = rng.normal(3.0, 2.0, (50, 37))
+
+    stats = RunningStats(X.shape[0])
+    for i0 in range(0, X.shape[1], 8):
+        stats.update(X[:, i0:i0 + 8])
+
+    assert stats.count == X.shape[1]
+    assert np.allclose(stats.mean, X.mean(axis=1))
+    assert np.allclose(stats.std, X.std(axis=1))
+
+def test_profiler(tmp_path):
+    """Check profiled calls & solver iterations are summarised & written"""
+    class Solver:
+        def solve(self, x, b):
+            return 7
+
+    class Holder:
+        pass
+
+    profiler = Profiler()
+    fn = profiler.wrap("fn", lambda x: 2 * x)
+    holder = Holder()
+    holder.solver = Solver()
+    profiler.profile_solver(holder, "solver", "solve")
+
+    assert fn(3) == 6
+    fn(4)
+    assert holder.solver.solve(None, None) == 7
+
+    stats = profiler.summary()
+    assert stats["fn"]["calls"] == 2
+    assert stats["solve"]["iterations"] == 7
+
+    profiler.write(str(tmp_path / "profile"))
+    with open(tmp_path / "profile.json") as f:
+        assert json.load(f)["operations"]["fn"]["calls"] == 2
+    with open(tmp_path / "profile.csv") as f:
+        assert len(f.readlines()) == 4
+
+def test_profiler_hessian():
+    """Check Hessian actions are split into tangent-linear & adjoint parts"""
+    class Manager:
+        def compute_gradient(self, J, M):
+            return 2
+
+    class Hessian:
+        def _setup_manager(self, M, dM, solve_tlm=True):
+            return Manager(), M, dM
+
+        def action(self, M, dM):
+            manager, M, dM = self._setup_manager(M, dM)
+            return 1, 1, manager.compute_gradient(None, M)
+
+        def compute_gradient(self, M):
+            manager, M, _ = self._setup_manager(M, None, solve_tlm=False)
+            return 0, manager.compute_gradient(None, M)
+
+    profiler = Profiler()
+    ddJ = Hessian()
+    profiler.profile_hessian(ddJ)
+
+    assert ddJ.action(None, None) == (1, 1, 2)
+    ddJ.action(None, None)
+    ddJ.compute_gradient(None)
+
+    stats = profiler.summary()
+    for name in ["hessian_action", "hessian_tlm", "hessian_adjoint"]:
+        assert stats[name]["calls"] == 2
+    assert stats["hessian_tlm"]["total"] + stats["hessian_adjoint"]["total"] \
+        <= stats["hessian_action"]["total"]
+
 # Unused!
 def override_param(param_section, name, value):
     """Override frozen ConfigParser params for testing"""
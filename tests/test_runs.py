@@ -22,8 +22,14 @@ from fenics_ice.backend import clear_caches, compute_gradient, norm, \
 import pytest
 import numpy as np
 from runs import run_inv, run_forward, run_eigendec, run_errorprop, run_invsigma
-from fenics_ice import config
+from fenics_ice import config, inout
+from fenics_ice.eigendecomposition import eigenpair_paths
+from pathlib import Path
+import pickle
 import shutil
+import toml
+import h5py
+from xml.etree import ElementTree
 
 
 def EQReset():
@@ -34,6 +40,16 @@ def EQReset():
     clear_caches()
     stop_manager()
 
+def override_toml(toml_file, work_dir, section, **values):
+    """Write a copy of toml_file with values overridden in [section]"""
+    config_dict = toml.load(toml_file)
+    config_dict.setdefault(section, {}).update(values)
+
+    new_toml = Path(work_dir) / ("override_" + Path(toml_file).name)
+    with open(new_toml, 'w') as f:
+        toml.dump(config_dict, f)
+    return str(new_toml)
+
 @pytest.mark.order(1)
 @pytest.mark.dependency()
 def test_run_inversion(persistent_temp_model, monkeypatch):
@@ -177,6 +193,140 @@ def test_run_forward(existing_temp_model, monkeypatch, setup_deps):
                               expected_u_norm,
                               work_dir, 'expected_u_norm', tol=tol)
 
+@pytest.mark.parametrize("linear_solver", ["lu", "gmres"])
+@pytest.mark.dependency(["test_run_forward"])
+def test_run_forward_reuse_thickness_solver(existing_temp_model, monkeypatch,
+                                            setup_deps, linear_solver):
+    """Check the persistent thickness solver reproduces the forward QoI"""
+
+    work_dir = existing_temp_model["work_dir"]
+    toml_file = existing_temp_model["toml_filename"]
+
+    # Switch to the working directory
+    monkeypatch.chdir(work_dir)
+
+    params = config.ConfigParser(toml_file, top_dir=work_dir)
+    expected_delta_qoi = params.testing.expected_delta_qoi
+
+    reuse_toml = override_toml(toml_file, work_dir, 'mass_solve',
+                               reuse_solver=True, linear_solver=linear_solver)
+    reuse_toml = override_toml(reuse_toml, work_dir, 'time',
+                               phase_suffix='_reuse')
+
+    EQReset()
+    mdl_out = run_forward.run_forward(reuse_toml)
+    slvr = mdl_out.solvers[0]
+
+    assert slvr.thickadv_solver.counts["solver_setups"] == 1
+    delta_qoi = slvr.Qval_ts[-1] - slvr.Qval_ts[0]
+    assert np.isclose(delta_qoi, expected_delta_qoi, rtol=1.0e-5)
+
+@pytest.mark.dependency(["test_run_forward"])
+def test_run_forward_explicit_thickness(existing_temp_model, monkeypatch,
+                                        setup_deps):
+    """Check the sub-stepped explicit thickness update is close to implicit"""
+
+    work_dir = existing_temp_model["work_dir"]
+    toml_file = existing_temp_model["toml_filename"]
+
+    # Switch to the working directory
+    monkeypatch.chdir(work_dir)
+
+    params = config.ConfigParser(toml_file, top_dir=work_dir)
+    expected_delta_qoi = params.testing.expected_delta_qoi
+
+    explicit_toml = override_toml(toml_file, work_dir, 'mass_solve',
+                                  scheme='explicit')
+    explicit_toml = override_toml(explicit_toml, work_dir, 'time',
+                                  phase_suffix='_explicit')
+
+    EQReset()
+    mdl_out = run_forward.run_forward(explicit_toml)
+    slvr = mdl_out.solvers[0]
+
+    # Both schemes are first order in time
+    delta_qoi = slvr.Qval_ts[-1] - slvr.Qval_ts[0]
+    assert np.isclose(delta_qoi, expected_delta_qoi, rtol=5.0e-2)
+
+@pytest.mark.dependency(["test_run_forward"])
+def test_run_forward_adaptive(existing_temp_model, monkeypatch, setup_deps):
+    """Check adaptive timestepping lands on the QoI times & is close to fixed"""
+
+    work_dir = existing_temp_model["work_dir"]
+    toml_file = existing_temp_model["toml_filename"]
+
+    # Switch to the working directory
+    monkeypatch.chdir(work_dir)
+
+    params = config.ConfigParser(toml_file, top_dir=work_dir)
+    expected_delta_qoi = params.testing.expected_delta_qoi
+
+    adaptive_toml = override_toml(toml_file, work_dir, 'time',
+                                  adaptive=True, phase_suffix='_adaptive')
+    adaptive_toml = override_toml(adaptive_toml, work_dir, 'checkpointing',
+                                  method='memory')
+
+    EQReset()
+    mdl_out = run_forward.run_forward(adaptive_toml)
+    slvr = mdl_out.solvers[0]
+
+    t_sens = np.linspace(0.0, params.time.run_length, params.time.num_sens)
+    assert all(np.any(np.isclose(slvr.t_ts, t, rtol=0.0, atol=1.0e-8))
+               for t in t_sens)
+    assert len(slvr.t_ts) == len(slvr.Qval_ts)
+
+    delta_qoi = slvr.Qval_ts[-1] - slvr.Qval_ts[0]
+    assert np.isclose(delta_qoi, expected_delta_qoi, rtol=5.0e-2)
+
+@pytest.mark.dependency(["test_run_forward"])
+def test_run_forward_timeseries_output(existing_temp_model, monkeypatch,
+                                       setup_deps):
+    """Check timestep output written to a single time-series file"""
+
+    work_dir = existing_temp_model["work_dir"]
+    toml_file = existing_temp_model["toml_filename"]
+
+    # Switch to the working directory
+    monkeypatch.chdir(work_dir)
+
+    params = config.ConfigParser(toml_file, top_dir=work_dir)
+    expected_delta_qoi = params.testing.expected_delta_qoi
+
+    timeseries_toml = override_toml(toml_file, work_dir, 'io',
+                                    timeseries_output=True)
+    timeseries_toml = override_toml(timeseries_toml, work_dir, 'time',
+                                    save_frequency=params.time.run_length / 2,
+                                    phase_suffix='_timeseries')
+
+    EQReset()
+    mdl_out = run_forward.run_forward(timeseries_toml)
+    slvr = mdl_out.solvers[0]
+
+    params = config.ConfigParser(timeseries_toml, top_dir=work_dir)
+    xdmf_path = inout.timeseries_path(params, "timesteps",
+                                      params.io.diagnostics_dir,
+                                      phase_name=params.time.phase_name,
+                                      phase_suffix='_timeseries')
+
+    # Saved at step 0, then every n_save_frequency steps
+    n_steps = params.time.total_steps
+    n_save_frequency = int(min(np.ceil(params.time.save_frequency
+                                       / params.time.dt), n_steps))
+    n_saves = 1 + n_steps // n_save_frequency
+    n_vars = 3 if params.melt.use_melt_parameterisation else 2  # H, U, (melt)
+
+    # One mesh, & the values of each variable at each saved step
+    with h5py.File(xdmf_path.with_suffix(".h5"), 'r') as f:
+        assert len(f["Mesh"]) == 1
+        assert len(f["VisualisationVector"]) == n_saves * n_vars
+
+    times = {float(e.get("Value"))
+             for e in ElementTree.parse(xdmf_path).getroot().iter("Time")}
+    assert len(times) == n_saves
+
+    delta_qoi = slvr.Qval_ts[-1] - slvr.Qval_ts[0]
+    assert np.isclose(delta_qoi, expected_delta_qoi, rtol=1.0e-5)
+
 @pytest.mark.tv
 def test_tv_run_forward(existing_temp_model, monkeypatch, setup_deps):
     """
@@ -279,6 +429,89 @@ def test_run_eigendec(existing_temp_model, monkeypatch, setup_deps):
                               expected_evec0_norm,
                               work_dir, 'expected_evec0_norm', tol=tol)
 
+@pytest.mark.dependency(["test_run_eigendec"])
+def test_run_eigendec_random(existing_temp_model, monkeypatch, setup_deps):
+    """Check the randomized GHEP finds the leading SLEPc eigenvalues"""
+
+    work_dir = existing_temp_model["work_dir"]
+    toml_file = existing_temp_model["toml_filename"]
+
+    # Switch to the working directory
+    monkeypatch.chdir(work_dir)
+
+    params = config.ConfigParser(toml_file, top_dir=work_dir)
+    with open(eigenpair_paths(params)[0], 'rb') as f:
+        lam_slepc = pickle.load(f)[0]
+
+    num_eig = min(10, len(lam_slepc))
+    random_toml = override_toml(toml_file, work_dir, 'eigendec',
+                                eig_algo='random', num_eig=num_eig,
+                                oversampling=20, power_iter=2,
+                                phase_suffix='_random')
+
+    EQReset()
+    mdl_out = run_eigendec.run_eigendec(random_toml)
+    lam_random = mdl_out.solvers[0].eigenvals
+
+    assert np.allclose(lam_random[:3], lam_slepc[:3], rtol=1.0e-3)
+
+@pytest.mark.dependency(["test_run_eigendec"])
+def test_run_eigendec_resume(existing_temp_model, monkeypatch, setup_deps):
+    """Check a resumed eigendecomposition extends the previous eigenpairs"""
+
+    work_dir = existing_temp_model["work_dir"]
+    toml_file = existing_temp_model["toml_filename"]
+
+    # Switch to the working directory
+    monkeypatch.chdir(work_dir)
+
+    params = config.ConfigParser(toml_file, top_dir=work_dir)
+    with open(eigenpair_paths(params)[0], 'rb') as f:
+        lam_slepc = pickle.load(f)[0]
+
+    num_eig = min(6, len(lam_slepc))
+    first_toml = override_toml(toml_file, work_dir, 'eigendec',
+                               eig_algo='random', num_eig=num_eig // 2,
+                               oversampling=20, power_iter=2,
+                               phase_suffix='_resume')
+    EQReset()
+    lam_first = run_eigendec.run_eigendec(first_toml).solvers[0].eigenvals
+
+    resume_toml = override_toml(toml_file, work_dir, 'eigendec',
+                                eig_algo='random', num_eig=num_eig,
+                                oversampling=20, power_iter=2,
+                                phase_suffix='_resume', resume=True)
+    EQReset()
+    lam_resumed = run_eigendec.run_eigendec(resume_toml).solvers[0].eigenvals
+
+    assert len(lam_resumed) == num_eig
+    assert np.allclose(lam_resumed[:num_eig // 2], lam_first)
+    assert np.allclose(lam_resumed[:3], lam_slepc[:3], rtol=1.0e-3)
+
+@pytest.mark.dependency(["test_run_eigendec"])
+def test_run_eigendec_inexact(existing_temp_model, monkeypatch, setup_deps):
+    """Check relaxed tolerance Hessian actions give the leading eigenvalues"""
+
+    work_dir = existing_temp_model["work_dir"]
+    toml_file = existing_temp_model["toml_filename"]
+
+    # Switch to the working directory
+    monkeypatch.chdir(work_dir)
+
+    params = config.ConfigParser(toml_file, top_dir=work_dir)
+    with open(eigenpair_paths(params)[0], 'rb') as f:
+        lam_slepc = pickle.load(f)[0]
+
+    inexact_toml = override_toml(toml_file, work_dir, 'eigendec',
+                                 inexact_hessian=True, hessian_rtol_max=1.0e-6,
+                                 phase_suffix='_inexact')
+
+    EQReset()
+    mdl_out = run_eigendec.run_eigendec(inexact_toml)
+    lam_inexact = mdl_out.solvers[0].eigenvals
+
+    assert np.allclose(lam_inexact[:3], lam_slepc[:3], rtol=1.0e-4)
+
 @pytest.mark.order(4)
 @pytest.mark.dependency(["test_run_eigendec", "test_run_forward"])
 def test_run_errorprop(existing_temp_model, monkeypatch, setup_deps):
@@ -316,6 +549,30 @@ def test_run_errorprop(existing_temp_model, monkeypatch, setup_deps):
                               work_dir,
                               'expected_Q_sigma_prior', tol=tol)
 
+@pytest.mark.dependency(["test_run_errorprop"])
+def test_run_errorprop_batched(existing_temp_model, monkeypatch, setup_deps):
+    """Check the batched error propagation matches the per-time loop"""
+
+    work_dir = existing_temp_model["work_dir"]
+    toml_file = existing_temp_model["toml_filename"]
+
+    # Switch to the working directory
+    monkeypatch.chdir(work_dir)
+
+    EQReset()
+    mdl_loop = run_errorprop.run_errorprop(toml_file)
+
+    batched_toml = override_toml(toml_file, work_dir, 'errorprop',
+                                 batched=True)
+
+    EQReset()
+    mdl_batched = run_errorprop.run_errorprop(batched_toml)
+
+    assert np.allclose(mdl_batched.Q_sigma, mdl_loop.Q_sigma,
+                       rtol=1e-10, atol=0.0)
+    assert np.allclose(mdl_batched.Q_sigma_prior, mdl_loop.Q_sigma_prior,
+                       rtol=1e-10, atol=0.0)
+
 @pytest.mark.skipif(pytest.parallel, reason='broken in parallel')
 @pytest.mark.dependency(["test_run_eigendec"],["test_run_errorprop"])
 def test_run_invsigma(existing_temp_model, monkeypatch, setup_deps):
@@ -352,6 +609,34 @@ def test_run_invsigma(existing_temp_model, monkeypatch, setup_deps):
                               work_dir,
                               "expected_cntrl_sigma_prior_norm", tol=tol)
 
+@pytest.mark.skipif(pytest.parallel, reason='broken in parallel')
+@pytest.mark.dependency(["test_run_invsigma"])
+def test_run_invsigma_batched(existing_temp_model, monkeypatch, setup_deps):
+    """Check the batched patch sigmas match the per-patch loop"""
+
+    work_dir = existing_temp_model["work_dir"]
+    toml_file = existing_temp_model["toml_filename"]
+
+    # Switch to the working directory
+    monkeypatch.chdir(work_dir)
+
+    EQReset()
+    mdl_loop = run_invsigma.run_invsigma(toml_file)
+
+    batched_toml = override_toml(toml_file, work_dir, 'invsigma',
+                                 batched=True, block_size=7)
+
+    EQReset()
+    mdl_batched = run_invsigma.run_invsigma(batched_toml)
+
+    for sig_batched, sig_loop in zip(mdl_batched.cntrl_sigma +
+                                     mdl_batched.cntrl_sigma_prior,
+                                     mdl_loop.cntrl_sigma +
+                                     mdl_loop.cntrl_sigma_prior):
+        assert np.allclose(sig_batched.vector().get_local(),
+                           sig_loop.vector().get_local(),
+                           rtol=1.0e-8, atol=1.0e-12)
+
 @pytest.mark.key('smith')
 def test_run_smith_inversion(temp_model, monkeypatch):
 